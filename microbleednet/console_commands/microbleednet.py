@@ -13,6 +13,18 @@ from microbleednet.documentation import help_messages
 # 14-01-2023          #
 #######################
 
+def str_to_bool(value):
+    """
+    Parses the value of a boolean option, type=bool would turn any non-empty string (e.g. False) into True
+    :param value: str, true/false, yes/no, 1/0 or an empty string (false), case insensitive
+    :return: bool
+    """
+    if value.lower() in ['true', 'yes', 'y', '1']:
+        return True
+    if value.lower() in ['false', 'no', 'n', '0', '']:
+        return False
+    raise argparse.ArgumentTypeError(f'Boolean value expected (True or False), got {value}')
+
 def main():
     desc_msgs = help_messages.desc_descs()
     epilog_msgs = help_messages.epilog_descs()
@@ -55,14 +67,16 @@ def main():
     optionalNamedtrain = parser_train.add_argument_group('Optional named arguments')
     optionalNamedtrain.add_argument('-tr_prop', '--train_prop', type=float, required=False, default=0.8,
                                     help='Proportion of data used for training (default = 0.8)')
-    optionalNamedtrain.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=10,
-                                    help='No. of subjects considered for each mini-epoch (default = 10)')
+    optionalNamedtrain.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=1,
+                                    help='No. of batches accumulated for each optimiser step (default = 1)')
     optionalNamedtrain.add_argument('-psize', '--patch_size', type=int, required=False, default=48,
                                     help='Size of patches extracted for candidate detection (default = 48)')
     optionalNamedtrain.add_argument('-cand_det', '--cand_detection', type=bool, required=False, default=True,
                                     help='Train the candidate detection (step 1) model (default = True)')
     optionalNamedtrain.add_argument('-cand_disc', '--cand_discrimination', type=bool, required=False, default=True,
                                     help='Train the candidate discrimination (step 2) model (default = True)')
+    optionalNamedtrain.add_argument('-cand_disc_shared', '--cand_discrimination_shared', type=str_to_bool, required=False, default=False,
+                                    help='Train the candidate discrimination head on the CDet encoder features (default = False)')
     optionalNamedtrain.add_argument('-da', '--data_augmentation', type=bool, required=False, default=True,
                                     help='Applying data augmentation (default=True)')
     optionalNamedtrain.add_argument('-af', '--aug_factor', type=int, required=False, default=2,
@@ -87,16 +101,40 @@ def main():
                                     help='Number of epochs (default=100)')
     optionalNamedtrain.add_argument('-es', '--early_stop_val', type=int, required=False, default=20,
                                     help='No. of epochs to wait for progress (early stopping) (default=20)')
+    optionalNamedtrain.add_argument('-val_every', '--val_every', type=int, required=False, default=1,
+                                    help='Validate the model every N epochs (and after the last epoch), the early stopping patience is still in epochs (default=1)')
+    optionalNamedtrain.add_argument('-log_timing', '--log_timing', type=str_to_bool, required=False, default=False,
+                                    help='Append the training throughput and the time of each training phase per epoch to timings_<model>.jsonl in the model directory (default=False)')
     optionalNamedtrain.add_argument('-sv_mod', '--save_full_model', type=bool, required=False, default=False,
                                     help='Saving the whole model instead of weights alone (default=False)')
     optionalNamedtrain.add_argument('-cp_type', '--cp_save_type', type=str, required=False, default='last',
                                     help='Checkpoint saving options: best, last, everyN (default=last)')
     optionalNamedtrain.add_argument('-cp_n', '--cp_everyn_N', type=int, required=False, default=10,
                                     help='If -cp_type=everyN, the N value (default=10)')
+    optionalNamedtrain.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                    help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedtrain.add_argument('-compile', '--compile_model', type=str_to_bool, required=False, default=False,
+                                    help='Compile the models with torch.compile (inductor backend), the compile cache is reused across runs (default=False)')
+    optionalNamedtrain.add_argument('-nw', '--num_workers', type=int, required=False, default=4,
+                                    help='No. of DataLoader worker processes loading the training and validation patches (default=4)')
+    optionalNamedtrain.add_argument('-pin', '--pin_memory', type=str_to_bool, required=False, default=True,
+                                    help='Load the batches into pinned memory for asynchronous copies to the GPU (default=True)')
+    optionalNamedtrain.add_argument('-pw', '--persistent_workers', type=str_to_bool, required=False, default=True,
+                                    help='Keep the DataLoader workers alive across epochs (default=True)')
+    optionalNamedtrain.add_argument('-prefetch', '--prefetch_factor', type=int, required=False, default=2,
+                                    help='No. of batches loaded in advance by each DataLoader worker (default=2)')
+    optionalNamedtrain.add_argument('-act_ckpt', '--activation_checkpointing', type=str_to_bool, required=False, default=False,
+                                    help='Recompute the activations of the model blocks in the backward pass instead of storing them, to train larger batches in the same memory (default=False)')
+    optionalNamedtrain.add_argument('-cdet_width', '--cdet_init_channels', type=int, required=False, default=64,
+                                    help='No. of channels in the first layer of the CDet model (default=64)')
+    optionalNamedtrain.add_argument('-cdet_depth', '--cdet_depth', type=int, required=False, default=2,
+                                    help='No. of downsampling levels of the CDet model (default=2)')
+    optionalNamedtrain.add_argument('-cdet_teacher', '--cdet_teacher_model', type=str, required=False, default=None,
+                                    help='Path to a trained CDet model (with the basename) to distil into the CDet model being trained (default=None)')
     optionalNamedtrain.add_argument('-v', '--verbose', type=bool, required=False, default=False,
                                     help='Display debug messages (default=False)')
     optionalNamedtrain.add_argument('-mgpu', '--multi_gpu', type=bool, required=False, default=False,
-                                    help='Enable use of multiple GPUs for training (default=False)')
+                                    help='Data-parallel training over the processes launched with torchrun, on GPUs (NCCL) or CPUs (gloo) (default=False)')
 
     parser_train.set_defaults(func=commands.train)
 
@@ -118,11 +156,116 @@ def main():
                                        help='Checkpoint to be loaded. Options: best, last, specific (default = last)')
     optionalNamedevaluate.add_argument('-cp_n', '--cp_everyn_N', type=int, required=False, default=None,
                                        help='If -cp_type=specific, the N value (default=10)')
+    optionalNamedevaluate.add_argument('-variant', '--model_variant', type=str, required=False, default='eager',
+                                       help='Model to be loaded. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize) (default=eager)')
+    optionalNamedevaluate.add_argument('-cdisc', '--cdisc_model', type=str, required=False, default='student',
+                                       help='Candidate discrimination model. Options: student, shared (head on the CDet encoder features, eager only) (default=student)')
+    optionalNamedevaluate.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                       help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedevaluate.add_argument('-compile', '--compile_model', type=str_to_bool, required=False, default=False,
+                                       help='Compile the models with torch.compile (inductor backend), the compile cache is reused across runs (default=False)')
+    optionalNamedevaluate.add_argument('-j', '--jobs', type=int, required=False, default=1,
+                                       help='Number of subjects evaluated in parallel worker processes on the CPU (default=1)')
+    optionalNamedevaluate.add_argument('-tpj', '--threads_per_job', type=int, required=False, default=None,
+                                       help='Number of torch threads used by each job (default=number of cores / jobs)')
     optionalNamedevaluate.add_argument('-v', '--verbose', type=bool, required=False, default=False,
                                        help='Display debug messages (default=False)')
     
     parser_evaluate.set_defaults(func=commands.evaluate)
 
+    parser_export = subparsers.add_parser('export', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                          description=desc_msgs['export'], epilog=epilog_msgs['subparsers'])
+    requiredNamedexport = parser_export.add_argument_group('Required named arguments')
+    requiredNamedexport.add_argument('-m', '--model_name', type=str, required=True,
+                                     help='Model basename with absolute path (use pre for the standard pre-trained model)')
+    optionalNamedexport = parser_export.add_argument_group('Optional named arguments')
+    optionalNamedexport.add_argument('-o', '--output_dir', type=str, required=False, default=None,
+                                     help='Directory for saving the exported models (default=model directory)')
+    optionalNamedexport.add_argument('-v', '--verbose', type=str_to_bool, required=False, default=False,
+                                     help='Display debug messages (default=False)')
+
+    parser_export.set_defaults(func=commands.export)
+
+    parser_quantize = subparsers.add_parser('quantize', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                            description=desc_msgs['quantize'], epilog=epilog_msgs['subparsers'])
+    requiredNamedquantize = parser_quantize.add_argument_group('Required named arguments')
+    requiredNamedquantize.add_argument('-i', '--inp_dir', type=str, required=True,
+                                       help='Input directory containing preprocessed calibration images')
+    requiredNamedquantize.add_argument('-m', '--model_name', type=str, required=True,
+                                       help='Model basename with absolute path (use pre for the standard pre-trained model)')
+    optionalNamedquantize = parser_quantize.add_argument_group('Optional named arguments')
+    optionalNamedquantize.add_argument('-o', '--output_dir', type=str, required=False, default=None,
+                                       help='Directory for saving the quantized models (default=model directory)')
+    optionalNamedquantize.add_argument('-ncal', '--num_calibration_patches', type=int, required=False, default=256,
+                                       help='Maximum number of patches used to calibrate each model (default=256)')
+    optionalNamedquantize.add_argument('-v', '--verbose', type=str_to_bool, required=False, default=False,
+                                       help='Display debug messages (default=False)')
+
+    parser_quantize.set_defaults(func=commands.quantize)
+
+    parser_prune = subparsers.add_parser('prune', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                         description=desc_msgs['prune'], epilog=epilog_msgs['subparsers'])
+    requiredNamedprune = parser_prune.add_argument_group('Required named arguments')
+    requiredNamedprune.add_argument('-i', '--inp_dir', type=str, required=True,
+                                    help='Input directory containing preprocessed images and labels for fine-tuning')
+    requiredNamedprune.add_argument('-m', '--model_name', type=str, required=True,
+                                    help='Model basename with absolute path (use pre for the standard pre-trained model)')
+    requiredNamedprune.add_argument('-o', '--output_dir', type=str, required=True,
+                                    help='Directory for saving the pruned models (must be different from the model directory)')
+    optionalNamedprune = parser_prune.add_argument_group('Optional named arguments')
+    optionalNamedprune.add_argument('-keep', '--keep_ratio', type=float, required=False, default=0.5,
+                                    help='Proportion of the channels kept in each block (default=0.5)')
+    optionalNamedprune.add_argument('-ft', '--finetune', type=str_to_bool, required=False, default=True,
+                                    help='Fine-tune the pruned models (default=True)')
+    optionalNamedprune.add_argument('-ilr', '--init_learng_rate', type=float, required=False, default=0.0001,
+                                    help='Learning rate for fine-tuning (default=0.0001)')
+    optionalNamedprune.add_argument('-bs', '--batch_size', type=int, required=False, default=8,
+                                    help='Batch size (default=8)')
+    optionalNamedprune.add_argument('-ep', '--num_epochs', type=int, required=False, default=5,
+                                    help='Number of fine-tuning epochs (default=5)')
+    optionalNamedprune.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                    help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedprune.add_argument('-v', '--verbose', type=str_to_bool, required=False, default=False,
+                                    help='Display debug messages (default=False)')
+
+    parser_prune.set_defaults(func=commands.prune)
+
+    parser_benchmark = subparsers.add_parser('benchmark', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                             description=desc_msgs['benchmark'], epilog=epilog_msgs['subparsers'])
+    requiredNamedbenchmark = parser_benchmark.add_argument_group('Required named arguments')
+    requiredNamedbenchmark.add_argument('-m', '--model_name', type=str, required=True,
+                                        help='Model basename with absolute path (use pre for the standard pre-trained model)')
+    optionalNamedbenchmark = parser_benchmark.add_argument_group('Optional named arguments')
+    optionalNamedbenchmark.add_argument('-bs', '--batch_size', type=int, required=False, default=1,
+                                        help='Number of patches per pass (default=1)')
+    optionalNamedbenchmark.add_argument('-n', '--num_repeats', type=int, required=False, default=10,
+                                        help='Number of timed passes (default=10)')
+    optionalNamedbenchmark.add_argument('-train', '--training', type=str_to_bool, required=False, default=False,
+                                        help='Also benchmark training steps (default=False)')
+    optionalNamedbenchmark.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                        help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedbenchmark.add_argument('-v', '--verbose', type=str_to_bool, required=False, default=False,
+                                        help='Display debug messages (default=False)')
+
+    parser_benchmark.set_defaults(func=commands.benchmark)
+
+    parser_compare = subparsers.add_parser('compare', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                           description=desc_msgs['compare'], epilog=epilog_msgs['subparsers'])
+    requiredNamedcompare = parser_compare.add_argument_group('Required named arguments')
+    requiredNamedcompare.add_argument('-i', '--inp_dir', type=str, required=True,
+                                      help='Input directory containing preprocessed images')
+    requiredNamedcompare.add_argument('-m', '--model_name', type=str, required=True,
+                                      help='Model basename with absolute path (use pre for the standard pre-trained model)')
+    optionalNamedcompare = parser_compare.add_argument_group('Optional named arguments')
+    optionalNamedcompare.add_argument('-variant', '--model_variant', type=str, required=False, default='eager',
+                                      help='Model to be compared with the float32 eager model. Options: eager, scripted, int8 (default=eager)')
+    optionalNamedcompare.add_argument('-precision', '--precision', type=str, required=False, default='bfloat16',
+                                      help='Autocast precision of the compared model. Options: float32, bfloat16, float16 (GPU only) (default=bfloat16)')
+    optionalNamedcompare.add_argument('-v', '--verbose', type=str_to_bool, required=False, default=False,
+                                      help='Display debug messages (default=False)')
+
+    parser_compare.set_defaults(func=commands.compare)
+
     parser_finetune = subparsers.add_parser('fine_tune', formatter_class=argparse.RawDescriptionHelpFormatter,
                                             description=desc_msgs['fine_tune'], epilog=epilog_msgs['subparsers'])
     requiredNamedft = parser_finetune.add_argument_group('Required named arguments')
@@ -145,8 +288,8 @@ def main():
                                  help='Layers to fine-tune starting from the decoder (default=1 2)')
     optionalNamedft.add_argument('-tr_prop', '--train_prop', type=float, required=False, default=0.8,
                                  help='Proportion of data used for training (default = 0.8)')
-    optionalNamedft.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=10,
-                                 help='No. of subjects considered for each mini-epoch (default = 10)')
+    optionalNamedft.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=1,
+                                 help='No. of batches accumulated for each optimiser step (default = 1)')
     optionalNamedft.add_argument('-psize', '--patch_size', type=int, required=False, default=48,
                                  help='Size of patches extracted for candidate detection (default = 48)')
     optionalNamedft.add_argument('-cand_det', '--cand_detection', type=bool, required=False, default=True,
@@ -177,12 +320,32 @@ def main():
                                  help='Number of epochs (default=60)')
     optionalNamedft.add_argument('-es', '--early_stop_val', type=int, required=False, default=20,
                                  help='No. of epochs to wait for progress (early stopping) (default=20)')
+    optionalNamedft.add_argument('-val_every', '--val_every', type=int, required=False, default=1,
+                                 help='Validate the model every N epochs (and after the last epoch), the early stopping patience is still in epochs (default=1)')
+    optionalNamedft.add_argument('-log_timing', '--log_timing', type=str_to_bool, required=False, default=False,
+                                 help='Append the training throughput and the time of each training phase per epoch to timings_<model>.jsonl in the model directory (default=False)')
+    optionalNamedft.add_argument('-cache_frozen', '--cache_frozen_features', type=str_to_bool, required=False, default=False,
+                                 help='Run the frozen layers of the CDisc student model once on the training patches, and only the fine-tuned layers at every epoch (default=False)')
     optionalNamedft.add_argument('-sv_mod', '--save_full_model', type=bool, required=False, default=False,
                                  help='Saving the whole model instead of weights alone (default=False)')
     optionalNamedft.add_argument('-cp_type', '--cp_save_type', type=str, required=False, default='last',
                                  help='Checkpoint saving options: best, last, everyN (default=last)')
     optionalNamedft.add_argument('-cp_n', '--cp_everyn_N', type=int, required=False, default=10,
                                  help='If -cp_type=everyN, the N value')
+    optionalNamedft.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                 help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedft.add_argument('-compile', '--compile_model', type=str_to_bool, required=False, default=False,
+                                 help='Compile the models with torch.compile (inductor backend), the compile cache is reused across runs (default=False)')
+    optionalNamedft.add_argument('-nw', '--num_workers', type=int, required=False, default=4,
+                                 help='No. of DataLoader worker processes loading the training and validation patches (default=4)')
+    optionalNamedft.add_argument('-pin', '--pin_memory', type=str_to_bool, required=False, default=True,
+                                 help='Load the batches into pinned memory for asynchronous copies to the GPU (default=True)')
+    optionalNamedft.add_argument('-pw', '--persistent_workers', type=str_to_bool, required=False, default=True,
+                                 help='Keep the DataLoader workers alive across epochs (default=True)')
+    optionalNamedft.add_argument('-prefetch', '--prefetch_factor', type=int, required=False, default=2,
+                                 help='No. of batches loaded in advance by each DataLoader worker (default=2)')
+    optionalNamedft.add_argument('-act_ckpt', '--activation_checkpointing', type=str_to_bool, required=False, default=False,
+                                 help='Recompute the activations of the model blocks in the backward pass instead of storing them, to train larger batches in the same memory (default=False)')
     optionalNamedft.add_argument('-v', '--verbose', type=bool, required=False, default=False,
                                  help='Display debug messages (default=False)')
     
@@ -202,10 +365,12 @@ def main():
                                  help='Number of folds for cross-validation (default = 5)')
     optionalNamedcv.add_argument('-resume_fold', '--resume_from_fold', type=int, required=False, default=1,
                                  help='Resume cross-validation from the specified fold (default = 1)')
+    optionalNamedcv.add_argument('-pf', '--parallel_folds', type=int, required=False, default=1,
+                                 help='No. of folds trained at the same time in separate processes, sharing the CPU threads (default = 1)')
     optionalNamedcv.add_argument('-tr_prop', '--train_prop', type=float, required=False, default=0.8,
                                  help='Proportion of data used for training (default = 0.8)')
-    optionalNamedcv.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=10,
-                                 help='No. of subjects considered for each mini-epoch (default = 10)')
+    optionalNamedcv.add_argument('-bfactor', '--batch_factor', type=int, required=False, default=1,
+                                 help='No. of batches accumulated for each optimiser step (default = 1)')
     optionalNamedcv.add_argument('-psize', '--patch_size', type=int, required=False, default=48,
                                  help='Size of patches extracted for candidate detection (default = 48)')
     optionalNamedcv.add_argument('-da', '--data_augmentation', type=bool, required=False, default=True,
@@ -232,6 +397,10 @@ def main():
                                  help='Number of epochs (default=60)')
     optionalNamedcv.add_argument('-es', '--early_stop_val', type=int, required=False, default=20,
                                  help='No. of epochs to wait for progress (early stopping) (default=20)')
+    optionalNamedcv.add_argument('-val_every', '--val_every', type=int, required=False, default=1,
+                                 help='Validate the model every N epochs (and after the last epoch), the early stopping patience is still in epochs (default=1)')
+    optionalNamedcv.add_argument('-log_timing', '--log_timing', type=str_to_bool, required=False, default=False,
+                                 help='Append the training throughput and the time of each training phase per epoch to timings_<model>.jsonl in the model directory (default=False)')
     optionalNamedcv.add_argument('-int', '--intermediate', type=bool, required=False, default=False,
                                  help='Saving intermediate prediction results for each subject (default=False)')
     optionalNamedcv.add_argument('-sv', '--save_checkpoint', type=bool, required=False, default=False,
@@ -242,6 +411,24 @@ def main():
                                  help='Checkpoint saving options: best, last, everyN (default=last)')
     optionalNamedcv.add_argument('-cp_n', '--cp_everyn_N', type=int, required=False, default=10,
                                  help='If -cp_type=everyN, the N value')
+    optionalNamedcv.add_argument('-precision', '--precision', type=str, required=False, default='float32',
+                                 help='Autocast precision. Options: float32, bfloat16, float16 (GPU only) (default=float32)')
+    optionalNamedcv.add_argument('-compile', '--compile_model', type=str_to_bool, required=False, default=False,
+                                 help='Compile the models with torch.compile (inductor backend), the compile cache is reused across runs (default=False)')
+    optionalNamedcv.add_argument('-nw', '--num_workers', type=int, required=False, default=4,
+                                 help='No. of DataLoader worker processes loading the training and validation patches (default=4)')
+    optionalNamedcv.add_argument('-pin', '--pin_memory', type=str_to_bool, required=False, default=True,
+                                 help='Load the batches into pinned memory for asynchronous copies to the GPU (default=True)')
+    optionalNamedcv.add_argument('-pw', '--persistent_workers', type=str_to_bool, required=False, default=True,
+                                 help='Keep the DataLoader workers alive across epochs (default=True)')
+    optionalNamedcv.add_argument('-prefetch', '--prefetch_factor', type=int, required=False, default=2,
+                                 help='No. of batches loaded in advance by each DataLoader worker (default=2)')
+    optionalNamedcv.add_argument('-act_ckpt', '--activation_checkpointing', type=str_to_bool, required=False, default=False,
+                                 help='Recompute the activations of the model blocks in the backward pass instead of storing them, to train larger batches in the same memory (default=False)')
+    optionalNamedcv.add_argument('-cdet_width', '--cdet_init_channels', type=int, required=False, default=64,
+                                 help='No. of channels in the first layer of the CDet model (default=64)')
+    optionalNamedcv.add_argument('-cdet_depth', '--cdet_depth', type=int, required=False, default=2,
+                                 help='No. of downsampling levels of the CDet model (default=2)')
     optionalNamedcv.add_argument('-v', '--verbose', type=bool, required=False, default=False,
                                  help='Display debug messages (default=False)')
     
@@ -255,6 +442,16 @@ def main():
         commands.train(args)
     elif args.command == 'evaluate':
         commands.evaluate(args)
+    elif args.command == 'export':
+        commands.export(args)
+    elif args.command == 'quantize':
+        commands.quantize(args)
+    elif args.command == 'prune':
+        commands.prune(args)
+    elif args.command == 'compare':
+        commands.compare(args)
+    elif args.command == 'benchmark':
+        commands.benchmark(args)
     elif args.command == 'fine_tune':
         commands.fine_tune(args)
     elif args.command == 'cross_validate':
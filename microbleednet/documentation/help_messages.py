@@ -17,6 +17,11 @@ def help_descs():
         "       microbleednet preprocess      Preprocess data for a MicroBleed-Net model\n"
         "       microbleednet train           Training a MicroBleed-Net model from scratch\n"
         "       microbleednet evaluate        Applying a saved/pretrained MicroBleed-Net model for testing\n"
+        "       microbleednet export          Exporting a saved/pretrained MicroBleed-Net model for deployment\n"
+        "       microbleednet quantize        Int8 quantization of a saved/pretrained MicroBleed-Net model for CPU inference\n"
+        "       microbleednet prune           Channel pruning and fine-tuning of a saved/pretrained MicroBleed-Net model\n"
+        "       microbleednet compare         Comparing a reduced precision/quantized MicroBleed-Net model with the float32 model\n"
+        "       microbleednet benchmark       Timing the eager and compiled (torch.compile) MicroBleed-Net models\n"
         "       microbleednet fine_tune       Fine-tuning a saved/pretrained MicroBleed-Net model\n"
         "       microbleednet cross_validate  Cross-validation of MicroBleed-Net model\n"
         "   \n"
@@ -54,7 +59,7 @@ def help_descs():
         '   \n'
         'Optional arguments:\n'
         '       -tr_prop, --train_prop        Proportion of data used for training [0, 1]. The rest will be used for validation [default = 0.8]\n'
-        '       -bfactor, --batch_factor      Number of subjects to be considered for each mini-epoch [default = 10]\n'
+        '       -bfactor, --batch_factor      Number of batches accumulated for each optimiser step [default = 1]\n'
         '       -loss, --loss_function        Applying spatial weights to loss function. Options: weighted, nweighted [default=weighted]\n'
         '       -gdir, --gmdist_dir           Directory containing GM distance map images. Required if -loss=weighted [default = None]\n'
         '       -vdir, --ventdist_dir         Directory containing ventricle distance map images. Required if -loss=weighted [default = None]\n'
@@ -68,11 +73,24 @@ def help_descs():
         '       -bs, --batch_size             Batch size used for training [default = 8]\n'
         '       -ep, --num_epochs             Number of epochs for training [default = 60]\n'
         '       -es, --early_stop_val         Number of epochs to wait for progress (early stopping) [default = 20]\n'
+        '       -val_every, --val_every       Validate the model every N epochs (and after the last epoch) [default = 1]\n'
+        '       -log_timing, --log_timing     Write the training throughput and phase times of each epoch to timings_<model>.jsonl [default = False]\n'
         '       -sv_mod, --save_full_model    Saving the whole model instead of weights alone [default = False]\n'
         '       -cv_type, --cp_save_type      Checkpoint to be saved. Options: best, last, everyN [default = last]\n'
         '       -cp_n, --cp_everyn_N          If -cv_type=everyN, the N value [default = 10]\n'
         '       -da, --data_augmentation      Applying data augmentation [default = True]\n'
         '       -af, --aug_factor             Data inflation factor for augmentation [default = 2]\n'
+        '       -precision, --precision       Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
+        '       -compile, --compile_model     Compile the models with torch.compile (inductor backend) [default = False]\n'
+        '       -nw, --num_workers            No. of DataLoader worker processes loading the training and validation patches [default = 4]\n'
+        '       -pin, --pin_memory            Load the batches into pinned memory for asynchronous copies to the GPU [default = True]\n'
+        '       -pw, --persistent_workers     Keep the DataLoader workers alive across epochs [default = True]\n'
+        '       -prefetch, --prefetch_factor  No. of batches loaded in advance by each DataLoader worker [default = 2]\n'
+        '       -act_ckpt, --activation_checkpointing  Recompute the activations of the model blocks in the backward pass instead of storing them [default = False]\n'
+        '       -cdet_width, --cdet_init_channels    No. of channels in the first layer of the CDet model [default = 64]\n'
+        '       -cdet_depth, --cdet_depth     No. of downsampling levels of the CDet model [default = 2]\n'
+        '       -cdet_teacher, --cdet_teacher_model  Trained CDet model basename with absolute path, distilled into the CDet model being trained [default = None]\n'
+        '       -mgpu, --multi_gpu            Data-parallel training over the processes launched with torchrun, on GPUs (NCCL) or CPUs (gloo) [default = False]\n'
         '       -v, --verbose                 Display debug messages [default = False]\n'
         '   \n',
 
@@ -93,6 +111,91 @@ def help_descs():
         '       -int, --intermediate                  Saving intermediate prediction results (individual planes) for each subject [default = False]\n'
         '       -cv_type, --cp_load_type              Checkpoint to be loaded. Options: best, last, everyN [default = last]\n'
         '       -cp_n, --cp_everyn_N                  If -cv_type = everyN, the N value [default = 10]\n'
+        '       -variant, --model_variant             Model to be loaded. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize) [default = eager]\n'
+        '       -cdisc, --cdisc_model                 Candidate discrimination model. Options: student, shared (head on the CDet encoder features, eager only) [default = student]\n'
+        '       -precision, --precision               Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
+        '       -compile, --compile_model             Compile the models with torch.compile (inductor backend) [default = False]\n'
+        '       -j, --jobs                            Number of subjects evaluated in parallel worker processes on the CPU [default = 1]\n'
+        '       -tpj, --threads_per_job               Number of torch threads used by each job [default = number of cores / jobs]\n'
+        '       -v, --verbose                         Display debug messages [default = False]\n'
+        '   \n',
+
+        'export' :
+        'microbleednet export: exporting the MicroBleed-Net model for deployment, v' + str(v) + '\n'
+        '   \n'
+        'Usage: microbleednet export -m <model_name> [options]\n'
+        '   \n'
+        'Compulsory arguments:\n'
+        '       -m, --model_name                      Model basename with absolute path (use pre for the standard pre-trained model)\n'
+        '   \n'
+        'Optional arguments:\n'
+        '       -o, --output_dir                      Path to the directory for saving the exported models [default = model directory]\n'
+        '       -v, --verbose                         Display debug messages [default = False]\n'
+        '   \n',
+
+        'quantize' :
+        'microbleednet quantize: int8 quantization of the MicroBleed-Net model for CPU inference, v' + str(v) + '\n'
+        '   \n'
+        'Usage: microbleednet quantize -i <input_directory> -m <model_name> [options]\n'
+        '   \n'
+        'Compulsory arguments:\n'
+        '       -i, --inp_dir                         Path to the directory containing preprocessed images for calibration\n'
+        '       -m, --model_name                      Model basename with absolute path (use pre for the standard pre-trained model)\n'
+        '   \n'
+        'Optional arguments:\n'
+        '       -o, --output_dir                      Path to the directory for saving the quantized models [default = model directory]\n'
+        '       -ncal, --num_calibration_patches      Maximum number of patches used to calibrate each model [default = 256]\n'
+        '       -v, --verbose                         Display debug messages [default = False]\n'
+        '   \n',
+
+        'prune' :
+        'microbleednet prune: channel pruning of the MicroBleed-Net model for CPU inference, v' + str(v) + '\n'
+        '   \n'
+        'Usage: microbleednet prune -i <input_directory> -m <model_name> -o <output_directory> [options]\n'
+        '   \n'
+        'Compulsory arguments:\n'
+        '       -i, --inp_dir                         Path to the directory containing preprocessed images and labels for fine-tuning\n'
+        '       -m, --model_name                      Model basename with absolute path (use pre for the standard pre-trained model)\n'
+        '       -o, --output_dir                      Path to the directory for saving the pruned models (different from the model directory)\n'
+        '   \n'
+        'Optional arguments:\n'
+        '       -keep, --keep_ratio                   Proportion of the channels kept in each block [default = 0.5]\n'
+        '       -ft, --finetune                       Fine-tune the pruned models [default = True]\n'
+        '       -ilr, --init_learng_rate              Learning rate for fine-tuning [default = 0.0001]\n'
+        '       -bs, --batch_size                     Batch size [default = 8]\n'
+        '       -ep, --num_epochs                     Number of fine-tuning epochs [default = 5]\n'
+        '       -precision, --precision               Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
+        '       -v, --verbose                         Display debug messages [default = False]\n'
+        '   \n',
+
+        'compare' :
+        'microbleednet compare: comparing a MicroBleed-Net model variant with the float32 model, v' + str(v) + '\n'
+        '   \n'
+        'Usage: microbleednet compare -i <input_directory> -m <model_name> [options]\n'
+        '   \n'
+        'Compulsory arguments:\n'
+        '       -i, --inp_dir                         Path to the directory containing preprocessed images\n'
+        '       -m, --model_name                      Model basename with absolute path (use pre for the standard pre-trained model)\n'
+        '   \n'
+        'Optional arguments:\n'
+        '       -variant, --model_variant             Model to be compared with the float32 eager model. Options: eager, scripted, int8 [default = eager]\n'
+        '       -precision, --precision               Autocast precision of the compared model. Options: float32, bfloat16, float16 (GPU only) [default = bfloat16]\n'
+        '       -v, --verbose                         Display debug messages [default = False]\n'
+        '   \n',
+
+        'benchmark' :
+        'microbleednet benchmark: timing the eager and compiled MicroBleed-Net models, v' + str(v) + '\n'
+        '   \n'
+        'Usage: microbleednet benchmark -m <model_name> [options]\n'
+        '   \n'
+        'Compulsory arguments:\n'
+        '       -m, --model_name                      Model basename with absolute path (use pre for the standard pre-trained model)\n'
+        '   \n'
+        'Optional arguments:\n'
+        '       -bs, --batch_size                     Number of patches per pass [default = 1]\n'
+        '       -n, --num_repeats                     Number of timed passes [default = 10]\n'
+        '       -train, --training                    Also benchmark training steps [default = False]\n'
+        '       -precision, --precision               Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
         '       -v, --verbose                         Display debug messages [default = False]\n'
         '   \n',
 
@@ -114,7 +217,7 @@ def help_descs():
         '       -cpld_n, --cpload_everyn_N            If everyN option was chosen for loading a checkpoint, the N value [default = 10]\n'
         '       -ftlayers, --ft_layers                Layers to fine-tune starting from the decoder (e.g. 1 2 -> final two two decoder layers)\n'
         '       -tr_prop, --train_prop                Proportion of data used for fine-tuning [0, 1]. The rest will be used for validation [default = 0.8]\n'
-        '       -bfactor, --batch_factor              Number of subjects to be considered for each mini-epoch [default = 10]\n'
+        '       -bfactor, --batch_factor              Number of batches accumulated for each optimiser step [default = 1]\n'
         '       -loss, --loss_function                Applying spatial weights to loss function. Options: weighted, nweighted [default=weighted]\n'
         '       -gdir, --gmdist_dir                   Directory containing GM distance map images. Required if -loss = weighted [default = None]\n'
         '       -vdir, --ventdist_dir                 Directory containing ventricle distance map images. Required if -loss = weighted [default = None]\n'
@@ -128,11 +231,21 @@ def help_descs():
         '       -bs, --batch_size                     Batch size used for fine-tuning [default = 8]\n'
         '       -ep, --num_epochs                     Number of epochs for fine-tuning [default = 60]\n'
         '       -es, --early_stop_val                 Number of fine-tuning epochs to wait for progress (early stopping) [default = 20]\n'
+        '       -val_every, --val_every               Validate the model every N epochs (and after the last epoch) [default = 1]\n'
+        '       -log_timing, --log_timing             Write the training throughput and phase times of each epoch to timings_<model>.jsonl [default = False]\n'
+        '       -cache_frozen, --cache_frozen_features  Run the frozen CDisc student layers once on the training patches, and only the fine-tuned layers at every epoch [default = False]\n'
         '       -sv_mod, --save_full_model            Saving the whole fine-tuned model instead of weights alone [default = False]\n'
         '       -cv_type, --cp_save_type              Checkpoint to be saved. Options: best, last, everyN [default = last]\n'
         '       -cp_n, --cp_everyn_N                  If -cv_type = everyN, the N value [default = 10]\n'
         '       -da, --data_augmentation              Applying data augmentation [default = True]\n'
         '       -af, --aug_factor                     Data inflation factor for augmentation [default = 2]\n'
+        '       -precision, --precision               Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
+        '       -compile, --compile_model             Compile the models with torch.compile (inductor backend) [default = False]\n'
+        '       -nw, --num_workers                    No. of DataLoader worker processes loading the training and validation patches [default = 4]\n'
+        '       -pin, --pin_memory                    Load the batches into pinned memory for asynchronous copies to the GPU [default = True]\n'
+        '       -pw, --persistent_workers             Keep the DataLoader workers alive across epochs [default = True]\n'
+        '       -prefetch, --prefetch_factor          No. of batches loaded in advance by each DataLoader worker [default = 2]\n'
+        '       -act_ckpt, --activation_checkpointing  Recompute the activations of the model blocks in the backward pass instead of storing them [default = False]\n'
         '       -v, --verbose                         Display debug messages [default = False]\n'
         '   \n',
 
@@ -147,8 +260,9 @@ def help_descs():
         '       -o, --output_dir                      Path to the directory for saving output predictions\n'
         '   \n'
         'Optional arguments:\n'
+        '       -pf, --parallel_folds                 No. of folds trained at the same time in separate processes, sharing the CPU threads [default = 1]\n'
         '       -tr_prop, --train_prop                Proportion of data used for training [0, 1]. The rest will be used for validation [default = 0.8]\n'
-        '       -bfactor, --batch_factor              Number of subjects to be considered for each mini-epoch [default = 10]\n'
+        '       -bfactor, --batch_factor              Number of batches accumulated for each optimiser step [default = 1]\n'
         '       -loss, --loss_function                Applying spatial weights to loss function. Options: weighted, nweighted [default=weighted]\n'
         '       -gdir, --gmdist_dir                   Directory containing GM distance map images. Required if -loss = weighted [default = None]\n'
         '       -vdir, --ventdist_dir                 Directory containing ventricle distance map images. Required if -loss = weighted [default = None]\n'
@@ -162,9 +276,20 @@ def help_descs():
         '       -bs, --batch_size                     Batch size used for fine-tuning [default = 8]\n'
         '       -ep, --num_epochs                     Number of epochs for fine-tuning [default = 60]\n'
         '       -es, --early_stop_val                 Number of fine-tuning epochs to wait for progress (early stopping) [default = 20]\n'
+        '       -val_every, --val_every               Validate the model every N epochs (and after the last epoch) [default = 1]\n'
+        '       -log_timing, --log_timing             Write the training throughput and phase times of each epoch to timings_<model>.jsonl [default = False]\n'
         '       -int, --intermediate                  Saving intermediate prediction results (individual planes) for each subject [default = False]\n'
         '       -da, --data_augmentation              Applying data augmentation [default = True]\n'
         '       -af, --aug_factor                     Data inflation factor for augmentation [default = 2]\n'
+        '       -precision, --precision               Autocast precision. Options: float32, bfloat16, float16 (GPU only) [default = float32]\n'
+        '       -compile, --compile_model             Compile the models with torch.compile (inductor backend) [default = False]\n'
+        '       -nw, --num_workers                    No. of DataLoader worker processes loading the training and validation patches [default = 4]\n'
+        '       -pin, --pin_memory                    Load the batches into pinned memory for asynchronous copies to the GPU [default = True]\n'
+        '       -pw, --persistent_workers             Keep the DataLoader workers alive across epochs [default = True]\n'
+        '       -prefetch, --prefetch_factor          No. of batches loaded in advance by each DataLoader worker [default = 2]\n'
+        '       -act_ckpt, --activation_checkpointing  Recompute the activations of the model blocks in the backward pass instead of storing them [default = False]\n'
+        '       -cdet_width, --cdet_init_channels     No. of channels in the first layer of the CDet model [default = 64]\n'
+        '       -cdet_depth, --cdet_depth             No. of downsampling levels of the CDet model [default = 2]\n'
         '       -v, --verbose                         Display debug messages [default = False]\n'
         '   \n'
     }
@@ -180,6 +305,11 @@ def desc_descs():
         "Sub-commands available:\n"
         "       microbleednet train           Training a MicroBleed-Net model from scratch\n"
         "       microbleednet evaluate        Applying a saved/pretrained MicroBleed-Net model for testing\n"
+        "       microbleednet export          Exporting a saved/pretrained MicroBleed-Net model for deployment\n"
+        "       microbleednet quantize        Int8 quantization of a saved/pretrained MicroBleed-Net model for CPU inference\n"
+        "       microbleednet prune           Channel pruning and fine-tuning of a saved/pretrained MicroBleed-Net model\n"
+        "       microbleednet compare         Comparing a reduced precision/quantized MicroBleed-Net model with the float32 model\n"
+        "       microbleednet benchmark       Timing the eager and compiled (torch.compile) MicroBleed-Net models\n"
         "       microbleednet fine_tune       Fine-tuning a saved/pretrained MicroBleed-Net model \n"
         "       microbleednet cross_validate  Cross-validation of MicroBleed-Net model\n"
         "   \n",
@@ -211,6 +341,53 @@ def desc_descs():
         '\'<subj_name>_T1.nii.gz\'respectively\n'
         '   \n',
 
+        'export':
+        '   \n'
+        'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
+        '   \n'
+        'The \'export\' command folds the BatchNorm layers of a saved/pretrained MicroBleed-Net model into its\n'
+        'convolutions and saves frozen TorchScript models (channels_last_3d) that can be loaded by the\n'
+        '\'evaluate\' command with -variant scripted\n'
+        '   \n',
+
+        'quantize':
+        '   \n'
+        'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
+        '   \n'
+        'The \'quantize\' command applies static int8 quantization to the convolutions and dynamic int8 quantization\n'
+        'to the fully connected layers of a saved/pretrained MicroBleed-Net model, calibrated on the preprocessed\n'
+        'subjects in the input directory. The lesion-level agreement with the float model is reported on the same\n'
+        'subjects. The quantized models can be loaded by the \'evaluate\' command with -variant int8\n'
+        '   \n',
+
+        'prune':
+        '   \n'
+        'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
+        '   \n'
+        'The \'prune\' command removes the channels with the smallest BatchNorm scales between the two convolutions\n'
+        'of every block of the CDet and CDisc student models, reports the parameters, FLOPs and CPU latency before\n'
+        'and after pruning, and fine-tunes the pruned models on the subjects in the input directory. The pruned\n'
+        'models are saved in the output directory with the microbleednet basename\n'
+        '   \n',
+
+        'compare':
+        '   \n'
+        'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
+        '   \n'
+        'The \'compare\' command runs the full pipeline with the float32 eager model and with the selected model\n'
+        'variant/precision on the preprocessed subjects in the input directory, and reports the lesion-level\n'
+        'sensitivity, precision and Dice of the selected model with respect to the float32 model\n'
+        '   \n',
+
+        'benchmark':
+        '   \n'
+        'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
+        '   \n'
+        'The \'benchmark\' command times the CDet (48 x 48 x 48) and CDisc student (24 x 24 x 24) models in eager\n'
+        'mode and compiled with torch.compile, on random patches, and reports the time per batch, the speed-up and\n'
+        'the time of the first pass (which includes the compilation, or loads it from the compile cache)\n'
+        '   \n',
+
         'fine_tune':
         '   \n'
         'microbleednet: Triplanar ensemble U-Net model, v' + str(v) + '\n'
@@ -2,8 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import torch
 import random
 import numpy as np
+import torch.nn.functional as F
 from skimage.util import random_noise
 from scipy.ndimage import rotate, zoom
 from scipy.ndimage.interpolation import shift
@@ -225,3 +227,91 @@ def augment_pair(image, frst, label):
     
     else:
         raise Exception('Invalid dimensions for image augmentation - currently only supported in 3d')
+
+
+def flip_batch(volumes, flip_mask):
+    """
+    Flips the selected volumes along the last spatial axis (as flip_pair)
+    :param volumes: torch.tensor, N x C x H x W x D
+    :param flip_mask: torch.tensor, N booleans
+    :return: torch.tensor, N x C x H x W x D
+    """
+
+    return torch.where(flip_mask[:, None, None, None, None], volumes.flip(-1), volumes)
+
+def translate_batch(volumes, offsets_x, offsets_y, max_offset=5):
+    """
+    Integer in-plane translation of every volume by its own offsets, the regions shifted in are zero
+    :param volumes: torch.tensor, N x C x H x W x D
+    :param offsets_x: torch.tensor, N integer offsets along H
+    :param offsets_y: torch.tensor, N integer offsets along W
+    :param max_offset: int, largest absolute offset
+    :return: torch.tensor, N x C x H x W x D
+    """
+
+    n_volumes, _, height, width, _ = volumes.shape
+    padded_volumes = F.pad(volumes, (0, 0, max_offset, max_offset, max_offset, max_offset))
+
+    rows = torch.arange(height, device=volumes.device)[None, :] + max_offset - offsets_x[:, None]
+    cols = torch.arange(width, device=volumes.device)[None, :] + max_offset - offsets_y[:, None]
+    volume_indices = torch.arange(n_volumes, device=volumes.device)[:, None, None]
+
+    # Advanced indexing on N, H and W gives N x H x W x C x D
+    translated_volumes = padded_volumes[volume_indices, :, rows[:, :, None], cols[:, None, :]]
+
+    return translated_volumes.permute(0, 3, 1, 2, 4)
+
+def add_noise_batch(images, noise_mask, generator=None):
+    """
+    Gaussian noise (variance 0.01) on the selected images, clipped as skimage.util.random_noise (as add_noise_pair)
+    :param images: torch.tensor, N x H x W x D
+    :param noise_mask: torch.tensor, N booleans
+    :param generator: torch.Generator on the device of the images
+    :return: torch.tensor, N x H x W x D
+    """
+
+    noise = torch.randn(images.shape, generator=generator, device=images.device, dtype=images.dtype) * 0.1
+    lower_bounds = torch.where(images.flatten(1).min(dim=1).values < 0, -1.0, 0.0)[:, None, None, None]
+    noisy_images = torch.maximum(torch.clamp(images + noise, max=1.0), lower_bounds)
+
+    return torch.where(noise_mask[:, None, None, None], noisy_images, images)
+
+def augment_batch(data, labels=None, n_augmentations=4, generator=None):
+    """
+    Batched (torch) version of data_preparation.augment_data, run on the collated batch instead of on every sample in the
+    DataLoader workers. Every augmented copy gets a random non-empty subset of flip, translation and noise (image channel
+    only), as augment_pair.
+    :param data: torch.tensor, N x 2 x H x W x D (image and FRST)
+    :param labels: torch.tensor, N x K x H x W x D voxel labels or weights (transformed with the data), or N x K patch labels (copied)
+    :param n_augmentations: int, number of augmented copies of each volume
+    :param generator: torch.Generator on the device of the data, for reproducible augmentations
+    :return: tuple of data and labels, the N original volumes followed by the N x n_augmentations augmented copies
+    """
+
+    device = data.device
+    augmented_data = data.repeat(n_augmentations, *([1] * (data.dim() - 1)))
+    n_volumes = len(augmented_data)
+
+    # Random number (1 to 3) of transformations per copy, and a random subset of that size
+    n_transformations = torch.randint(1, 4, (n_volumes, 1), generator=generator, device=device)
+    transformation_ranks = torch.argsort(torch.rand(n_volumes, 3, generator=generator, device=device), dim=1)
+    flip_mask, translate_mask, noise_mask = (transformation_ranks < n_transformations).unbind(dim=1)
+
+    offsets_x = torch.randint(-5, 6, (n_volumes,), generator=generator, device=device) * translate_mask
+    offsets_y = torch.randint(-5, 6, (n_volumes,), generator=generator, device=device) * translate_mask
+
+    augmented_data = translate_batch(flip_batch(augmented_data, flip_mask), offsets_x, offsets_y)
+    augmented_data = torch.stack([add_noise_batch(augmented_data[:, 0], noise_mask, generator=generator), augmented_data[:, 1]], dim=1)
+
+    augmented_data = torch.cat([data, augmented_data], dim=0)
+
+    if labels is None:
+        return augmented_data, None
+
+    augmented_labels = labels.repeat(n_augmentations, *([1] * (labels.dim() - 1)))
+    if labels.dim() == 5:
+        augmented_labels = translate_batch(flip_batch(augmented_labels, flip_mask), offsets_x, offsets_y)
+
+    augmented_labels = torch.cat([labels, augmented_labels], dim=0)
+
+    return augmented_data, augmented_labels
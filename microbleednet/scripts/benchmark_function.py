@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import time
+import torch
+
+from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
+
+
+def time_model(model, example_input, repeats, device, precision='float32', training=False):
+    """
+    Times the forward (and backward) passes of the model on a fixed-shape batch
+    :param model: model
+    :param example_input: torch.tensor, batch of patches
+    :param repeats: int, number of timed passes after the first one
+    :param device: cpu() or cuda()
+    :param precision: str, autocast precision of the forward passes
+    :param training: bool, time a training step (forward and backward) instead of inference
+    :return: tuple of the first pass time (including compilation) and the mean time of the following passes, in seconds
+    """
+
+    model.train(training)
+    autocast_context = utils.get_autocast_context(device, precision)
+
+    def run_step():
+        if training:
+            with autocast_context:
+                output = model(example_input)
+            # Proxy loss, only the cost of the backward pass is of interest
+            output.float().logsumexp(dim=1).mean().backward()
+        else:
+            with torch.no_grad(), autocast_context:
+                model(example_input)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+    run_step()
+    first_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        run_step()
+    mean_time = (time.perf_counter() - start_time) / repeats
+
+    return first_time, mean_time
+
+
+def main(model_directory, model_name, batch_size=1, repeats=10, precision='float32', training=False, verbose=False):
+    """
+    Benchmarks the eager and compiled (torch.compile) CDet and CDisc student models on their fixed patch shapes
+    :param model_directory: str, directory containing the trained models
+    :param model_name: str, basename of the trained models
+    :param batch_size: int, number of patches per pass
+    :param repeats: int, number of timed passes
+    :param precision: str, autocast precision of the forward passes
+    :param training: bool, also benchmark training steps
+    :param verbose: bool, display debug messages
+    :return: dictionary of model: phase: mode: (first pass time, mean pass time)
+    """
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    cdet_model = model_registry.load_model(model_directory, model_name, 'cdet')
+    cdisc_student_model = model_registry.load_model(model_directory, model_name, 'cdisc_student')
+
+    # Patch sizes used by the training and evaluation functions
+    benchmarks = [
+        ('cdet', cdet_model, torch.rand(batch_size, 2, 48, 48, 48, device=device)),
+        ('cdisc_student', cdisc_student_model, torch.rand(batch_size, 2, 24, 24, 24, device=device)),
+    ]
+    phases = ['inference', 'training'] if training else ['inference']
+
+    results = {}
+
+    for model_key, model, example_input in benchmarks:
+
+        results[model_key] = {phase: {} for phase in phases}
+
+        for mode in ['eager', 'compiled']:
+
+            benchmark_model = copy.deepcopy(model).to(device)
+            if mode == 'compiled':
+                benchmark_model = utils.compile_model(benchmark_model)
+
+            for phase in phases:
+                if verbose:
+                    print(f'Benchmarking {model_key} {phase} ({mode})')
+
+                results[model_key][phase][mode] = time_model(benchmark_model, example_input, repeats, device, precision=precision, training=(phase == 'training'))
+
+        for phase in phases:
+            eager_first_time, eager_time = results[model_key][phase]['eager']
+            compiled_first_time, compiled_time = results[model_key][phase]['compiled']
+            print(f'{model_key} {phase}: eager {eager_time * 1e3:.1f} ms, compiled {compiled_time * 1e3:.1f} ms per batch of {batch_size} '
+                  f'(speed-up x{eager_time / compiled_time:.2f}), first pass eager {eager_first_time:.2f} s, compiled {compiled_first_time:.2f} s')
+
+    return results
@@ -10,9 +10,9 @@ import torch.nn as nn
 from tqdm import tqdm
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 
 from microbleednet.scripts import data_preparation
-from microbleednet.scripts import model_architectures as models
 
 ########################################
 # Microbleednet main training function #
@@ -20,7 +20,27 @@ from microbleednet.scripts import model_architectures as models
 # 09-01-2023                           #
 ########################################
 
-def main(subjects, verbose=True, model_directory=None, model_name='microbleednet'):
+def load_cdet_model(model_directory, model_name='microbleednet', model_variant='eager', device=None):
+    """
+    Loads the CDet model used for evaluation
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param model_variant: str, model to load. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize)
+    :param device: cpu() or cuda()
+    :return: model
+    """
+
+    if model_variant in ['scripted', 'int8']:
+        model_path = os.path.join(model_directory, f'{model_name}_cdet_model_{model_variant}.pt')
+        model = utils.load_exported_model(model_path, device)
+
+    else:
+        # Load candidate detection model, built with the width and depth of the checkpoint
+        model = model_registry.load_model(model_directory, model_name, 'cdet', device)
+
+    return model
+
+def main(subjects, verbose=True, model_directory=None, model_name='microbleednet', model_variant='eager', precision='float32', model=None, return_features=False):
     
     """
     The main evaluation function
@@ -32,6 +52,10 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
     :param save_case: str, condition for saving the checkpoint
     :param verbose: bool, display debug messages
     :param checkpoint_directory: str, directory for saving model/weights
+    :param model_variant: str, model to load. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize)
+    :param precision: str, autocast precision of the forward passes. Options: float32, bfloat16, float16 (GPU only)
+    :param model: already loaded model (see load_cdet_model), if None the model is loaded from model_directory
+    :param return_features: bool, also store the down2 encoder feature maps of the subject in subject['cdet_features'] (eager models only)
     :return: trained model
     """
 
@@ -42,20 +66,12 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=64)
-    # model = nn.DataParallel(model)
-    model = model.to(device)
-
-    # Load candidate detection model
-    try:
-        model_path = os.path.join(model_directory, f'{model_name}_cdet_model.pth')
-        model = utils.load_model(model_path, model)
-    except:
-        try:
-            model_path = os.path.join(model_directory, f'{model_name}_cdet_model_weights.pth')
-            model = utils.load_model(model_path, model, mode='weights')
-        except ImportError:
-            raise ImportError(f'In directory, {model_directory}, {model_name}_cdet_model.pth or {model_name}_cdet_model_weights.pth does not appear to be a valid model file.')
+    if model_variant == 'int8':
+        # Quantized models only run on the CPU
+        device = torch.device('cpu')
+
+    if model is None:
+        model = load_cdet_model(model_directory, model_name, model_variant, device)
 
     if verbose:
         print(f'Loaded CDet to get initial predictions')
@@ -66,6 +82,7 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
     # patch_size = training_params['Patch_size']
 
     model.eval()
+    autocast_context = utils.get_autocast_context(device, precision)
 
     for subject in tqdm(subjects, desc='evaluating_cdet', disable=True, leave=False):
 
@@ -74,17 +91,24 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
 
         data_patches, _, _, _, _ = data_preparation.get_nonoverlapping_patches(image, label, brain_mask, frst, patch_size)
         data_patches[data_patches < 0] = 0
+        data_patches = data_patches.astype(np.float32)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context:
 
             inferred_patches = []
+            feature_patches = []
             for patch in data_patches:
                 
                 patch = np.expand_dims(patch, axis=0)
                 patch = torch.from_numpy(patch)
-                patch = patch.to(device=device, dtype=torch.float)
-
-                predictions = model.forward(patch)
+                patch = patch.to(device=device)
+
+                if return_features:
+                    features = model.encode(patch)
+                    predictions = model.decode(features).float()
+                    feature_patches.append(features[2][0].float().cpu().numpy())
+                else:
+                    predictions = model.forward(patch).float()
                 predictions = softmax(predictions)
                 predictions = predictions[0, 1]
 
@@ -96,6 +120,75 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
         I
         subject['cdet_inference'] = inferred_subject
 
+        if return_features:
+            feature_patches = np.stack(feature_patches, axis=0)
+            subject['cdet_features'] = data_preparation.put_feature_patches_into_volume(feature_patches, label.shape, patch_size)
+
     if return_type == 'item':
         return subjects[0]
-    return subjects
\ No newline at end of file
+    return subjects
+
+def get_cdet_candidates_cache_path(subject, model_hash, precision, cache_directory):
+    """
+    :param subject: dictionary containing subject filepaths
+    :param model_hash: str, utils.hash_state_dict of the CDet model
+    :param precision: str, autocast precision of the forward passes
+    :param cache_directory: str, directory of the cached candidate maps
+    :return: str, path of the cached candidate map of the subject
+    """
+
+    subject_hash = utils.hash_files([subject[key] for key in ['input_path', 'frst_path'] if key in subject])
+    return os.path.join(cache_directory, f'{subject_hash[:32]}_{model_hash[:32]}_{precision}.npz')
+
+def get_cdet_candidates(subjects, verbose=True, model_directory=None, model_name='microbleednet', precision='float32', model=None, cache_directory=None):
+    """
+    Adds the CDet candidate maps of the subjects (used to extract the CDisc patches) in the compact form of
+    data_preparation.pack_candidate_map to subject['cdet_candidates']. The maps are cached on disk, keyed on the
+    contents of the subject input and FRST images and on the weights of the CDet model, so that the CDet inference only
+    runs for new subjects or a changed model.
+    :param subjects: list of dictionaries containing subject filepaths
+    :param verbose: bool, display debug messages
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param precision: str, autocast precision of the forward passes
+    :param model: already loaded model (see load_cdet_model), if None the model is loaded from model_directory
+    :param cache_directory: str, directory of the cached candidate maps (default = ~/.cache/microbleednet/cdet_candidates)
+    :return: list of subjects
+    """
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if model is None:
+        model = load_cdet_model(model_directory, model_name, 'eager', device)
+
+    if cache_directory is None:
+        cache_directory = os.path.join(os.path.expanduser('~'), '.cache', 'microbleednet', 'cdet_candidates')
+    os.makedirs(cache_directory, exist_ok=True)
+
+    model_hash = utils.hash_state_dict(model)
+    n_cached_subjects = 0
+
+    for subject in subjects:
+
+        cache_path = get_cdet_candidates_cache_path(subject, model_hash, precision, cache_directory)
+
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as candidates:
+                subject['cdet_candidates'] = {key: candidates[key] for key in candidates.files}
+            n_cached_subjects += 1
+            continue
+
+        # The full inference volume of a subject is only kept until it is packed
+        cdet_inference = main(dict(subject), verbose=False, precision=precision, model=model)['cdet_inference']
+        subject['cdet_candidates'] = data_preparation.pack_candidate_map(cdet_inference)
+
+        # Written to a temporary file and renamed, so that concurrent processes never read a partial file
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **subject['cdet_candidates'])
+        os.replace(temporary_path, cache_path)
+
+    if verbose:
+        print(f'CDet candidates of {n_cached_subjects} / {len(subjects)} subjects loaded from the cache')
+
+    return subjects
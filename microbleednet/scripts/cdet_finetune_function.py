@@ -2,16 +2,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
 import torch
 from torch import optim
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import datasets
 from microbleednet.scripts import loss_functions
 from microbleednet.scripts import data_preparation
 from microbleednet.scripts import cdet_train_function
-from microbleednet.scripts import model_architectures as models
 
 
 ################################################################
@@ -46,21 +45,12 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     layers_to_finetune = finetune_params['Finetuning_layers']  # list of numbers [1,8]
     finetune_learning_rate = finetune_params['Finetuning_learning_rate']  # scalar (0,1)
 
-    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=64)
+    model_name = finetune_params['Modelname']
+    model = model_registry.load_model(model_directory, model_name, 'cdet')
+
     # model = nn.DataParallel(model)
     model.to(device=device)
 
-    model_name = finetune_params['Modelname']
-    try:
-        model_path = os.path.join(model_directory, f'{model_name}_cdet_model.pth')
-        model = utils.load_model(model_path, model, mode='full_model')
-    except:
-        try:
-            model_path = os.path.join(model_directory, f'{model_name}_cdet_model_weights.pth')
-            model = utils.load_model(model_path, model, mode='weights')
-        except ImportError:
-            raise ImportError(f'In directory {model_directory}, {model_name}_cdet_model.pth or {model_name}_cdet_student_model_weights.pth do not appear to be valid model or weights files')
-
     if type(milestones) != list:
         milestones = [milestones]
 
@@ -93,8 +83,8 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
         print(f"Num positive patches: {len(positive_patches_store)}, Num negative patches: {len(negative_patches_store)}")
 
     train_patches_store, validation_patches_store = utils.split_patches(positive_patches_store, negative_patches_store, train_proportion)
-    train_set = datasets.CDetPatchDataset(train_patches_store['positive'], train_patches_store['negative'], perform_augmentations=True)
-    validation_set = datasets.CDetPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'])
+    train_set = datasets.CDetPatchDataset(train_patches_store['positive'], train_patches_store['negative'], ratio='1:1', perform_augmentations=True)
+    validation_set = datasets.CDetPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
 
     if verbose:
         print(f'Num training patches: {len(train_set)}, Num validation patches: {len(validation_set)}')
@@ -102,3 +92,5 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones, gamma=gamma, last_epoch=-1)
 
     model = cdet_train_function.train(train_set, validation_set, model, criterion, optimizer, scheduler, finetune_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory)
+
+    return model
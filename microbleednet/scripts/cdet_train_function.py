@@ -4,17 +4,20 @@ from __future__ import print_function
 
 import os
 import torch
-import numpy as np
+import contextlib
 import torch.nn as nn
 from tqdm import tqdm
 from torch import optim
-from torch.utils.data import DataLoader
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import datasets
+from microbleednet.scripts import augmentations
 from microbleednet.scripts import earlystopping
+from microbleednet.scripts import checkpoint_writer
 
 from microbleednet.scripts import loss_functions
+from microbleednet.scripts import compare_function
 from microbleednet.scripts import data_preparation
 from microbleednet.scripts import model_architectures as models
 
@@ -50,10 +53,26 @@ def main(subjects, training_params, perform_augmentation=True, save_checkpoint=T
     learning_rate = training_params['Learning_rate']  # scalar (0, 1)
     train_proportion = training_params['Train_prop']  # scale (0, 1)
 
-    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=64)
+    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=training_params['Cdet_init_channels'], depth=training_params['Cdet_depth'])
     # model = nn.DataParallel(model)
     model = model.to(device)
 
+    # Trained CDet model distilled into the (usually slimmer) model being trained
+    teacher_model = None
+    teacher_model_path = training_params['Cdet_teacher']
+    if teacher_model_path is not None:
+        try:
+            teacher_model = model_registry.load_model(os.path.dirname(teacher_model_path), os.path.basename(teacher_model_path), 'cdet', device)
+        except ValueError:
+            raise ValueError('Teacher CDet model not loaded correctly.')
+
+        teacher_model.eval()
+        for param in teacher_model.parameters():
+            param.requires_grad = False
+
+        if verbose:
+            print(f'Distilling the CDet teacher model {teacher_model.architecture} into the CDet model {model.architecture}')
+
     if type(milestones) != list:
         milestones = [milestones]
 
@@ -85,11 +104,15 @@ def main(subjects, training_params, perform_augmentation=True, save_checkpoint=T
 
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones, gamma=gamma, last_epoch=-1)
 
-    model = train(train_set, validation_set, model, criterion, optimizer, scheduler, training_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory)
+    model = train(train_set, validation_set, model, criterion, optimizer, scheduler, training_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory, teacher_model=teacher_model)
+
+    if teacher_model is not None and utils.is_main_process():
+        print('Comparing the distilled CDet model with its teacher on the training subjects')
+        compare_function.cdet_speed_sensitivity_report(subjects, {'teacher': teacher_model, 'student': model}, precision=training_params['Precision'], verbose=verbose)
 
     return model
 
-def train(train_set, validation_set, model, criterion, optimizer, scheduler, training_params, device, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None):
+def train(train_set, validation_set, model, criterion, optimizer, scheduler, training_params, device, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None, teacher_model=None):
     
     """
     Microbleednet train function
@@ -107,6 +130,7 @@ def train(train_set, validation_set, model, criterion, optimizer, scheduler, tra
     :param save_case: str, condition for saving CP
     :param verbose: bool, display debug messages
     :param checkpoint_directory: str, filepath for saving the model
+    :param teacher_model: trained CDet model to distil into the model, if None the model is trained on the labels only
     :return: trained model
     """
 
@@ -114,14 +138,21 @@ def train(train_set, validation_set, model, criterion, optimizer, scheduler, tra
     num_epochs = training_params['Num_epochs']
     batch_factor = training_params['Batch_factor']
     patience = training_params['Patience']
+    validate_every = training_params['Validate_every']
     save_resume = training_params['SaveResume']
     patch_size = training_params['Patch_size']
+    precision = training_params['Precision']
+
+    # Checkpoints are written on a background thread, the training does not wait for the disk
+    writer = checkpoint_writer.AsyncCheckpointWriter()
 
-    early_stopping = earlystopping.EarlyStoppingModelCheckpointing('cdet', patience, verbose=verbose)
+    # The patience is in epochs, and the early stopping counts validations
+    early_stopping = earlystopping.EarlyStoppingModelCheckpointing('cdet', -(-patience // validate_every), verbose=verbose, checkpoint_writer=writer)
 
     train_losses = []
     validation_dice = []
     validation_losses = []
+    epoch_timings = {}
     best_validation_dice = 0
 
     start_epoch = 1
@@ -149,100 +180,187 @@ def train(train_set, validation_set, model, criterion, optimizer, scheduler, tra
     if verbose:
         print('Starting training.')
 
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=4)
+    # The training loader (and its persistent workers) is reused by every epoch. The validation sampler keeps the same seed
+    # and epoch, so that the validation batches are the same at every validation and are only collated once. In a
+    # distributed training, each process loads its own share of the patches.
+    train_sampler = datasets.BalancedPatchSampler(train_set, num_replicas=utils.get_world_size(), rank=utils.get_rank())
+    validation_sampler = datasets.BalancedPatchSampler(validation_set, num_replicas=utils.get_world_size(), rank=utils.get_rank())
+    train_loader = utils.create_data_loader(train_set, batch_size, train_sampler, training_params, device)
+    validation_batches = utils.cache_batches(utils.create_data_loader(validation_set, batch_size, validation_sampler, training_params, device), device)
+
+    # The patches are augmented on the collated batch, on the training device
+    perform_augmentation = perform_augmentation and train_set.perform_augmentations
+    augmentation_generator = torch.Generator(device=device)
+    augmentation_generator.manual_seed(0)
+
+    autocast_context = utils.get_autocast_context(device, precision)
+    scaler = utils.get_grad_scaler(device, precision)
+
+    if teacher_model is not None:
+        distillation_criterion = loss_functions.SegmentationDistillationLoss()
+
+    # Activations recomputed in the backward pass, the model is checkpointed before being compiled
+    if training_params['Activation_checkpointing']:
+        model = utils.set_activation_checkpointing(model)
+
+    if training_params['Compile']:
+        model = utils.compile_model(model)
+        if teacher_model is not None:
+            teacher_model = utils.compile_model(teacher_model)
+
+    # The training passes go through DistributedDataParallel in a distributed training, the model itself is validated and saved
+    training_model, no_gradient_sync = utils.wrap_distributed_model(model, device)
+
+    # Time spent waiting for the data loader, in the forward and backward passes, the optimiser steps, the validation and
+    # the checkpointing at each epoch
+    timer = utils.EpochTimer(device)
 
     for epoch in range(start_epoch, num_epochs + 1):
 
         model.train()
-        train_set.reset_samples()
+        train_sampler.set_epoch(epoch)
+        timer.reset()
 
         running_loss = 0.0
+        n_samples = 0
         print(f'\nEpoch: {epoch}')
 
         n_batches = len(train_loader)
-        with tqdm(total=n_batches, desc='training_cdet', disable=True) as pbar:
+        optimizer.zero_grad()
+        with timer.time('train'), tqdm(total=n_batches, desc='training_cdet', disable=True) as pbar:
 
-            for batch in train_loader:
+            for batch_index, batch in enumerate(timer.iterate(train_loader, 'data_wait')):
 
                 x, y, pixel_weights = batch['input'], batch['label'], batch['pixel_weights']
                 x = x.reshape(-1, *x.shape[2:])
                 y = y.reshape(-1, *y.shape[2:])
                 pixel_weights = pixel_weights.reshape(-1, *pixel_weights.shape[2:])
+                n_samples += x.shape[0]
+
+                with timer.time('preprocessing'):
+                    x = x.to(device=device, dtype=torch.float, non_blocking=True)
+                    y = y.to(device=device, dtype=torch.long, non_blocking=True)
+                    pixel_weights = pixel_weights.to(device=device, dtype=torch.float, non_blocking=True)
+
+                    if perform_augmentation:
+                        # The voxel weights (smoothed labels) are flipped and translated with the labels
+                        x, labels = augmentations.augment_batch(x, torch.cat([y[:, None].float(), pixel_weights], dim=1), generator=augmentation_generator)
+                        y = labels[:, 0].long()
+                        pixel_weights = labels[:, 1:]
+
+                # Gradients are accumulated over batch_factor batches, with the loss averaged over the group, and only
+                # synchronised between the processes before the optimiser steps
+                group_size, optimizer_step = utils.get_accumulation_step(batch_index, n_batches, batch_factor)
+                with (contextlib.nullcontext() if optimizer_step else no_gradient_sync()):
+                    with timer.time('forward'):
+                        with autocast_context:
+                            predictions = training_model.forward(x)
+                            if teacher_model is not None:
+                                with torch.no_grad():
+                                    teacher_predictions = teacher_model.forward(x)
+
+                        # The loss is computed in float32 outside the autocast region
+                        if teacher_model is not None:
+                            loss = distillation_criterion(predictions.float(), teacher_predictions.float(), y, 4, 0.4, weight=pixel_weights)
+                        else:
+                            loss = criterion(predictions.float(), y, weight=pixel_weights)
+
+                    with timer.time('backward'):
+                        scaler.scale(loss / group_size).backward()
 
-                x = x.to(device=device, dtype=torch.float)
-                y = y.to(device=device, dtype=torch.float)
-                pixel_weights = pixel_weights.to(device=device, dtype=torch.float)
-
-                optimizer.zero_grad()
-                predictions = model.forward(x)
-                loss = criterion(predictions, y, weight=pixel_weights)
                 running_loss += loss.item()
-                loss.backward()
-                optimizer.step()
+                if optimizer_step:
+                    with timer.time('optimizer'):
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
 
                 pbar.set_postfix({'loss': f'{loss.item():.6f}'})
                 pbar.update(1)
 
-        mean_validation_loss, mean_validation_dice = test(validation_set, model, batch_size, device, criterion, verbose=verbose)
+        # The model is validated every validate_every epochs, and after the last epoch
+        validate = (epoch % validate_every == 0) or (epoch == num_epochs)
+        if validate:
+            with timer.time('validation'):
+                mean_validation_loss, mean_validation_dice = test(validation_batches, model, device, criterion, precision=precision, verbose=verbose)
         scheduler.step()
 
-        mean_loss = (running_loss / n_batches)
-        mean_loss = mean_loss
+        running_loss, n_loss_batches, n_samples = utils.all_reduce_sum([running_loss, n_batches, n_samples], device)
+        mean_loss = (running_loss / n_loss_batches)
         print(f'Training set average loss: {mean_loss:.6f}')
 
         train_losses.append(mean_loss)
-        validation_dice.append(mean_validation_dice.cpu().numpy())
-        validation_losses.append(mean_validation_loss)
+        if validate:
+            validation_dice.append(mean_validation_dice.cpu().numpy())
+            validation_losses.append(mean_validation_loss)
 
-        if save_resume:
-            
-            checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdet.pth')
-            if checkpoint_directory is not None:
-                checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdet.pth')
+        with timer.time('checkpoint'):
+            if save_resume and utils.is_main_process():
                 
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'scheduler_state_dict': scheduler.state_dict(),
-                'loss_train': train_losses,
-                'loss_val': validation_losses,
-                'dice_val': validation_dice,
-                'best_val_dice': best_validation_dice
-            }, checkpoint_path)
-
-        if save_checkpoint:
-            np.savez(os.path.join(checkpoint_directory, 'losses_cdet.npz'), train_loss=train_losses, val_loss=validation_losses)
-            np.savez(os.path.join(checkpoint_directory, 'validation_dice_cdet.npz'), dice_val=validation_dice)
-
-        early_stopping(mean_validation_loss, mean_validation_dice, best_validation_dice, model, epoch, optimizer, scheduler, mean_loss, training_params, weights=save_weights, checkpoint=save_checkpoint, save_condition=save_case, model_path=checkpoint_directory)
-
-        if mean_validation_dice > best_validation_dice:
-            best_validation_dice = mean_validation_dice
-
-        if early_stopping.early_stop:
-            print('Patience Reached - Early Stopping Activated.')
-            break
+                checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdet.pth')
+                if checkpoint_directory is not None:
+                    checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdet.pth')
+                    
+                writer.save({
+                    'epoch': epoch,
+                    'model_state_dict': model.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'scheduler_state_dict': scheduler.state_dict(),
+                    'loss_train': train_losses,
+                    'loss_val': validation_losses,
+                    'dice_val': validation_dice,
+                    'best_val_dice': best_validation_dice
+                }, checkpoint_path)
+
+            if validate:
+                early_stopping(mean_validation_loss, mean_validation_dice, best_validation_dice, model, epoch, optimizer, scheduler, mean_loss, training_params, weights=save_weights, checkpoint=save_checkpoint, save_condition=save_case, model_path=checkpoint_directory)
+
+        timings = timer.summary(n_samples)
+        utils.print_epoch_timings(timings, verbose=verbose)
+        for key, value in [('epoch', epoch), *timings.items()]:
+            epoch_timings.setdefault(key, []).append(value)
+
+        if save_checkpoint and utils.is_main_process():
+            # The timings of the epochs (of this run, when resumed) are saved with the losses
+            writer.savez(os.path.join(checkpoint_directory, 'losses_cdet.npz'), train_loss=train_losses, val_loss=validation_losses, **epoch_timings)
+            writer.savez(os.path.join(checkpoint_directory, 'validation_dice_cdet.npz'), dice_val=validation_dice)
+
+        if training_params['Log_timing'] and utils.is_main_process():
+            utils.append_json_line(os.path.join(checkpoint_directory, 'timings_cdet.jsonl'), dict(epoch=epoch, **timings))
+
+        if validate:
+            if mean_validation_dice > best_validation_dice:
+                best_validation_dice = mean_validation_dice
+
+            if early_stopping.early_stop:
+                print('Patience Reached - Early Stopping Activated.')
+                break
         # sys.exit('Patience Reached - Early Stopping Activated')
 
         torch.cuda.empty_cache()  # Clear memory cache
 
-    if save_resume:
+    # Waits for the pending checkpoints before the models are loaded or the resume checkpoint is removed
+    writer.close()
+
+    if save_resume and utils.is_main_process():
         checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdet.pth')
         if checkpoint_directory is not None:
             checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdet.pth')
             
         os.remove(checkpoint_path)
 
+    # The other processes wait for the models saved by the main process
+    utils.barrier()
+
     return model
 
-def test(test_set, model, batch_size, device, criterion, verbose=False):
+def test(test_batches, model, device, criterion, precision='float32', verbose=False):
     """
-    :param test_data: test_data
+    :param test_batches: list of the validation batches (utils.cache_batches)
     :param model: model
-    :param batch_size: int
     :param device: cpu or gpu (.cuda())
     :param criterion: loss function
+    :param precision: str, autocast precision of the forward passes (float32, bfloat16, float16)
     :param weighted: bool, whether to apply spatial weights in loss function
     :param verbose: bool, display debug messages
     """
@@ -250,36 +368,35 @@ def test(test_set, model, batch_size, device, criterion, verbose=False):
     model.eval()
 
     softmax = nn.Softmax(dim=1)
-    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=4)
 
     running_loss = 0.0
     running_dice_score = 0
 
-    n_batches = len(test_loader)
-    test_set.reset_samples()
+    n_batches = len(test_batches)
 
-    with torch.no_grad():
+    with torch.no_grad(), utils.get_autocast_context(device, precision):
         with tqdm(total=n_batches, desc='evaluating_cdet', disable=True) as pbar:
 
-            for batch in test_loader:
+            for batch in test_batches:
 
                 x, y, pixel_weights = batch['input'], batch['label'], batch['pixel_weights']
                 x = x.reshape(-1, *x.shape[2:])
                 y = y.reshape(-1, *y.shape[2:])
                 pixel_weights = pixel_weights.reshape(-1, *pixel_weights.shape[2:])
 
-                x = x.to(device=device, dtype=torch.float)
-                y = y.to(device=device, dtype=torch.float)
-                pixel_weights = pixel_weights.to(device=device, dtype=torch.float)
+                x = x.to(device=device, dtype=torch.float, non_blocking=True)
+                y = y.to(device=device, dtype=torch.long, non_blocking=True)
+                pixel_weights = pixel_weights.to(device=device, dtype=torch.float, non_blocking=True)
 
-                predictions = model.forward(x)
+                predictions = model.forward(x).float()
                 loss = criterion(predictions, y, weight=pixel_weights)
                 running_loss += loss.item()
             
                 probabilities = softmax(predictions)
-                probability_vector = probabilities.view(-1, 2)
+                # The class channel is moved last, so that the predictions are laid out voxel by voxel like the one-hot targets
+                probability_vector = probabilities.movedim(1, -1).reshape(-1, 2)
                 binary_prediction_vector = (probability_vector > 0.5).double()
-                target_vector = y.view(-1, 2)
+                target_vector = nn.functional.one_hot(y.reshape(-1), 2)
 
                 dice_score = loss_functions.calculate_dice_coefficient(binary_prediction_vector, target_vector)
                 running_dice_score += dice_score
@@ -287,8 +404,11 @@ def test(test_set, model, batch_size, device, criterion, verbose=False):
                 pbar.set_postfix({'loss': f'{loss.item():.6f}', 'dice': f'{dice_score:.6f}'})
                 pbar.update(1)
 
+    # Sums over the validation patches of all the processes of a distributed training
+    running_loss, running_dice_score, n_batches = utils.all_reduce_sum([running_loss, float(running_dice_score), n_batches], device)
+
     mean_validation_loss = running_loss / n_batches
-    mean_validation_dice = running_dice_score / n_batches
+    mean_validation_dice = torch.tensor(running_dice_score / n_batches, dtype=torch.float64)
  
     print(f'Validation set average loss - {mean_validation_loss:.6f}, Average dice - {mean_validation_dice:.6f}')
 
@@ -10,9 +10,9 @@ import torch.nn as nn
 from tqdm import tqdm
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 
 from microbleednet.scripts import data_preparation
-from microbleednet.scripts import model_architectures as models
 
 ########################################
 # Microbleednet main training function #
@@ -20,7 +20,27 @@ from microbleednet.scripts import model_architectures as models
 # 09-01-2023                           #
 ########################################
 
-def main(subjects, verbose=True, model_directory=None, model_name='microbleednet'):
+def load_cdisc_student_model(model_directory, model_name='microbleednet', model_variant='eager', device=None):
+    """
+    Loads the CDisc student model used for evaluation
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param model_variant: str, model to load. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize)
+    :param device: cpu() or cuda()
+    :return: model
+    """
+
+    if model_variant in ['scripted', 'int8']:
+        model_path = os.path.join(model_directory, f'{model_name}_cdisc_student_model_{model_variant}.pt')
+        model = utils.load_exported_model(model_path, device)
+
+    else:
+        # Load candidate discrimination model, built with the (pruned) architecture of the checkpoint
+        model = model_registry.load_model(model_directory, model_name, 'cdisc_student', device)
+
+    return model
+
+def main(subjects, verbose=True, model_directory=None, model_name='microbleednet', model_variant='eager', precision='float32', model=None):
     
     """
     The main evaluation function
@@ -32,6 +52,9 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
     :param save_case: str, condition for saving the checkpoint
     :param verbose: bool, display debug messages
     :param checkpoint_directory: str, directory for saving model/weights
+    :param model_variant: str, model to load. Options: eager, scripted (microbleednet export), int8 (microbleednet quantize)
+    :param precision: str, autocast precision of the forward passes. Options: float32, bfloat16, float16 (GPU only)
+    :param model: already loaded model (see load_cdisc_student_model), if None the model is loaded from model_directory
     :return: trained model
     """
 
@@ -42,20 +65,12 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
-    # model = nn.DataParallel(model)
-    model = model.to(device)
+    if model_variant == 'int8':
+        # Quantized models only run on the CPU
+        device = torch.device('cpu')
 
-    # Load candidate detection model
-    try:
-        model_path = os.path.join(model_directory, f'{model_name}_cdisc_student_model.pth')
-        model = utils.load_model(model_path, model, mode='full_model')
-    except:
-        try:
-            model_path = os.path.join(model_directory, f'{model_name}_cdisc_student_model_weights.pth')
-            model = utils.load_model(model_path, model, mode='weights')
-        except ImportError:
-            raise ImportError(f'In directory, {model_directory}, {model_name}_cdisc_model.pth or {model_name}_cdisc_student_model_weights.pth does not appear to be a valid model file.')
+    if model is None:
+        model = load_cdisc_student_model(model_directory, model_name, model_variant, device)
 
     softmax = nn.Softmax(dim=1) 
 
@@ -63,6 +78,7 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
     # patch_size = training_params['Patch_size']
 
     model.eval()
+    autocast_context = utils.get_autocast_context(device, precision)
 
     for subject in tqdm(subjects, desc='evaluating_cdisc', disable=True):
 
@@ -76,17 +92,18 @@ def main(subjects, verbose=True, model_directory=None, model_name='microbleednet
         data_patches, _ = data_preparation.get_patches_centered_on_cmb(image, cdet_prediction, frst, patch_size)
         data_patches, _= data_preparation.augment_data(data_patches, np.zeros_like(data_patches), n_augmentations=4)
         data_patches[data_patches < 0] = 0
+        data_patches = data_patches.astype(np.float32)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context:
 
             patch_predictions = []
             for patch in data_patches:
 
                 patch = np.expand_dims(patch, axis=0)
                 patch = torch.from_numpy(patch)
-                patch = patch.to(device=device, dtype=torch.float)
+                patch = patch.to(device=device)
 
-                predictions = model.forward(patch)
+                predictions = model.forward(patch).float()
                 probabilities = softmax(predictions)
 
                 predictions = np.argmax(probabilities.cpu().numpy(), axis=1)
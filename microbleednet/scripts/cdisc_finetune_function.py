@@ -2,14 +2,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
 import torch
 from torch import optim
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import datasets
 from microbleednet.scripts import loss_functions
-from microbleednet.scripts import model_architectures as models
 
 from microbleednet.scripts import data_preparation
 from microbleednet.scripts import cdisc_train_function
@@ -22,7 +21,7 @@ from microbleednet.scripts import cdet_evaluate_function
 #####################################################################
 
 
-def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, model_directory=None, checkpoint_directory=None):
+def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, model_directory=None, checkpoint_directory=None, teacher_directory=None):
     """
     The main function for fine-tuning the model
     :param subjects: list of dictionaries containing subject filepaths for fine-tuning
@@ -34,6 +33,7 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     :param verbose: bool, display debug messages
     :param model_directory: str, filepath containing pretrained model
     :param checkpoint_directory: str, filepath for saving the model
+    :param teacher_directory: str, filepath containing the CDisc teacher models (default = model_directory)
     """
     assert len(subjects) >= 5, "Number of distinct subjects for fine-tuning cannot be less than 5"
 
@@ -47,56 +47,22 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     finetune_learning_rate = finetune_params['Finetuning_learning_rate']  # scalar (0,1)
     patch_size = 24
 
-    student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
-    # student_model = nn.DataParallel(student_model)
-    student_model.to(device=device)
+    if teacher_directory is None:
+        teacher_directory = model_directory
 
-    teacher_model = models.CDiscNet(n_channels=2, n_classes=2, init_channels=64)
-    teacher_model.to(device=device)
-
-    teacher_classification_head = models.CDiscClass24(n_channels=2, n_classes=2, init_channels=256)
-    teacher_classification_head.to(device=device)
-
-    try:
-        try:
-            teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model.pth')
-            teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='full_model')
-        except:
-            try:
-                teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model_weights.pth')
-                teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='weights')
-            except:
-                ValueError('Teacher Discriminator model not loaded correctly.')
-
-        if verbose:
-            print('Teacher model loaded.')
-
-        try:
-            teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head.pth')
-            teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='full_model')
-        except:
-            try:
-                teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head_weights.pth')
-                teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='weights')
-            except:
-                ValueError('Teacher Classification head not loaded correctly.')
-
-        if verbose:
-            print('Teacher classification head loaded.')
-
-    except:
-        raise ValueError('Teacher Discriminator models not loaded correctly.')
+    teacher_model = model_registry.load_model(teacher_directory, 'microbleednet', 'cdisc_teacher', device)
+    if verbose:
+        print('Teacher model loaded.')
+
+    teacher_classification_head = model_registry.load_model(teacher_directory, 'microbleednet', 'cdisc_teacher_classification_head', device)
+    if verbose:
+        print('Teacher classification head loaded.')
 
     model_name = finetune_params['Modelname']
-    try:
-        model_path_student = os.path.join(model_directory,  f'{model_name}_cdisc_student_model.pth')
-        student_model = utils.load_model(model_path_student, student_model, mode='full_model')
-    except:
-        try:
-            model_path_student = os.path.join(model_directory, f'{model_name}_cdisc_student_model_weights.pth')
-            student_model = utils.load_model(model_path_student, student_model, mode='weights')
-        except:
-            raise ImportError(f'In directory {model_directory}, {model_name}_cdisc_student_model.pth or {model_name}_cdisc_student_model_weights.pth do not appear to be valid model or weights files')
+    student_model = model_registry.load_model(model_directory, model_name, 'cdisc_student')
+
+    # student_model = nn.DataParallel(student_model)
+    student_model.to(device=device)
 
     if type(milestones) != list:
         milestones = [milestones]
@@ -107,7 +73,8 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     print('Total number of model parameters', flush=True)
     print(f'Total parameters in candidate discriminatino model: {sum([p.numel() for p in student_model.parameters()])}')
 
-    student_model = utils.freeze_layers_for_finetuning(student_model, layers_to_finetune, verbose=verbose)
+    student_layer_names = ['fc3', 'fc2', 'fc1', 'classdown2', 'classdown1', 'classconvfirst', 'down2', 'down1', 'convfirst', 'inpconv']
+    student_model = utils.freeze_layers_for_finetuning(student_model, layers_to_finetune, verbose=verbose, model_layer_names=student_layer_names)
     student_model.to(device=device)
 
     trainable_parameters = list(filter(lambda p: p.requires_grad, student_model.parameters()))
@@ -126,20 +93,22 @@ def main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=T
     if verbose:
         print(f'Found {len(subjects)} subjects')
 
-    # This adds the cdet inference to each subject dictionary
-    subjects = cdet_evaluate_function.main(subjects, verbose=verbose, model_directory=checkpoint_directory)
+    # This adds the (cached) cdet candidates to each subject dictionary
+    subjects = cdet_evaluate_function.get_cdet_candidates(subjects, verbose=verbose, model_directory=checkpoint_directory)
     tp_patches_store, fp_patches_store = data_preparation.split_into_patches_centered_on_cmb_classwise(subjects, patch_size=patch_size)
 
     if verbose:
         print(f'Num tp patches: {len(tp_patches_store)}, Num fp patches: {len(fp_patches_store)}')
 
     train_patches_store, validation_patches_store = utils.split_patches(tp_patches_store, fp_patches_store, train_proportion)
-    train_set = datasets.CDiscPatchDataset(train_patches_store['negative'], train_patches_store['positive'], perform_augmentations=True)
-    validation_set = datasets.CDiscPatchDataset(validation_patches_store['negative'], validation_patches_store['positive'])
+    train_set = datasets.CDiscPatchDataset(train_patches_store['positive'], train_patches_store['negative'], ratio='1:1', perform_augmentations=True)
+    validation_set = datasets.CDiscPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
 
     if verbose:
         print(f'Num training patches: {len(train_set)}, Num validation patches: {len(validation_set)}')
 
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones, gamma=gamma, last_epoch=-1)
 
-    model = cdisc_train_function.train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, finetune_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory)
+    model = cdisc_train_function.train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, finetune_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory, cache_frozen_layers=finetune_params['Cache_frozen_features'])
+
+    return model
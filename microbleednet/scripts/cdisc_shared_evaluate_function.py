@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import numpy as np
+import torch.nn as nn
+from tqdm import tqdm
+
+from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
+
+from microbleednet.scripts import data_preparation
+
+
+def load_cdisc_shared_head(model_directory, model_name='microbleednet', device=None):
+    """
+    Loads the candidate discrimination head trained on the CDet encoder features
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param device: cpu() or cuda()
+    :return: model
+    """
+
+    model = model_registry.load_model(model_directory, model_name, 'cdisc_shared', device)
+
+    return model
+
+def main(subjects, verbose=True, model_directory=None, model_name='microbleednet', precision='float32', model=None, batch_size=64):
+    """
+    Candidate discrimination on ROI crops of the CDet encoder features, without a second encoder pass
+    :param subjects: list of dictionaries containing subject filepaths, evaluated with cdet_evaluate_function (return_features=True)
+    :param verbose: bool, display debug messages
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param precision: str, autocast precision of the forward passes. Options: float32, bfloat16, float16 (GPU only)
+    :param model: already loaded head (see load_cdisc_shared_head), if None the head is loaded from model_directory
+    :param batch_size: int, number of candidates classified in a single forward pass
+    :return: subjects with the CDisc predictions in subject['cdisc_inference']
+    """
+
+    return_type = 'list'
+    if type(subjects) != list:
+        subjects = [subjects]
+        return_type = 'item'
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if model is None:
+        model = load_cdisc_shared_head(model_directory, model_name, device)
+
+    softmax = nn.Softmax(dim=1)
+
+    patch_size = 24
+
+    model.eval()
+    autocast_context = utils.get_autocast_context(device, precision)
+
+    for subject in tqdm(subjects, desc='evaluating_cdisc_shared', disable=True):
+
+        # Here we assume that the subject has been passed through the CDet evaluation function with return_features=True.
+        try:
+            cdet_prediction = subject['cdet_inference']
+            cdet_features = subject['cdet_features']
+        except:
+            raise ValueError(f"Subject {subject['basename']} has not been evaluated with CDet (return_features=True). Please evaluate with CDet first.")
+
+        feature_patches = data_preparation.get_feature_patches_centered_on_cmb(cdet_features, cdet_prediction, patch_size)
+
+        patch_predictions = []
+        with torch.no_grad(), autocast_context:
+            for idx in range(0, len(feature_patches), batch_size):
+
+                batch = torch.from_numpy(feature_patches[idx:idx + batch_size])
+                batch = batch.to(device=device)
+
+                predictions = model.forward(batch).float()
+                probabilities = softmax(predictions)
+
+                predictions = np.argmax(probabilities.cpu().numpy(), axis=1)
+                patch_predictions.extend(predictions.tolist())
+
+        inferred_subject = data_preparation.filter_predictions_from_volume(cdet_prediction, patch_predictions)
+        subject['cdisc_inference'] = inferred_subject
+
+        # The feature maps are only needed for the candidate discrimination
+        del subject['cdet_features']
+
+    if return_type == 'item':
+        return subjects[0]
+    return subjects
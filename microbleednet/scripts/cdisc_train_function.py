@@ -4,18 +4,22 @@ from __future__ import print_function
 
 import os
 import torch
+import tempfile
+import contextlib
 import numpy as np
 import torch.nn as nn
 from tqdm import tqdm
 from torch import optim
-from torch.utils.data import DataLoader
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import datasets
+from microbleednet.scripts import augmentations
 from microbleednet.scripts import loss_functions
 from microbleednet.scripts import model_architectures as models
 
 from microbleednet.scripts import earlystopping
+from microbleednet.scripts import checkpoint_writer
 from microbleednet.scripts import data_preparation
 from microbleednet.scripts import cdet_evaluate_function
 
@@ -26,7 +30,7 @@ from microbleednet.scripts import cdet_evaluate_function
 ########################################
 
 
-def main(subjects, training_params, model_directory=None, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='last', verbose=True, checkpoint_directory=None):
+def main(subjects, training_params, model_directory=None, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='last', verbose=True, checkpoint_directory=None, shared_encoder=False):
     
     """
     The main training function
@@ -40,6 +44,7 @@ def main(subjects, training_params, model_directory=None, perform_augmentation=T
     :param save_case: str, condition for saving the checkpoint
     :param verbose: bool, display debug messages
     :param checkpoint_directory: str, directory for saving model/weights
+    :param shared_encoder: bool, train the CDisc head on the (frozen) CDet encoder features instead of the CDisc student model
     :return: trained model
     """
 
@@ -54,51 +59,33 @@ def main(subjects, training_params, model_directory=None, perform_augmentation=T
     train_proportion = training_params['Train_prop']  # scale (0, 1)
     patch_size = 24
 
-    student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
+    if shared_encoder:
+        try:
+            cdet_model = model_registry.load_model(checkpoint_directory, 'microbleednet', 'cdet')
+        except ValueError:
+            raise ValueError('CDet model not loaded correctly, please train the CDet model first.')
+
+        student_model = models.CDiscSharedNet(cdet_model, n_classes=2, init_channels=64)
+        model_key = 'cdisc_shared'
+    else:
+        student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
+        model_key = 'cdisc_student'
     # student_model = nn.DataParallel(student_model)
     student_model.to(device=device)
 
-    teacher_model = models.CDiscNet(n_channels=2, n_classes=2, init_channels=64)
-    teacher_model.to(device=device)
-
-    teacher_classification_head = models.CDiscClass24(n_channels=2, n_classes=2, init_channels=256)
-    teacher_classification_head.to(device=device)
-
-    try:
-        try:
-            teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model.pth')
-            teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='full_model')
-        except:
-            try:
-                teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model_weights.pth')
-                teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='weights')
-            except:
-                ValueError('Teacher Discriminator model not loaded correctly.')
-
-        if verbose:
-            print('Teacher model loaded.')
-
-        try:
-            teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head.pth')
-            teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='full_model')
-        except:
-            try:
-                teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head_weights.pth')
-                teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='weights')
-            except:
-                ValueError('Teacher Classification head not loaded correctly.')
-
-        if verbose:
-            print('Teacher classification head loaded.')
+    teacher_model = model_registry.load_model(model_directory, 'microbleednet', 'cdisc_teacher', device)
+    if verbose:
+        print('Teacher model loaded.')
 
-    except:
-        raise ValueError('Teacher Discriminator models not loaded correctly.')
+    teacher_classification_head = model_registry.load_model(model_directory, 'microbleednet', 'cdisc_teacher_classification_head', device)
+    if verbose:
+        print('Teacher classification head loaded.')
     
     if type(milestones) != list:
         milestones = [milestones]
 
     if verbose:
-        print(f'Total number of model parameters to train in CDisc student model: {sum([p.numel() for p in student_model.parameters()]) / 1e6} M')
+        print(f'Total number of model parameters to train in CDisc {model_key} model: {sum([p.numel() for p in student_model.parameters() if p.requires_grad]) / 1e6} M')
 
     trainable_parameters = list(filter(lambda p: p.requires_grad, student_model.parameters()))
     if optimizer == 'adam':
@@ -112,8 +99,8 @@ def main(subjects, training_params, model_directory=None, perform_augmentation=T
     if verbose:
         print(f'Found {len(subjects)} subjects')
 
-    # This adds the cdet inference to each subject dictionary
-    subjects = cdet_evaluate_function.main(subjects, verbose=verbose, model_directory=checkpoint_directory)
+    # This adds the (cached) cdet candidates to each subject dictionary
+    subjects = cdet_evaluate_function.get_cdet_candidates(subjects, verbose=verbose, model_directory=checkpoint_directory)
     tp_patches_store, fp_patches_store = data_preparation.split_into_patches_centered_on_cmb_classwise(subjects, patch_size=patch_size)
 
     if verbose:
@@ -128,17 +115,124 @@ def main(subjects, training_params, model_directory=None, perform_augmentation=T
 
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones, gamma=gamma, last_epoch=-1)
 
-    model = train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, training_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory)
+    model = train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, training_params, device, perform_augmentation=perform_augmentation, save_checkpoint=save_checkpoint, save_weights=save_weights, save_case=save_case, verbose=verbose, checkpoint_directory=checkpoint_directory, model_key=model_key)
 
     return model
 
-def train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, training_params, device, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None):
+def cache_teacher_scores(patches_store, teacher_model, teacher_classification_head, device, perform_augmentation=True, n_augmentations=4, precision='float32', batch_size=64, seed=0, verbose=False):
+    """
+    Runs the frozen teacher once on every patch, and on a fixed set of augmented variants of it, and stores the variants
+    and the teacher logits in the patch dictionaries. CDiscPatchDataset then returns the stored variants and logits, so
+    that the teacher is not run again at every epoch.
+    :param patches_store: list of patch dictionaries
+    :param teacher_model: CDiscNet, only its encoder is run
+    :param teacher_classification_head: CDiscClass24
+    :param device: cpu() or cuda()
+    :param perform_augmentation: bool, store the augmented variants of the patches (otherwise only the patches themselves)
+    :param n_augmentations: int, number of augmented variants per patch
+    :param precision: str, autocast precision of the forward passes
+    :param batch_size: int, number of patch variants per forward pass
+    :param seed: int, seed of the augmentations
+    :param verbose: bool, display debug messages
+    :return: patches_store, with data_patch_variants and teacher_scores in every patch dictionary
+    """
+
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+
+    for patch in patches_store:
+        x = torch.from_numpy(np.expand_dims(patch['data_patch'], 0)).float()
+        if perform_augmentation:
+            x, _ = augmentations.augment_batch(x, n_augmentations=n_augmentations, generator=generator)
+        patch['data_patch_variants'] = x.numpy()
+
+    teacher_model.eval()
+    teacher_classification_head.eval()
+    autocast_context = utils.get_autocast_context(device, precision)
+
+    patches_per_batch = max(1, batch_size // len(patches_store[0]['data_patch_variants'])) if len(patches_store) > 0 else 1
+
+    for idx in range(0, len(patches_store), patches_per_batch):
+        batch_patches = patches_store[idx:idx + patches_per_batch]
+        x = torch.from_numpy(np.concatenate([patch['data_patch_variants'] for patch in batch_patches], axis=0)).to(device=device)
+
+        with torch.no_grad(), autocast_context:
+            teacher_scores = teacher_classification_head(teacher_model.encode(x)).float().cpu().numpy()
+
+        teacher_scores = np.split(teacher_scores, np.cumsum([len(patch['data_patch_variants']) for patch in batch_patches])[:-1])
+        for patch, patch_teacher_scores in zip(batch_patches, teacher_scores):
+            patch['teacher_scores'] = patch_teacher_scores
+
+    if verbose:
+        print(f'Cached the teacher scores of {sum([len(patch["teacher_scores"]) for patch in patches_store])} patch variants')
+
+    return patches_store
+
+def cache_frozen_features(patches_store, model, device, precision='float32', batch_size=64, max_memory=2 ** 31, verbose=False):
+    """
+    Runs the frozen leading layers of a fine-tuned model once on the stored variants of every patch (see
+    cache_teacher_scores) and stores their outputs, in float16, in the patch dictionaries. CDiscPatchDataset then returns
+    the stored outputs, and only the trainable layers of the model are run at every epoch. The frozen layers are run in
+    eval mode, so their BatchNorm statistics are not updated by the fine-tuning. The outputs are kept in a temporary file
+    instead of in memory when they take more than max_memory bytes.
+    :param patches_store: list of patch dictionaries, with data_patch_variants
+    :param model: CDiscStudentNet, with its layers frozen by utils.freeze_layers_for_finetuning
+    :param device: cpu() or cuda()
+    :param precision: str, autocast precision of the forward passes
+    :param batch_size: int, number of patch variants per forward pass
+    :param max_memory: int, size in bytes above which the outputs are stored in a temporary file
+    :param verbose: bool, display debug messages
+    :return: FrozenPrefixNet running the trainable layers of the model, the model itself if its first layer is trainable
+    """
+
+    n_frozen_layers = utils.get_n_frozen_leading_layers(model)
+    if n_frozen_layers == 0 or len(patches_store) == 0:
+        return model
+
+    model.eval()
+    autocast_context = utils.get_autocast_context(device, precision)
+
+    n_variants = [len(patch['data_patch_variants']) for patch in patches_store]
+    offsets = np.cumsum([0] + n_variants)
+    patches_per_batch = max(1, batch_size // max(n_variants))
+    frozen_features = None
+
+    for idx in range(0, len(patches_store), patches_per_batch):
+        batch_patches = patches_store[idx:idx + patches_per_batch]
+        x = torch.from_numpy(np.concatenate([patch['data_patch_variants'] for patch in batch_patches], axis=0)).to(device=device, dtype=torch.float)
+
+        with torch.no_grad(), autocast_context:
+            features = model.forward_layers(x, last=n_frozen_layers).float().cpu().numpy()
+
+        if frozen_features is None:
+            shape = (offsets[-1], *features.shape[1:])
+            n_bytes = int(np.prod(shape)) * np.dtype(np.float16).itemsize
+            if n_bytes > max_memory:
+                # The file has no name and is removed once the array is released
+                frozen_features = np.memmap(tempfile.TemporaryFile(), dtype=np.float16, mode='w+', shape=shape)
+            else:
+                frozen_features = np.empty(shape, dtype=np.float16)
+
+        frozen_features[offsets[idx]:offsets[idx + len(batch_patches)]] = features
+
+    for patch, start, end in zip(patches_store, offsets[:-1], offsets[1:]):
+        patch['frozen_features'] = frozen_features[start:end]
+
+    if verbose:
+        storage = 'a temporary file' if isinstance(frozen_features, np.memmap) else 'memory'
+        print(f'Cached the outputs of the {n_frozen_layers} frozen layers for {offsets[-1]} patch variants ({n_bytes / 1e6:.1f} MB in {storage})')
+
+    return models.FrozenPrefixNet(model, n_frozen_layers)
+
+def train(train_set, validation_set, teacher_model, teacher_classification_head, student_model, criterion, distillation_criterion, optimizer, scheduler, training_params, device, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None, model_key='cdisc_student', cache_frozen_layers=False):
     """
     Microbleednet train function
 
     :param train_set: CDiscPatchDataset containing training patches
     :param validation_subjects: CDiscPatchDataset containing training patches
     :param teacher_model: model
+    :param teacher_classification_head: model, run with the teacher model once before training (see cache_teacher_scores)
+    :param student_model: model
     :param criterion: loss function
     :param optimizer: optimiser
     :param scheduler: learning rate scheduler
@@ -150,6 +244,8 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
     :param save_case: str, condition for saving CP
     :param verbose: bool, display debug messages
     :param checkpoint_directory: str, filepath for saving the model
+    :param model_key: str, name used for the saved models, checkpoints and losses (cdisc_student, cdisc_shared)
+    :param cache_frozen_layers: bool, run the frozen leading layers of the fine-tuned student model once before training (see cache_frozen_features)
     :return: trained model
     """
 
@@ -158,15 +254,22 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
     num_epochs = training_params['Num_epochs']
     batch_factor = training_params['Batch_factor']
     patience = training_params['Patience']
+    validate_every = training_params['Validate_every']
     save_resume = training_params['SaveResume']
     patch_size = training_params['Patch_size']
+    precision = training_params['Precision']
 
-    early_stopping = earlystopping.EarlyStoppingModelCheckpointing('cdisc_student', patience, verbose=verbose)
+    # Checkpoints are written on a background thread, the training does not wait for the disk
+    writer = checkpoint_writer.AsyncCheckpointWriter()
+
+    # The patience is in epochs, and the early stopping counts validations
+    early_stopping = earlystopping.EarlyStoppingModelCheckpointing(model_key, -(-patience // validate_every), verbose=verbose, checkpoint_writer=writer)
 
     train_losses = []
     validation_dice = []
     validation_losses = []
     validation_accuracy = []
+    epoch_timings = {}
     best_validation_accuracy = 0
 
     start_epoch = 1
@@ -174,9 +277,9 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
     if save_resume:
         try:
             if checkpoint_directory is not None:
-                checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdisc_student.pth')
+                checkpoint_path = os.path.join(checkpoint_directory, f'tmp_model_{model_key}.pth')
             else:
-                checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdisc_student.pth')
+                checkpoint_path = os.path.join(os.getcwd(), f'tmp_model_{model_key}.pth')
 
             checkpoint_resumetraining = torch.load(checkpoint_path)
             student_model.load_state_dict(checkpoint_resumetraining['model_state_dict'])
@@ -195,14 +298,49 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
     if verbose:
         print('Starting training.')
 
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=4)
     softmax = nn.Softmax(dim=1)
 
+    autocast_context = utils.get_autocast_context(device, precision)
+    scaler = utils.get_grad_scaler(device, precision)
+
+    # The frozen teacher is run once on the training patches instead of on every batch of every epoch
+    cache_teacher_scores(train_set.patches, teacher_model, teacher_classification_head, device, perform_augmentation=(perform_augmentation and train_set.perform_augmentations), precision=precision, verbose=verbose)
+
+    # In a fine-tuning, the frozen leading layers of the student are also run once on the stored patch variants, and the
+    # training passes only run the trainable layers. The validation still runs the whole model on the patches.
+    trained_layers = student_model
+    if cache_frozen_layers:
+        trained_layers = cache_frozen_features(train_set.patches, student_model, device, precision=precision, verbose=verbose)
+
+    # The training loader (and its persistent workers, which get a copy of the cached teacher scores) is reused by every
+    # epoch. The validation sampler keeps the same seed and epoch, so that the validation batches are the same at every
+    # validation and are only collated once. In a distributed training, each process loads its own share of the patches.
+    train_sampler = datasets.BalancedPatchSampler(train_set, num_replicas=utils.get_world_size(), rank=utils.get_rank())
+    validation_sampler = datasets.BalancedPatchSampler(validation_set, num_replicas=utils.get_world_size(), rank=utils.get_rank())
+    train_loader = utils.create_data_loader(train_set, batch_size, train_sampler, training_params, device)
+    validation_batches = utils.cache_batches(utils.create_data_loader(validation_set, batch_size, validation_sampler, training_params, device), device)
+
+    # Activations recomputed in the backward pass, the model is checkpointed before being compiled
+    if training_params['Activation_checkpointing']:
+        student_model = utils.set_activation_checkpointing(student_model)
+
+    if training_params['Compile']:
+        student_model = utils.compile_model(student_model)
+        if trained_layers is not student_model:
+            trained_layers = utils.compile_model(trained_layers)
+
+    # The training passes go through DistributedDataParallel in a distributed training, the model itself is validated and saved
+    training_model, no_gradient_sync = utils.wrap_distributed_model(trained_layers, device)
+
+    # Time spent waiting for the data loader, in the forward and backward passes, the optimiser steps, the validation and
+    # the checkpointing at each epoch
+    timer = utils.EpochTimer(device)
+
     for epoch in range(start_epoch, num_epochs + 1):
 
-        teacher_model.eval()
         student_model.train()
-        train_set.reset_samples()
+        train_sampler.set_epoch(epoch)
+        timer.reset()
 
         running_distillation_loss = 0.0
         running_classification_loss = 0.0
@@ -212,39 +350,58 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
 
         running_negative_sampled = 0
         running_negative_predictions = 0
+
+        n_samples = 0
         
         print(f'\nEpoch: {epoch}')
 
         n_batches = len(train_loader)
-        with tqdm(total=n_batches, desc='training_cdisc', disable=True) as pbar:
+        optimizer.zero_grad()
+        with timer.time('train'), tqdm(total=n_batches, desc='training_cdisc', disable=True) as pbar:
 
-            for batch in train_loader:
+            for batch_index, batch in enumerate(timer.iterate(train_loader, 'data_wait')):
 
-                x, y = batch['input'], batch['label']
+                x, y, teacher_predictions = batch['input'], batch['label'], batch['teacher_scores']
                 x = x.reshape(-1, *x.shape[2:])
                 y = y.reshape(-1, *y.shape[2:])
+                teacher_predictions = teacher_predictions.reshape(-1, *teacher_predictions.shape[2:])
                 classification_weights = y * 100
-
-                x = x.to(device=device, dtype=torch.float)
-                y = y.to(device=device, dtype=torch.float)
-                classification_weights = classification_weights.to(device=device, dtype=torch.float)
-
-                optimizer.zero_grad()
-                teacher_encodings, _ = teacher_model.forward(x)
-                teacher_predictions = teacher_classification_head.forward(teacher_encodings)
-                student_predictions = student_model.forward(x)
-                
-                # classification_loss = criterion(student_predictions, y)
-                classification_loss = criterion(student_predictions, y, classification_weights)
-                distillation_loss = distillation_criterion(student_predictions, teacher_predictions, y, 4, 0.4)
-                total_loss = classification_loss + distillation_loss
-                # total_loss = distillation_loss
+                n_samples += x.shape[0]
+
+                with timer.time('preprocessing'):
+                    x = x.to(device=device, dtype=torch.float, non_blocking=True)
+                    y = y.to(device=device, dtype=torch.float, non_blocking=True)
+                    teacher_predictions = teacher_predictions.to(device=device, dtype=torch.float, non_blocking=True)
+                    classification_weights = classification_weights.to(device=device, dtype=torch.float, non_blocking=True)
+
+                # Gradients are accumulated over batch_factor batches, with the loss averaged over the group, and only
+                # synchronised between the processes before the optimiser steps
+                group_size, optimizer_step = utils.get_accumulation_step(batch_index, n_batches, batch_factor)
+                with (contextlib.nullcontext() if optimizer_step else no_gradient_sync()):
+                    with timer.time('forward'):
+                        with autocast_context:
+                            student_predictions = training_model.forward(x)
+
+                        # The losses are computed in float32 outside the autocast region
+                        student_predictions = student_predictions.float()
+                    
+                        # classification_loss = criterion(student_predictions, y)
+                        classification_loss = criterion(student_predictions, y, classification_weights)
+                        distillation_loss = distillation_criterion(student_predictions, teacher_predictions, y, 4, 0.4)
+                        total_loss = classification_loss + distillation_loss
+                        # total_loss = distillation_loss
+
+                    with timer.time('backward'):
+                        scaler.scale(total_loss / group_size).backward()
 
                 running_distillation_loss += distillation_loss.item()
                 running_classification_loss += classification_loss.item()
 
-                total_loss.backward()
-                optimizer.step()
+                if optimizer_step:
+                    with timer.time('optimizer'):
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
 
                 probabilities = softmax(student_predictions)
                 binary_prediction_vector = np.argmax(probabilities.detach().cpu().numpy(), axis=1)
@@ -266,69 +423,96 @@ def train(train_set, validation_set, teacher_model, teacher_classification_head,
                 pbar.update(1)
 
 
-        mean_validation_loss, mean_validation_accuracy = test(validation_set, student_model, batch_size, device, criterion, verbose=verbose)
+        # The model is validated every validate_every epochs, and after the last epoch
+        validate = (epoch % validate_every == 0) or (epoch == num_epochs)
+        if validate:
+            with timer.time('validation'):
+                mean_validation_loss, mean_validation_accuracy = test(validation_batches, student_model, device, criterion, precision=precision, verbose=verbose)
         scheduler.step()
 
-        mean_classification_loss = (running_classification_loss / n_batches)  # .detach().cpu().numpy()
-        mean_distillation_loss = (running_distillation_loss / n_batches)
+        # Sums over the training patches of all the processes of a distributed training
+        running_classification_loss, running_distillation_loss, n_loss_batches, n_samples, running_positive_predictions, running_positive_sampled, running_negative_predictions, running_negative_sampled = \
+            utils.all_reduce_sum([running_classification_loss, running_distillation_loss, n_batches, n_samples, running_positive_predictions, running_positive_sampled, running_negative_predictions, running_negative_sampled], device)
+
+        mean_classification_loss = (running_classification_loss / n_loss_batches)  # .detach().cpu().numpy()
+        mean_distillation_loss = (running_distillation_loss / n_loss_batches)
         mean_loss = [mean_classification_loss, mean_distillation_loss]
 
         print(f'Training set average loss: {(mean_classification_loss + mean_distillation_loss):.6f}, Positives predicted - ({running_positive_predictions}/{running_positive_sampled}), Negatives predicted - ({running_negative_predictions}/{running_negative_sampled})')
 
         train_losses.append(mean_loss)
-        validation_losses.append(mean_validation_loss)
-        validation_accuracy.append(mean_validation_accuracy)
-
-        if save_resume:
-            if checkpoint_directory is not None:
-                checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdisc_student.pth')
-            else:
-                checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdisc_student.pth')
-
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': student_model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'scheduler_state_dict': scheduler.state_dict(),
-                'total_loss_train': train_losses,
-                'total_loss_val': validation_losses,
-                'dice_val': validation_dice,
-                'acc_val': validation_accuracy,
-                'best_val_acc': best_validation_accuracy
-            }, checkpoint_path)
-
-        if save_checkpoint:
-            np.savez(os.path.join(checkpoint_directory, 'losses_cdisc_student.npz'), train_loss=train_losses, val_loss=validation_losses)
-            np.savez(os.path.join(checkpoint_directory, 'validation_acc_cdisc_student.npz'), dice_val=validation_accuracy)
-
-        early_stopping(mean_validation_loss, mean_validation_accuracy, best_validation_accuracy, student_model, epoch, optimizer, scheduler, mean_loss, training_params, weights=save_weights, checkpoint=save_checkpoint, save_condition=save_case, model_path=checkpoint_directory)
-
-        if mean_validation_accuracy > best_validation_accuracy:
-            best_validation_accuracy = mean_validation_accuracy
-
-        if early_stopping.early_stop:
-            print('Patience Reached - Early Stopping Activated.')
-            break
+        if validate:
+            validation_losses.append(mean_validation_loss)
+            validation_accuracy.append(mean_validation_accuracy)
+
+        with timer.time('checkpoint'):
+            if save_resume and utils.is_main_process():
+                if checkpoint_directory is not None:
+                    checkpoint_path = os.path.join(checkpoint_directory, f'tmp_model_{model_key}.pth')
+                else:
+                    checkpoint_path = os.path.join(os.getcwd(), f'tmp_model_{model_key}.pth')
+
+                writer.save({
+                    'epoch': epoch,
+                    'model_state_dict': student_model.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'scheduler_state_dict': scheduler.state_dict(),
+                    'total_loss_train': train_losses,
+                    'total_loss_val': validation_losses,
+                    'dice_val': validation_dice,
+                    'acc_val': validation_accuracy,
+                    'best_val_acc': best_validation_accuracy
+                }, checkpoint_path)
+
+            if validate:
+                early_stopping(mean_validation_loss, mean_validation_accuracy, best_validation_accuracy, student_model, epoch, optimizer, scheduler, mean_loss, training_params, weights=save_weights, checkpoint=save_checkpoint, save_condition=save_case, model_path=checkpoint_directory)
+
+        timings = timer.summary(n_samples)
+        utils.print_epoch_timings(timings, verbose=verbose)
+        for key, value in [('epoch', epoch), *timings.items()]:
+            epoch_timings.setdefault(key, []).append(value)
+
+        if save_checkpoint and utils.is_main_process():
+            # The timings of the epochs (of this run, when resumed) are saved with the losses
+            writer.savez(os.path.join(checkpoint_directory, f'losses_{model_key}.npz'), train_loss=train_losses, val_loss=validation_losses, **epoch_timings)
+            writer.savez(os.path.join(checkpoint_directory, f'validation_acc_{model_key}.npz'), dice_val=validation_accuracy)
+
+        if training_params['Log_timing'] and utils.is_main_process():
+            utils.append_json_line(os.path.join(checkpoint_directory, f'timings_{model_key}.jsonl'), dict(epoch=epoch, **timings))
+
+        if validate:
+            if mean_validation_accuracy > best_validation_accuracy:
+                best_validation_accuracy = mean_validation_accuracy
+
+            if early_stopping.early_stop:
+                print('Patience Reached - Early Stopping Activated.')
+                break
         # sys.exit('Patience Reached - Early Stopping Activated')
 
         torch.cuda.empty_cache()  # Clear memory cache
 
-    if save_resume:
+    # Waits for the pending checkpoints before the models are loaded or the resume checkpoint is removed
+    writer.close()
+
+    if save_resume and utils.is_main_process():
         if checkpoint_directory is not None:
-            checkpoint_path = os.path.join(checkpoint_directory, 'tmp_model_cdisc_student.pth')
+            checkpoint_path = os.path.join(checkpoint_directory, f'tmp_model_{model_key}.pth')
         else:
-            checkpoint_path = os.path.join(os.getcwd(), 'tmp_model_cdisc_student.pth')
+            checkpoint_path = os.path.join(os.getcwd(), f'tmp_model_{model_key}.pth')
         os.remove(checkpoint_path)
 
+    # The other processes wait for the models saved by the main process
+    utils.barrier()
+
     return student_model
 
-def test(test_set, student_model, batch_size, device, criterion, verbose=False):
+def test(test_batches, student_model, device, criterion, precision='float32', verbose=False):
     """
-    :param test_set: test_set
+    :param test_batches: list of the validation batches (utils.cache_batches)
     :param student_model: model
-    :param batch_size: int
     :param device: cpu or gpu (.cuda())
     :param criterion: loss function
+    :param precision: str, autocast precision of the forward passes (float32, bfloat16, float16)
     :param weighted: bool, whether to apply spatial weights in loss function
     :param verbose: bool, display debug messages
     """
@@ -336,7 +520,6 @@ def test(test_set, student_model, batch_size, device, criterion, verbose=False):
     student_model.eval()
 
     softmax = nn.Softmax(dim=1)
-    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False, num_workers=4)
 
     running_loss = 0.0
     running_correct_predictions = 0
@@ -348,24 +531,23 @@ def test(test_set, student_model, batch_size, device, criterion, verbose=False):
     running_negative_sampled = 0
     running_negative_predictions = 0
 
-    n_batches = len(test_loader)
-    # test_set.reset_samples()
+    n_batches = len(test_batches)
 
-    with torch.no_grad():
+    with torch.no_grad(), utils.get_autocast_context(device, precision):
         with tqdm(total=n_batches, desc='evaluating_cdisc', disable=True) as pbar:
 
-            for batch in test_loader:
+            for batch in test_batches:
 
                 x, y = batch['input'], batch['label']
                 x = x.reshape(-1, *x.shape[2:])
                 y = y.reshape(-1, *y.shape[2:])
                 classification_weights = y * 100
 
-                x = x.to(device=device, dtype=torch.float)
-                y = y.to(device=device, dtype=torch.float)
-                classification_weights = classification_weights.to(device=device, dtype=torch.float)
+                x = x.to(device=device, dtype=torch.float, non_blocking=True)
+                y = y.to(device=device, dtype=torch.float, non_blocking=True)
+                classification_weights = classification_weights.to(device=device, dtype=torch.float, non_blocking=True)
 
-                predictions = student_model.forward(x)
+                predictions = student_model.forward(x).float()
 
                 # loss = criterion(predictions, y)
                 loss = criterion(predictions, y, classification_weights)
@@ -396,6 +578,10 @@ def test(test_set, student_model, batch_size, device, criterion, verbose=False):
                 pbar.set_postfix({'loss': f'{loss.item():.6f}', 'accuracy': f'{accuracy:.6f}', 'positives predicted': f'({positives_predicted}/{positives_sampled})'})
                 pbar.update(1)
 
+    # Sums over the validation patches of all the processes of a distributed training
+    running_loss, n_batches, running_correct_predictions, total_samples, running_positive_predictions, running_positive_sampled, running_negative_predictions, running_negative_sampled = \
+        utils.all_reduce_sum([running_loss, n_batches, running_correct_predictions, total_samples, running_positive_predictions, running_positive_sampled, running_negative_predictions, running_negative_sampled], device)
+
     mean_validation_loss = (running_loss / n_batches)  # .cpu().numpy()
     mean_validation_accuracy = running_correct_predictions / total_samples
     print(f'Validation set average loss - {mean_validation_loss:.6f}, Average accuracy - {mean_validation_accuracy:.6f}, Positives predicted - ({running_positive_predictions}/{running_positive_sampled}), Negatives predicted - ({running_negative_predictions}/{running_negative_sampled})')
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import torch
+import atexit
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def snapshot(value):
+    """
+    Copies the tensors (to the CPU), arrays and containers of a checkpoint, so that the training can modify the model,
+    the optimiser and the loss lists while the checkpoint is being written
+    :param value: checkpoint (state_dict, dictionary, list, tensor, array or plain value)
+    :return: copy of the checkpoint
+    """
+
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        copied_value = type(value)((key, snapshot(item)) for key, item in value.items())
+        # Model state_dicts carry the versions of the modules, used when the checkpoint is loaded
+        if hasattr(value, '_metadata'):
+            copied_value._metadata = value._metadata
+        return copied_value
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+
+    return value
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints (torch.save) and metric files (np.savez) on a background thread, so that the training does not wait
+    for the disk. The checkpoints are copied to the CPU when they are submitted, and each file is written to a temporary
+    file that is then renamed, so that an interrupted write never leaves a truncated checkpoint. A write that has not
+    started yet is replaced by a newer write to the same path. Errors of the writes are raised by the next call.
+    """
+
+    def __init__(self):
+        self.pending_writes = OrderedDict()
+        self.writing = False
+        self.error = None
+        self.closed = False
+
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+        # Pending checkpoints are still written if the training exits early
+        atexit.register(self.close)
+
+    def save(self, checkpoint, path):
+        """
+        :param checkpoint: object saved with torch.save
+        :param path: str, checkpoint path
+        """
+        self.submit(path, torch.save, snapshot(checkpoint))
+
+    def savez(self, path, **arrays):
+        """
+        :param path: str, path of the .npz file
+        :param arrays: arrays (or lists) saved with np.savez
+        """
+        self.submit(path, lambda arrays, file: np.savez(file, **arrays), snapshot(arrays))
+
+    def submit(self, path, write_function, checkpoint):
+        with self.condition:
+            self.raise_error()
+            if self.closed:
+                raise ValueError('The checkpoint writer is closed.')
+            # Coalesces the writes to the same path, only the latest checkpoint is written
+            self.pending_writes.pop(path, None)
+            self.pending_writes[path] = (write_function, checkpoint)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending_writes and not self.closed:
+                    self.condition.wait()
+                if not self.pending_writes:
+                    return
+                path, (write_function, checkpoint) = self.pending_writes.popitem(last=False)
+                self.writing = True
+
+            try:
+                temporary_path = f'{path}.tmp'
+                with open(temporary_path, 'wb') as file:
+                    write_function(checkpoint, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temporary_path, path)
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        """
+        Waits until all the submitted checkpoints are written
+        """
+        with self.condition:
+            while self.pending_writes or self.writing:
+                self.condition.wait()
+            self.raise_error()
+
+    def close(self):
+        """
+        Writes the pending checkpoints and stops the writer thread
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
+        atexit.unregister(self.close)
+
+        with self.condition:
+            self.raise_error()
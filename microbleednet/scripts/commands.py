@@ -3,12 +3,20 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import sys
 import subprocess
 import nibabel as nib
 from glob import glob
 from tqdm import tqdm
 
+from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import data_preparation
+from microbleednet.scripts import prune_function
+from microbleednet.scripts import export_function
+from microbleednet.scripts import benchmark_function
+from microbleednet.scripts import quantize_function
+from microbleednet.scripts import compare_function
 from microbleednet.scripts import evaluate_function
 from microbleednet.scripts import cdet_train_function
 from microbleednet.scripts import cdisc_train_function
@@ -197,6 +205,19 @@ def train(args):
     if args.optimizer not in ['adam', 'sgd']:
         raise ValueError('Invalid option for Optimizer. Valid options are: adam, sgd.')
 
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.cdet_init_channels < 1:
+        raise ValueError('No. of CDet channels must be an int and > 1.')
+    if args.cdet_depth < 1 or args.patch_size % (2 ** args.cdet_depth) != 0:
+        raise ValueError('CDet depth must be an int and > 1, and the patch size must be divisible by 2 ** depth.')
+
+    if args.cdet_teacher_model is not None:
+        # Check if the teacher model path is valid
+        if not os.path.isfile(f'{args.cdet_teacher_model}_cdet_model.pth') and not os.path.isfile(f'{args.cdet_teacher_model}_cdet_model_weights.pth'):
+            raise ValueError(f'In directory {os.path.dirname(args.cdet_teacher_model)}, {os.path.basename(args.cdet_teacher_model)}_cdet_model.pth or {os.path.basename(args.cdet_teacher_model)}_cdet_model_weights.pth does not appear to be a valid file.')
+
     if isinstance(args.lr_sch_gamma, float) is False:
         raise ValueError('Learning rate reduction factor must be a float value.')
     elif args.lr_sch_gamma > 1:
@@ -213,8 +234,14 @@ def train(args):
         raise ValueError('Number of epochs must be an int and > 1.')
     if args.batch_factor < 1:
         raise ValueError('Batch factor must be an int and > 1.')
+    if args.num_workers < 0:
+        raise ValueError('Number of workers must be an int and >= 0.')
+    if args.prefetch_factor < 1:
+        raise ValueError('Prefetch factor must be an int and > 1.')
     if args.early_stop_val < 1 or args.early_stop_val > args.num_epochs:
         raise ValueError('Early stopping patience value must be an int and > 1 and < number of epochs.')
+    if args.val_every < 1 or args.val_every > args.num_epochs:
+        raise ValueError('Validation interval must be an int and > 1 and < number of epochs.')
     if args.aug_factor < 1:
         raise ValueError('Augmentation factor must be an int and > 1.')
     if args.cp_save_type not in ['best', 'last', 'everyN']:
@@ -248,7 +275,19 @@ def train(args):
         'Patience': args.early_stop_val,
         'Aug_factor': args.aug_factor,
         'EveryN': args.cp_everyn_N,
-        'SaveResume': args.save_resume_training
+        'SaveResume': args.save_resume_training,
+        'Precision': args.precision,
+        'Cdet_init_channels': args.cdet_init_channels,
+        'Cdet_depth': args.cdet_depth,
+        'Cdet_teacher': args.cdet_teacher_model,
+        'Compile': args.compile_model,
+        'Num_workers': args.num_workers,
+        'Pin_memory': args.pin_memory,
+        'Persistent_workers': args.persistent_workers,
+        'Prefetch_factor': args.prefetch_factor,
+        'Activation_checkpointing': args.activation_checkpointing,
+        'Validate_every': args.val_every,
+        'Log_timing': args.log_timing
     }
 
     if args.verbose:
@@ -266,6 +305,13 @@ def train(args):
     #     if model_directory is None:
     #         raise RuntimeError('Please export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/your/model')
 
+    # Data-parallel training over the processes launched by torchrun (gloo between CPU processes, NCCL between GPUs)
+    if args.multi_gpu:
+        utils.setup_distributed()
+        if not utils.is_main_process():
+            # Only the main process displays the training progress
+            sys.stdout = open(os.devnull, 'w')
+
     # Call main training functions
     if args.cand_detection:
         models = cdet_train_function.main(subjects, training_params, perform_augmentation=args.data_augmentation, save_checkpoint=True, save_weights=save_weights, save_case=args.cp_save_type, verbose=args.verbose, checkpoint_directory=model_directory)
@@ -278,8 +324,19 @@ def train(args):
 
     if args.verbose:
         print('Trained CDisc')
+
+    if args.cand_discrimination_shared:
+        models = cdisc_train_function.main(subjects, training_params, model_directory=model_directory, perform_augmentation=args.data_augmentation, save_checkpoint=True, save_weights=save_weights, save_case=args.cp_save_type, verbose=args.verbose, checkpoint_directory=model_directory, shared_encoder=True)
+
+        if args.verbose:
+            print('Trained shared-encoder CDisc')
+
+    if args.verbose:
         print('Training complete!')
 
+    if args.multi_gpu:
+        utils.cleanup_distributed()
+
 
 #####################################################
 # Define the evaluate sub-command for microbleednet #
@@ -344,20 +401,59 @@ def evaluate(args):
             if model_directory is None:
                 raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
             
-    else:
-        # Check if model paths are valid
-        if not os.path.isfile(f'{args.model_name}_cdet_model_weights.pth'):
-            raise ValueError(f'In directory {os.path.dirname(args.model_name)}, {os.path.basename(args.model_name)}_cdet_model.pth does not appear to be a valid file.')
-        if not os.path.isfile(f'{args.model_name}_cdisc_student_model_weights.pth'):
-            raise ValueError(f'In directory {os.path.dirname(args.model_name)}, {os.path.basename(args.model_name)}_cdisc_student_model.pth does not appear to be a valid file.')
+    elif args.model_variant in ['scripted', 'int8']:
+        # Check if exported model paths are valid
+        if not os.path.isfile(f'{args.model_name}_cdet_model_{args.model_variant}.pt'):
+            raise ValueError(f'In directory {os.path.dirname(args.model_name)}, {os.path.basename(args.model_name)}_cdet_model_{args.model_variant}.pt does not appear to be a valid file. Please run microbleednet export or microbleednet quantize first.')
+        if not os.path.isfile(f'{args.model_name}_cdisc_student_model_{args.model_variant}.pt'):
+            raise ValueError(f'In directory {os.path.dirname(args.model_name)}, {os.path.basename(args.model_name)}_cdisc_student_model_{args.model_variant}.pt does not appear to be a valid file. Please run microbleednet export or microbleednet quantize first.')
+
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
 
+    else:
         model_name = os.path.basename(args.model_name)
         model_directory = os.path.dirname(args.model_name)
 
+        # Check if model paths are valid, in any of the checkpoint formats of the model registry
+        cdisc_key = 'cdisc_shared' if args.cdisc_model == 'shared' else 'cdisc_student'
+        model_registry.resolve_model(model_directory, model_name, 'cdet')
+        model_registry.resolve_model(model_directory, model_name, cdisc_key)
+
+    if args.model_variant not in ['eager', 'scripted', 'int8']:
+        raise ValueError('Invalid option for model variant. Valid options are: eager, scripted, int8')
+
+    if args.cdisc_model not in ['student', 'shared']:
+        raise ValueError('Invalid option for CDisc model. Valid options are: student, shared')
+
+    if args.cdisc_model == 'shared' and args.model_variant != 'eager':
+        raise ValueError('The shared-encoder CDisc model needs the CDet encoder features, it can only be used with -variant eager')
+
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.model_variant == 'int8' and args.precision != 'float32':
+        raise ValueError('The int8 model variant can only be evaluated with -precision float32')
+
+    if args.compile_model and args.model_variant != 'eager':
+        raise ValueError('Only the eager model variant can be compiled, please use -variant eager with -compile')
+
+    if args.jobs < 1:
+        raise ValueError('Number of jobs must be an int and > 1.')
+
+    if args.threads_per_job is not None and args.threads_per_job < 1:
+        raise ValueError('Number of threads per job must be an int and > 1.')
+
     # Create the evaluation parameters dictionary
     evaluation_parameters = {
         'EveryN': args.cp_everyn_N,
         'Modelname': model_name,
+        'Model_variant': args.model_variant,
+        'Precision': args.precision,
+        'Jobs': args.jobs,
+        'Threads_per_job': args.threads_per_job,
+        'Cdisc_model': args.cdisc_model,
+        'Compile': args.compile_model,
     }
 
     if args.verbose:
@@ -379,6 +475,391 @@ def evaluate(args):
     evaluate_function.main(subjects, evaluation_parameters, args.intermediate, model_directory, args.cp_load_type, output_directory, args.verbose)
 
 
+###################################################
+# Define the export sub-command for microbleednet #
+###################################################
+
+def export(args):
+    """
+    :param args: Input arguments from argparse
+    """
+
+    output_directory = args.output_dir
+
+    if args.model_name == 'pre':
+        model_name = 'microbleednet'
+        model_directory = os.path.expandvars('$FSLDIR/data/microbleednet/models')
+
+        if not os.path.exists(model_directory):
+            model_directory = os.environ.get('MICROBLEEDNET_PRETRAINED_MODEL_PATH')
+
+            if model_directory is None:
+                raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
+
+    else:
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
+
+    if output_directory is None:
+        output_directory = model_directory
+
+    # Check if output directory is valid
+    if os.path.isdir(output_directory) is False:
+        raise ValueError(f'{output_directory} does not appear to be a valid directory')
+
+    if args.verbose:
+        parameters = vars(args)
+        print('Input parameters are:')
+        for k, v in parameters.items():
+            print(f'{k:<25} {v}')
+        print()
+
+    # Call the export function
+    export_function.main(model_directory, model_name, output_directory, args.verbose)
+
+
+#####################################################
+# Define the quantize sub-command for microbleednet #
+#####################################################
+
+def quantize(args):
+    """
+    :param args: Input arguments from argparse
+    """
+
+    preprocessed_directory = args.inp_dir
+    output_directory = args.output_dir
+
+    # Check if input directory is valid
+    if not os.path.isdir(preprocessed_directory):
+        raise ValueError(f'{preprocessed_directory} does not appear to be a valid input directory')
+
+    input_directory = os.path.join(preprocessed_directory, 'images')
+    frst_directory = os.path.join(preprocessed_directory, 'frsts')
+
+    input_paths = glob(os.path.join(input_directory, '*_preproc.nii*'))
+
+    # Check if input directory actually contains files
+    if len(input_paths) == 0:
+        raise ValueError(f'{input_directory} does not contain any preprocessed input images / filenames NOT in required format')
+
+    # Check if FRST directory is valid
+    if os.path.isdir(frst_directory) is False:
+        raise ValueError(f'{frst_directory} does not appear to be a valid directory, please preprocess images')
+
+    # Create a list of dictionaries containing required filepaths for the calibration subjects
+    subjects = []
+    for input_path in input_paths:
+
+        basepath = input_path.split('_preproc.nii')[0]
+        basename = basepath.split(os.sep)[-1]
+
+        # Checks if the FRST exists for the current file
+        frst_path = os.path.join(frst_directory, basename + '_frst.nii.gz')
+        if not os.path.isfile(frst_path):
+            raise ValueError(f'FRST does not exist for {basename}')
+
+        subject = {
+            'basename': basename,
+            'input_path': input_path,
+            'frst_path': frst_path,
+        }
+
+        subjects.append(subject)
+
+    if args.model_name == 'pre':
+        model_name = 'microbleednet'
+        model_directory = os.path.expandvars('$FSLDIR/data/microbleednet/models')
+
+        if not os.path.exists(model_directory):
+            model_directory = os.environ.get('MICROBLEEDNET_PRETRAINED_MODEL_PATH')
+
+            if model_directory is None:
+                raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
+
+    else:
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
+
+    if output_directory is None:
+        output_directory = model_directory
+
+    # Check if output directory is valid
+    if os.path.isdir(output_directory) is False:
+        raise ValueError(f'{output_directory} does not appear to be a valid directory')
+
+    if args.num_calibration_patches < 1:
+        raise ValueError('Number of calibration patches must be an int and > 1.')
+
+    if args.verbose:
+        parameters = vars(args)
+        print('Input parameters are:')
+        for k, v in parameters.items():
+            print(f'{k:<25} {v}')
+        print()
+
+    # Call the quantize function
+    quantize_function.main(subjects, model_directory, model_name, output_directory, args.num_calibration_patches, args.verbose)
+
+
+##################################################
+# Define the prune sub-command for microbleednet #
+##################################################
+
+def prune(args):
+    """
+    :param args: Input arguments from argparse
+    """
+
+    preprocessed_directory = args.inp_dir
+    output_directory = args.output_dir
+
+    # Check if input directory is valid
+    if not os.path.isdir(preprocessed_directory):
+        raise ValueError(f'{preprocessed_directory} does not appear to be a valid input directory')
+
+    input_directory = os.path.join(preprocessed_directory, 'images')
+    label_directory = os.path.join(preprocessed_directory, 'labels')
+    frst_directory = os.path.join(preprocessed_directory, 'frsts')
+
+    input_paths = glob(os.path.join(input_directory, '*_preproc.nii*'))
+
+    # Check if input directory actually contains files
+    if len(input_paths) == 0:
+        raise ValueError(f'{input_directory} does not contain any preprocessed input images / filenames NOT in required format')
+
+    # Check if FRST directory is valid
+    if os.path.isdir(frst_directory) is False:
+        raise ValueError(f'{frst_directory} does not appear to be a valid directory, please preprocess images')
+
+    # Check if output directory is valid
+    if os.path.isdir(output_directory) is False:
+        raise ValueError(f'{output_directory} does not appear to be a valid directory')
+
+    # Create a list of dictionaries containing required filepaths for the fine-tuning subjects
+    subjects = []
+    for input_path in input_paths:
+
+        basepath = input_path.split('_preproc.nii')[0]
+        basename = basepath.split(os.sep)[-1]
+
+        # Checks if the manual label exists for the current file
+        label_path = os.path.join(label_directory, basename + '_mask.nii.gz')
+        if args.finetune and not os.path.isfile(label_path):
+            raise ValueError(f'Manual lesion mask does not exist for {basename}')
+
+        # Checks if the FRST exists for the current file
+        frst_path = os.path.join(frst_directory, basename + '_frst.nii.gz')
+        if not os.path.isfile(frst_path):
+            raise ValueError(f'FRST does not exist for {basename}')
+
+        subject = {
+            'basename': basename,
+            'input_path': input_path,
+            'label_path': label_path,
+            'frst_path': frst_path,
+        }
+
+        subjects.append(subject)
+
+    if args.model_name == 'pre':
+        model_name = 'microbleednet'
+        model_directory = os.path.expandvars('$FSLDIR/data/microbleednet/models')
+
+        if not os.path.exists(model_directory):
+            model_directory = os.environ.get('MICROBLEEDNET_PRETRAINED_MODEL_PATH')
+
+            if model_directory is None:
+                raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
+
+    else:
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
+
+    # The pruned models are saved with the microbleednet basename, they must not overwrite the trained models
+    if os.path.abspath(output_directory) == os.path.abspath(model_directory):
+        raise ValueError('The output directory must be different from the directory of the trained models')
+
+    if args.keep_ratio <= 0 or args.keep_ratio > 1:
+        raise ValueError('Proportion of channels to keep must be between 0 and 1.')
+
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.finetune and len(subjects) < 5:
+        raise ValueError('Number of distinct subjects for fine-tuning cannot be less than 5')
+
+    if args.num_epochs < 1:
+        raise ValueError('Number of epochs must be an int and > 1.')
+
+    # Short fine-tuning of all the layers of the pruned models
+    finetune_params = None
+    if args.finetune:
+        finetune_params = {
+            'Finetuning_learning_rate': args.init_learng_rate,
+            'Optimizer': 'adam',
+            'Epsilon': 1e-4,
+            'Momentum': 0.9,
+            'LR_Milestones': [args.num_epochs],
+            'LR_red_factor': 0.1,
+            'Train_prop': 0.8,
+            'Batch_size': args.batch_size,
+            'Num_epochs': args.num_epochs,
+            'Batch_factor': 1,
+            'Patch_size': 48,
+            'Patience': args.num_epochs,
+            'Aug_factor': 2,
+            'EveryN': 10,
+            'Finetuning_layers': list(range(1, 11)),
+            'SaveResume': False,
+            'Precision': args.precision,
+            'Compile': False,
+            'Num_workers': 4,
+            'Pin_memory': True,
+            'Persistent_workers': True,
+            'Prefetch_factor': 2,
+            'Activation_checkpointing': False,
+            'Validate_every': 1,
+            'Log_timing': False,
+            'Cache_frozen_features': False,
+        }
+
+    if args.verbose:
+        parameters = vars(args)
+        print('Input parameters are:')
+        for k, v in parameters.items():
+            print(f'{k:<25} {v}')
+        print()
+
+    # Call the prune function
+    prune_function.main(subjects, model_directory, model_name, output_directory, keep_ratio=args.keep_ratio, finetune_params=finetune_params, verbose=args.verbose)
+
+
+####################################################
+# Define the compare sub-command for microbleednet #
+####################################################
+
+def compare(args):
+    """
+    :param args: Input arguments from argparse
+    """
+
+    preprocessed_directory = args.inp_dir
+
+    # Check if input directory is valid
+    if not os.path.isdir(preprocessed_directory):
+        raise ValueError(f'{preprocessed_directory} does not appear to be a valid input directory')
+
+    input_directory = os.path.join(preprocessed_directory, 'images')
+    frst_directory = os.path.join(preprocessed_directory, 'frsts')
+
+    input_paths = glob(os.path.join(input_directory, '*_preproc.nii*'))
+
+    # Check if input directory actually contains files
+    if len(input_paths) == 0:
+        raise ValueError(f'{input_directory} does not contain any preprocessed input images / filenames NOT in required format')
+
+    # Check if FRST directory is valid
+    if os.path.isdir(frst_directory) is False:
+        raise ValueError(f'{frst_directory} does not appear to be a valid directory, please preprocess images')
+
+    # Create a list of dictionaries containing required filepaths for the input subjects
+    subjects = []
+    for input_path in input_paths:
+
+        basepath = input_path.split('_preproc.nii')[0]
+        basename = basepath.split(os.sep)[-1]
+
+        # Checks if the FRST exists for the current file
+        frst_path = os.path.join(frst_directory, basename + '_frst.nii.gz')
+        if not os.path.isfile(frst_path):
+            raise ValueError(f'FRST does not exist for {basename}')
+
+        subject = {
+            'basename': basename,
+            'input_path': input_path,
+            'frst_path': frst_path,
+        }
+
+        subjects.append(subject)
+
+    if args.model_name == 'pre':
+        model_name = 'microbleednet'
+        model_directory = os.path.expandvars('$FSLDIR/data/microbleednet/models')
+
+        if not os.path.exists(model_directory):
+            model_directory = os.environ.get('MICROBLEEDNET_PRETRAINED_MODEL_PATH')
+
+            if model_directory is None:
+                raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
+
+    else:
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
+
+    if args.model_variant not in ['eager', 'scripted', 'int8']:
+        raise ValueError('Invalid option for model variant. Valid options are: eager, scripted, int8')
+
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.model_variant == 'int8' and args.precision != 'float32':
+        raise ValueError('The int8 model variant can only be evaluated with -precision float32')
+
+    if args.verbose:
+        parameters = vars(args)
+        print('Input parameters are:')
+        for k, v in parameters.items():
+            print(f'{k:<25} {v}')
+        print()
+
+    # Call the compare function, the reference is always the float32 eager model
+    compare_function.main(subjects, model_directory, model_name, reference_variant='eager', test_variant=args.model_variant, reference_precision='float32', test_precision=args.precision, verbose=True)
+
+
+######################################################
+# Define the benchmark sub-command for microbleednet #
+######################################################
+
+def benchmark(args):
+    """
+    :param args: Input arguments from argparse
+    """
+
+    if args.model_name == 'pre':
+        model_name = 'microbleednet'
+        model_directory = os.path.expandvars('$FSLDIR/data/microbleednet/models')
+
+        if not os.path.exists(model_directory):
+            model_directory = os.environ.get('MICROBLEEDNET_PRETRAINED_MODEL_PATH')
+
+            if model_directory is None:
+                raise RuntimeError('Cannot find data; export MICROBLEEDNET_PRETRAINED_MODEL_PATH=/path/to/my/model')
+
+    else:
+        model_name = os.path.basename(args.model_name)
+        model_directory = os.path.dirname(args.model_name)
+
+    if args.batch_size < 1:
+        raise ValueError('Batch size must be an int and > 1.')
+
+    if args.num_repeats < 1:
+        raise ValueError('Number of repeats must be an int and > 1.')
+
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.verbose:
+        parameters = vars(args)
+        print('Input parameters are:')
+        for k, v in parameters.items():
+            print(f'{k:<25} {v}')
+        print()
+
+    # Call the benchmark function
+    benchmark_function.main(model_directory, model_name, batch_size=args.batch_size, repeats=args.num_repeats, precision=args.precision, training=args.training, verbose=args.verbose)
+
+
 ######################################################
 # Define the fine_tune sub-command for microbleednet #
 ######################################################
@@ -451,6 +932,9 @@ def fine_tune(args):
     if args.optimizer not in ['adam', 'sgd']:
         raise ValueError('Invalid option for Optimizer. Valid options are: adam, sgd.')
 
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
     if isinstance(args.lr_sch_gamma, float) is False:
         raise ValueError('Learning rate reduction factor must be a float value.')
     elif args.lr_sch_gamma > 1:
@@ -467,8 +951,14 @@ def fine_tune(args):
         raise ValueError('Number of epochs must be an int and > 1.')
     if args.batch_factor < 1:
         raise ValueError('Batch factor must be an int and > 1.')
+    if args.num_workers < 0:
+        raise ValueError('Number of workers must be an int and >= 0.')
+    if args.prefetch_factor < 1:
+        raise ValueError('Prefetch factor must be an int and > 1.')
     if args.early_stop_val < 1 or args.early_stop_val > args.num_epochs:
         raise ValueError('Early stopping patience value must be an int and > 1 and < number of epochs.')
+    if args.val_every < 1 or args.val_every > args.num_epochs:
+        raise ValueError('Validation interval must be an int and > 1 and < number of epochs.')
     if args.aug_factor < 1:
         raise ValueError('Augmentation factor must be an int and > 1.')
     if args.cp_save_type not in ['best', 'last', 'everyN']:
@@ -529,6 +1019,16 @@ def fine_tune(args):
         'EveryNload': args.cpload_everyn_N,
         'Modelname': model_name,
         'SaveResume': args.save_resume_training,
+        'Precision': args.precision,
+        'Compile': args.compile_model,
+        'Num_workers': args.num_workers,
+        'Pin_memory': args.pin_memory,
+        'Persistent_workers': args.persistent_workers,
+        'Prefetch_factor': args.prefetch_factor,
+        'Activation_checkpointing': args.activation_checkpointing,
+        'Validate_every': args.val_every,
+        'Log_timing': args.log_timing,
+        'Cache_frozen_features': args.cache_frozen_features,
         }
     
     if args.verbose:
@@ -546,7 +1046,7 @@ def fine_tune(args):
         print('Finetuned CDet.')
 
     if args.cand_discrimination:
-        cdisc_finetune_function.main(subjects, finetune_params, aug=args.data_augmentation, save_cp=True, save_wei=save_weights, save_case=args.cp_save_type, verbose=args.verbose, model_dir=model_directory, dir_cp=output_directory)
+        cdisc_finetune_function.main(subjects, finetune_params, perform_augmentation=args.data_augmentation, save_checkpoint=True, save_weights=save_weights, save_case=args.cp_save_type, verbose=args.verbose, model_directory=model_directory, checkpoint_directory=output_directory)
 
     if args.verbose:
         print('Finetuned CDisc.')
@@ -628,6 +1128,14 @@ def cross_validate(args):
     if args.optimizer not in ['adam', 'sgd']:
         raise ValueError('Invalid option for Optimizer: Valid options: adam, sgd')
 
+    if args.precision not in ['float32', 'bfloat16', 'float16']:
+        raise ValueError('Invalid option for precision. Valid options are: float32, bfloat16, float16')
+
+    if args.cdet_init_channels < 1:
+        raise ValueError('No. of CDet channels must be an int and > 1')
+    if args.cdet_depth < 1 or args.patch_size % (2 ** args.cdet_depth) != 0:
+        raise ValueError('CDet depth must be an int and > 1, and the patch size must be divisible by 2 ** depth')
+
     if isinstance(args.lr_sch_gamma, float) is False:
         raise ValueError('Learning rate reduction factor must be a float value')
     elif args.lr_sch_gamma > 1:
@@ -644,8 +1152,14 @@ def cross_validate(args):
         raise ValueError('Number of epochs must be an int and > 1')
     if args.batch_factor < 1:
         raise ValueError('Batch factor must be an int and > 1')
+    if args.num_workers < 0:
+        raise ValueError('Number of workers must be an int and >= 0')
+    if args.prefetch_factor < 1:
+        raise ValueError('Prefetch factor must be an int and > 1')
     if args.early_stop_val < 1 or args.early_stop_val > args.num_epochs:
         raise ValueError('Early stopping patience value must be an int and > 1 and < number of epochs')
+    if args.val_every < 1 or args.val_every > args.num_epochs:
+        raise ValueError('Validation interval must be an int and > 1 and < number of epochs')
     if args.aug_factor < 1:
         raise ValueError('Augmentation factor must be an int and > 1')
     if args.cp_save_type not in ['best', 'last', 'everyN']:
@@ -669,6 +1183,9 @@ def cross_validate(args):
 
     if args.resume_from_fold > args.cv_fold:
         raise ValueError('The fold to resume CV cannot be higher than the total number of folds specified!')
+
+    if args.parallel_folds < 1:
+        raise ValueError('Number of parallel folds must be an int and > 1')
     
     # Inverts the value stored in args.save_full_model and converts it to bool (this is from original code)
     save_weights = args.save_full_model != 'True'
@@ -678,6 +1195,7 @@ def cross_validate(args):
         'Learning_rate': args.init_learng_rate,
         'fold': args.cv_fold,
         'res_fold': args.resume_from_fold,
+        'Parallel_folds': args.parallel_folds,
         'Optimizer': args.optimizer,
         'Epsilon': args.epsilon,
         'Momentum': args.momentum,
@@ -691,7 +1209,18 @@ def cross_validate(args):
         'Patience': args.early_stop_val,
         'Aug_factor': args.aug_factor,
         'EveryN': args.cp_everyn_N,
-        'SaveResume': args.save_resume_training
+        'SaveResume': args.save_resume_training,
+        'Precision': args.precision,
+        'Cdet_init_channels': args.cdet_init_channels,
+        'Cdet_depth': args.cdet_depth,
+        'Compile': args.compile_model,
+        'Num_workers': args.num_workers,
+        'Pin_memory': args.pin_memory,
+        'Persistent_workers': args.persistent_workers,
+        'Prefetch_factor': args.prefetch_factor,
+        'Activation_checkpointing': args.activation_checkpointing,
+        'Validate_every': args.val_every,
+        'Log_timing': args.log_timing
     }
     
     if args.verbose:
@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import numpy as np
+from tqdm import tqdm
+from skimage.measure import label
+
+from microbleednet.scripts import data_preparation
+from microbleednet.scripts import cdet_evaluate_function
+from microbleednet.scripts import cdisc_evaluate_function
+
+
+def lesion_level_agreement(reference_volume, test_volume):
+    """
+    Lesion-level agreement between the predictions of a reference model and a test model
+    :param reference_volume: ndarray, binary prediction of the reference model
+    :param test_volume: ndarray, binary prediction of the test model
+    :return: dictionary with the number of lesions found by each model, lesions found by both and voxel-wise Dice
+    """
+
+    reference_volume = reference_volume > 0
+    test_volume = test_volume > 0
+
+    labelled_reference, n_reference_lesions = label(reference_volume, return_num=True)
+    labelled_test, n_test_lesions = label(test_volume, return_num=True)
+
+    # A lesion is matched if it overlaps with any lesion of the other prediction
+    matched_reference_lesions = len(np.setdiff1d(np.unique(labelled_reference[test_volume]), [0]))
+    matched_test_lesions = len(np.setdiff1d(np.unique(labelled_test[reference_volume]), [0]))
+
+    intersection = np.logical_and(reference_volume, test_volume).sum()
+    dice = (2.0 * intersection + 1.0) / (reference_volume.sum() + test_volume.sum() + 1.0)
+
+    agreement = {
+        'reference_lesions': n_reference_lesions,
+        'test_lesions': n_test_lesions,
+        'matched_reference_lesions': matched_reference_lesions,
+        'matched_test_lesions': matched_test_lesions,
+        'dice': dice,
+    }
+
+    return agreement
+
+
+def predict_subject(subject, model_directory, model_name, model_variant, precision='float32'):
+    """
+    Runs the full CDet -> CDisc -> shape based filtering pipeline on a single subject
+    :param subject: dictionary containing subject filepaths
+    :param model_directory: str, directory containing the models
+    :param model_name: str, basename of the models
+    :param model_variant: str, model to load. Options: eager, scripted, int8
+    :param precision: str, autocast precision of the forward passes. Options: float32, bfloat16, float16
+    :return: ndarray, final binary prediction
+    """
+
+    subject = dict(subject)
+
+    subject = cdet_evaluate_function.main(subject, verbose=False, model_directory=model_directory, model_name=model_name, model_variant=model_variant, precision=precision)
+    subject = cdisc_evaluate_function.main(subject, verbose=False, model_directory=model_directory, model_name=model_name, model_variant=model_variant, precision=precision)
+
+    image, _, _, _ = data_preparation.load_subject(subject)
+    brain_mask = (image > 0).astype(int)
+
+    return data_preparation.shape_based_filtering(subject['cdisc_inference'], brain_mask)
+
+
+def main(subjects, model_directory, model_name='microbleednet', reference_variant='eager', test_variant='int8', test_model_directory=None, reference_precision='float32', test_precision='float32', verbose=True):
+    """
+    Reports the lesion-level agreement between two variants of the same model
+    :param subjects: list of dictionaries containing subject filepaths
+    :param model_directory: str, directory containing the models
+    :param model_name: str, basename of the models
+    :param reference_variant: str, reference model variant (usually the float model)
+    :param test_variant: str, model variant to compare with the reference
+    :param test_model_directory: str, directory containing the test models (default = model_directory)
+    :param reference_precision: str, autocast precision of the reference model
+    :param test_precision: str, autocast precision of the test model
+    :param verbose: bool, display debug messages
+    :return: list of per-subject agreement dictionaries
+    """
+
+    if test_model_directory is None:
+        test_model_directory = model_directory
+
+    reference_name = reference_variant if reference_precision == 'float32' else f'{reference_variant} ({reference_precision})'
+    test_name = test_variant if test_precision == 'float32' else f'{test_variant} ({test_precision})'
+
+    agreements = []
+
+    for subject in tqdm(subjects, leave=False, desc='comparing_models', disable=True):
+
+        reference_prediction = predict_subject(subject, model_directory, model_name, reference_variant, reference_precision)
+        test_prediction = predict_subject(subject, test_model_directory, model_name, test_variant, test_precision)
+
+        agreement = lesion_level_agreement(reference_prediction, test_prediction)
+        agreement['basename'] = subject['basename']
+        agreements.append(agreement)
+
+        if verbose:
+            print(f"{subject['basename']}: {reference_name} lesions - {agreement['reference_lesions']}, {test_name} lesions - {agreement['test_lesions']}, "
+                  f"matched - ({agreement['matched_reference_lesions']}/{agreement['reference_lesions']}), Dice - {agreement['dice']:.4f}")
+
+    n_reference_lesions = sum([agreement['reference_lesions'] for agreement in agreements])
+    n_test_lesions = sum([agreement['test_lesions'] for agreement in agreements])
+    n_matched_reference_lesions = sum([agreement['matched_reference_lesions'] for agreement in agreements])
+    n_matched_test_lesions = sum([agreement['matched_test_lesions'] for agreement in agreements])
+
+    # Full agreement if neither model finds any lesions
+    lesion_sensitivity = n_matched_reference_lesions / n_reference_lesions if n_reference_lesions > 0 else 1.0
+    lesion_precision = n_matched_test_lesions / n_test_lesions if n_test_lesions > 0 else 1.0
+    mean_dice = np.mean([agreement['dice'] for agreement in agreements])
+
+    print(f'Lesion-level agreement of {test_name} with {reference_name}: {n_matched_reference_lesions}/{n_reference_lesions} reference lesions found (sensitivity {lesion_sensitivity:.4f}), '
+          f'{n_matched_test_lesions}/{n_test_lesions} {test_name} lesions confirmed (precision {lesion_precision:.4f}), mean Dice - {mean_dice:.4f}')
+
+    return agreements
+
+
+def cdet_speed_sensitivity_report(subjects, cdet_models, precision='float32', verbose=True):
+    """
+    Compares CDet models (e.g. a distilled student and its teacher) in terms of inference time and lesion-level detection sensitivity
+    :param subjects: list of dictionaries containing subject filepaths, with manual labels
+    :param cdet_models: dictionary of model name: loaded CDet model
+    :param precision: str, autocast precision of the forward passes
+    :param verbose: bool, display per-subject results
+    :return: dictionary of model name: report dictionary
+    """
+
+    # The subjects are loaded once, so that only the model inference is timed
+    loaded_subjects = []
+    for subject in subjects:
+        subject = dict(subject)
+        subject['cached_data'] = data_preparation.load_subject(subject)
+        loaded_subjects.append(subject)
+
+    reports = {}
+
+    for model_name, model in cdet_models.items():
+
+        model.eval()
+        n_lesions = 0
+        n_detected_lesions = 0
+        n_candidates = 0
+        inference_time = 0.0
+
+        for subject in tqdm(loaded_subjects, leave=False, desc='cdet_report', disable=True):
+
+            start_time = time.perf_counter()
+            prediction = cdet_evaluate_function.main(dict(subject), verbose=False, precision=precision, model=model)['cdet_inference']
+            inference_time += time.perf_counter() - start_time
+
+            _, manual_label, _, _ = subject['cached_data']
+            labelled_lesions, n_subject_lesions = label(manual_label > 0, return_num=True)
+            n_subject_detected_lesions = len(np.setdiff1d(np.unique(labelled_lesions[prediction > 0]), [0]))
+            _, n_subject_candidates = label(prediction > 0, return_num=True)
+
+            n_lesions += n_subject_lesions
+            n_detected_lesions += n_subject_detected_lesions
+            n_candidates += n_subject_candidates
+
+            if verbose:
+                print(f"{model_name} - {subject['basename']}: detected ({n_subject_detected_lesions}/{n_subject_lesions}) lesions, {n_subject_candidates} candidates")
+
+        reports[model_name] = {
+            'parameters': sum([p.numel() for p in model.parameters()]),
+            'time_per_subject': inference_time / len(loaded_subjects),
+            'sensitivity': n_detected_lesions / n_lesions if n_lesions > 0 else 1.0,
+            'candidates_per_subject': n_candidates / len(loaded_subjects),
+        }
+
+    for model_name, report in reports.items():
+        print(f"{model_name}: {report['parameters'] / 1e6:.2f} M parameters, {report['time_per_subject']:.2f} s per subject, "
+              f"sensitivity {report['sensitivity']:.4f}, {report['candidates_per_subject']:.1f} candidates per subject")
+
+    return reports
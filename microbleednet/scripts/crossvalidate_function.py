@@ -7,10 +7,13 @@ import torch
 import torch.nn as nn
 from torch import optim
 import os
+import multiprocessing
 import nibabel as nib
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
 from microbleednet.scripts import datasets
 from microbleednet.scripts import cdet_train_function, cdisc_train_function, loss_functions
 from microbleednet.scripts import cdet_evaluate_function
@@ -27,179 +30,223 @@ import microbleednet.scripts.data_preparation as data_preparation
 ###########################################
 
 
-def main(subjects, crossvalidation_params, model_directory=None, perform_augmentation=True, intermediate=False, save_checkpoint=False, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None, output_directory=None):
+def get_fold_subject_ids(n_subjects, fold, folds):
     """
-    The main function for leave-one-out validation of Truenet
-    :param sub_name_dicts: list of dictionaries containing subject filepaths
-    :param cv_params: dictionary of LOO paramaters
-    :param model_dir: str, filepath for leading the teacher model
-    :param aug: bool, whether to do data augmentation
-    :param intermediate: bool, whether to save intermediate results
-    :param save_cp: bool, whether to save checkpoint
-    :param save_wei: bool, whether to save weights alone or the full model
-    :param save_case: str, condition for saving the CP
-    :param verbose: bool, display debug messages
-    :param dir_cp: str, filepath for saving the model
-    :param output_dir: str, filepath for saving the output predictions
+    Splits the subjects into the test subjects of a fold and the remaining (training and validation) subjects
+    :param n_subjects: int, number of subjects
+    :param fold: int, index of the fold [0, folds)
+    :param folds: int, number of folds
+    :return: tuple of test subject indices and remaining subject indices
     """
 
-    assert len(subjects) >= 5, "Number of distinct subjects for Leave-one-out validation cannot be less than 5"
+    subjects_per_fold = max(int(np.round(n_subjects / folds)), 1)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if fold == (folds - 1):
+        test_subject_ids = np.arange(fold * subjects_per_fold, n_subjects)
+    else:
+        test_subject_ids = np.arange(fold * subjects_per_fold, (fold+1) * subjects_per_fold)
 
-    cdet_model = models.CDetNet(n_channels=2, n_classes=2, init_channels=64)
-    cdisc_student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
+    remaining_subject_ids = np.setdiff1d(np.arange(n_subjects), test_subject_ids)
 
-    # cdet_model = nn.DataParallel(cdet_model)
-    # cdisc_student_model = nn.DataParallel(cdisc_student_model)
+    return test_subject_ids, remaining_subject_ids
 
-    cdet_model.to(device=device)
-    cdisc_student_model.to(device=device)
 
-    try:
-        try:
-            teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model.pth')
-            teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='full_model')
-        except:
-            try:
-                teacher_model_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_model_weights.pth')
-                teacher_model = utils.load_model(teacher_model_path, teacher_model, mode='weights')
-            except:
-                ValueError('Teacher Discriminator model not loaded correctly.')
+def create_optimizer(model, crossvalidation_params):
+    """
+    :param model: model
+    :param crossvalidation_params: dictionary of cross-validation parameters
+    :return: optimiser of the trainable parameters of the model
+    """
 
-        if verbose:
-            print('Teacher model loaded.')
-
-        try:
-            teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head.pth')
-            teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='full_model')
-        except:
-            try:
-                teacher_classification_head_path = os.path.join(model_directory, 'microbleednet_cdisc_teacher_classification_head_weights.pth')
-                teacher_classification_head = utils.load_model(teacher_classification_head_path, teacher_classification_head, mode='weights')
-            except:
-                ValueError('Teacher Classification head not loaded correctly.')
+    optimizer = crossvalidation_params['Optimizer']  # adam, sgd
+    learning_rate = crossvalidation_params['Learning_rate']  # scalar (0,1)
 
-        if verbose:
-            print('Teacher classification head loaded.')
+    if optimizer == 'adam':
+        epsilon = crossvalidation_params['Epsilon']
+        return optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=learning_rate, eps=epsilon)
+    elif optimizer == 'sgd':
+        moment = crossvalidation_params['Momentum']
+        return optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=learning_rate, momentum=moment)
+
+
+def run_fold(fold, subjects, cdet_patches_store, crossvalidation_params, model_directory=None, perform_augmentation=True, intermediate=False, save_checkpoint=False, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None, output_directory=None, num_threads=None):
+    """
+    Trains the CDet and CDisc student models of one fold from scratch, and predicts the test subjects of the fold with them.
+    Folds do not share any state, so that they can run in separate processes.
+    :param fold: int, index of the fold [0, folds)
+    :param subjects: list of dictionaries containing subject filepaths
+    :param cdet_patches_store: CDet patches of all the subjects (data_preparation.split_into_nonoverlapping_patches_per_subject)
+    :param crossvalidation_params: dictionary of cross-validation parameters
+    :param model_directory: str, filepath for loading the teacher model
+    :param perform_augmentation: bool, whether to do data augmentation
+    :param intermediate: bool, whether to save intermediate results
+    :param save_checkpoint: bool, whether to save checkpoints
+    :param save_weights: bool, whether to save weights alone or the full model
+    :param save_case: str, condition for saving the checkpoint
+    :param verbose: bool, display debug messages
+    :param checkpoint_directory: str, directory of the fold<k>_models checkpoint directories
+    :param output_directory: str, filepath for saving the output predictions
+    :param num_threads: int, number of CPU threads of the fold, if None the torch default is kept
+    """
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
 
-    except:
-        raise ValueError('Teacher Discriminator models not loaded correctly.')
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     folds = crossvalidation_params['fold']  # scalar [1, N]
-    res_fold = crossvalidation_params['res_fold'] - 1 # scalar [1, N]
-    optimizer = crossvalidation_params['Optimizer']  # adam, sgd
     gamma = crossvalidation_params['LR_red_factor']  # scalar (0,1)
     milestones = crossvalidation_params['LR_Milestones']  # list of integers [1, N]
-    learning_rate = crossvalidation_params['Learning_rate']  # scalar (0,1)
     train_proportion = crossvalidation_params['Train_prop']  # scalar (0,1)
 
     if type(milestones) != list:
         milestones = [milestones]
 
-    subjects_per_fold = max(int(np.round(len(subjects) / folds)), 1)
+    # Every fold starts from newly initialised models and optimisers
+    cdet_model = models.CDetNet(n_channels=2, n_classes=2, init_channels=crossvalidation_params['Cdet_init_channels'], depth=crossvalidation_params['Cdet_depth'])
+    cdisc_student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
 
-    if optimizer == 'adam':
-        epsilon = crossvalidation_params['Epsilon']
-        optimizer_cdet = optim.Adam(filter(lambda p: p.requires_grad, cdet_model.parameters()), lr=learning_rate, eps=epsilon)
-        optimizer_cdisc = optim.Adam(filter(lambda p: p.requires_grad, cdisc_student_model.parameters()), lr=learning_rate, eps=epsilon)
-    elif optimizer == 'sgd':
-        moment = crossvalidation_params['Momentum']
-        optimizer_cdet = optim.SGD(filter(lambda p: p.requires_grad, cdet_model.parameters()), lr=learning_rate, momentum=moment)
-        optimizer_cdisc = optim.SGD(filter(lambda p: p.requires_grad, cdisc_student_model.parameters()), lr=learning_rate, momentum=moment)
+    cdet_model.to(device=device)
+    cdisc_student_model.to(device=device)
+
+    optimizer_cdet = create_optimizer(cdet_model, crossvalidation_params)
+    optimizer_cdisc = create_optimizer(cdisc_student_model, crossvalidation_params)
+
+    teacher_model = model_registry.load_model(model_directory, 'microbleednet', 'cdisc_teacher', device)
+    teacher_classification_head = model_registry.load_model(model_directory, 'microbleednet', 'cdisc_teacher_classification_head', device)
 
     criterion = loss_functions.CombinedLoss()
     distillation_criterion = loss_functions.DistillationLoss()
 
     if verbose:
-        print(f'Found {len(subjects)} subjects')
+        print(f'Training models for fold #{fold + 1}:')
 
-    for fold in tqdm(range(res_fold, folds), leave=False, disable=True):
+    # The subject dictionaries are copied, the CDet predictions of a fold are stored in them
+    test_subject_ids, remaining_subject_ids = get_fold_subject_ids(len(subjects), fold, folds)
+    test_subjects = [dict(subjects[i]) for i in test_subject_ids]
+    remaining_subjects = [dict(subjects[i]) for i in remaining_subject_ids]
 
-        if verbose:
-            print(f'Training models for fold #{fold + 1}:')
+    # The checkpoints, resume checkpoints and metrics of each fold are kept apart
+    fold_checkpoint_directory = os.path.join(checkpoint_directory, f'fold{fold}_models')
+    os.makedirs(fold_checkpoint_directory, exist_ok=True)
 
-        if fold == (folds - 1):
-            test_subject_ids = np.arange(fold * subjects_per_fold, len(subjects))
-            test_subjects = [subjects[i] for i in test_subject_ids]
-        else:
-            test_subject_ids = np.arange(fold * subjects_per_fold, (fold+1) * subjects_per_fold)
-            test_subjects = [subjects[i] for i in test_subject_ids]
+    # Prepping subjects for cdet_train_function, the patches of the remaining subjects are selected from the patches of all the subjects
+    positive_patches_store, negative_patches_store = data_preparation.select_subject_patches(cdet_patches_store, remaining_subject_ids)
 
-        remaining_subject_ids = np.setdiff1d(np.arange(len(subjects)), test_subject_ids)
-        remaining_subjects = [subjects[id] for id in remaining_subject_ids]
+    train_patches_store, validation_patches_store = utils.split_patches(positive_patches_store, negative_patches_store, train_proportion)
+    train_set = datasets.CDetPatchDataset(train_patches_store['positive'], train_patches_store['negative'], ratio='1:1', perform_augmentations=True)
+    validation_set = datasets.CDetPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
 
-        if save_checkpoint:
-            fold_checkpoint_directory = os.path.join(checkpoint_directory, f'fold{fold}_models')
-            os.makedirs(fold_checkpoint_directory, exist_ok=True)
+    scheduler = optim.lr_scheduler.MultiStepLR(optimizer_cdet, milestones, gamma=gamma, last_epoch=-1)
 
-        # Prepping subjects for cdet_train_function
-        positive_patches_store, negative_patches_store = data_preparation.split_into_nonoverlapping_patches_classwise(remaining_subjects, patch_size=48)
+    cdet_model = cdet_train_function.train(train_set, validation_set, cdet_model, criterion, optimizer_cdet, scheduler, crossvalidation_params, device, perform_augmentation, save_checkpoint, save_weights, save_case, verbose, fold_checkpoint_directory)
 
-        train_patches_store, validation_patches_store = utils.split_patches(positive_patches_store, negative_patches_store, train_proportion)
-        train_set = datasets.CDetPatchDataset(train_patches_store['positive'], train_patches_store['negative'], ratio='1:1', perform_augmentations=True)
-        validation_set = datasets.CDetPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
+    # Prepping subjects for cdisc_train_function, with the candidates of the CDet model of the fold
+    remaining_subjects = cdet_evaluate_function.get_cdet_candidates(remaining_subjects, verbose=verbose, precision=crossvalidation_params['Precision'], model=cdet_model)
+    tp_patches_store, fp_patches_store = data_preparation.split_into_patches_centered_on_cmb_classwise(remaining_subjects, patch_size=24)
 
-        scheduler = optim.lr_scheduler.MultiStepLR(optimizer_cdet, milestones, gamma=gamma, last_epoch=-1)
+    train_patches_store, validation_patches_store = utils.split_patches(tp_patches_store, fp_patches_store, train_proportion)
+    train_set = datasets.CDiscPatchDataset(train_patches_store['positive'], train_patches_store['negative'], ratio='1:1', perform_augmentations=True)
+    validation_set = datasets.CDiscPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
 
-        cdet_model = cdet_train_function.train(train_set, validation_set, cdet_model, criterion, optimizer_cdet, scheduler, crossvalidation_params, device, perform_augmentation, save_checkpoint, save_weights, save_case, verbose, checkpoint_directory)
+    scheduler = optim.lr_scheduler.MultiStepLR(optimizer_cdisc, milestones, gamma=gamma, last_epoch=-1)
 
-        # Prepping subjects for cdisc_train_function
-        subjects = cdet_evaluate_function.main(subjects, verbose=verbose, model_directory=checkpoint_directory)
-        tp_patches_store, fp_patches_store = data_preparation.split_into_patches_centered_on_cmb_classwise(subjects, patch_size=24)
+    cdisc_student_model = cdisc_train_function.train(train_set, validation_set, teacher_model, teacher_classification_head, cdisc_student_model, criterion, distillation_criterion, optimizer_cdisc, scheduler, crossvalidation_params, device, perform_augmentation, save_checkpoint, save_weights, save_case, verbose, fold_checkpoint_directory)
 
-        train_patches_store, validation_patches_store = utils.split_patches(tp_patches_store, fp_patches_store, train_proportion)
-        train_set = datasets.CDiscPatchDataset(train_patches_store['negative'], train_patches_store['positive'], ratio='1:1', perform_augmentations=True)
-        validation_set = datasets.CDiscPatchDataset(validation_patches_store['positive'], validation_patches_store['negative'], ratio='1:1')
+    if verbose:
+        print(f'Predicting outputs for subjects in fold {fold + 1}')
 
-        scheduler = optim.lr_scheduler.MultiStepLR(optimizer_cdisc, milestones, gamma=gamma, last_epoch=-1)
+    for subject in tqdm(test_subjects, leave=False, disable=True):
 
-        cdisc_student_model = cdisc_train_function.train(train_set, validation_set, teacher_model, teacher_classification_head, cdisc_student_model, criterion, distillation_criterion, optimizer_cdisc, scheduler, crossvalidation_params, device, perform_augmentation, save_checkpoint, save_weights, save_case, verbose, checkpoint_directory)
+        image_header = nib.load(subject['input_path']).header
+        image_affine = nib.load(subject['input_path']).affine
+        image, label, frst, _ = data_preparation.load_subject(subject)
 
-        if verbose:
-            print(f'Predicting outputs for subjects in fold {fold + 1}')
-
-        for subject in tqdm(test_subjects, leave=False, disable=True):
-
-            image_header = nib.load(subject['input_path']).header
-            image_affine = nib.load(subject['input_path']).affine
-            image, label, frst, _ = data_preparation.load_subject(subject)
-
-            subject = cdet_evaluate_function.main(subject, verbose=False, model_directory=model_directory)
-
-            if intermediate:
-                os.makedirs(os.path.join(output_directory, 'cdet_predictions'), exist_ok=True)
-                save_path = os.path.join(output_directory, 'cdet_predictions', f"predicted_cdet_microbleednet_{subject['basename']}.nii.gz")
-                newhdr = image_header.copy()
-                newaff = image_affine.copy()
-                newobj = nib.nifti1.Nifti1Image(subject['cdet_inference'], affine=newaff, header=newhdr)
-                nib.save(newobj, save_path)
-
-            subject = cdisc_evaluate_function.main(subject, verbose=verbose, model_directory=model_directory)
-
-            if intermediate:
-                os.makedirs(os.path.join(output_directory, 'cdisc_predictions'), exist_ok=True)
-                save_path = os.path.join(output_directory, 'cdisc_predictions', f"predicted_cdisc_microbleednet_{subject['basename']}.nii.gz")
-                newhdr = image_header.copy()
-                newaff
-                newobj = nib.nifti1.Nifti1Image(subject['cdisc_inference'], affine=newaff, header=newhdr)
-                nib.save(newobj, save_path)
-
-            brain_mask = (image > 0).astype(int)
-            subject['final_inference'] = data_preparation.shape_based_filtering(subject['cdisc_inference'], brain_mask)
-
-            if intermediate:
-                os.makedirs(os.path.join(output_directory, 'final_predictions'), exist_ok=True)
-                save_path = os.path.join(output_directory, 'final_predictions', f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
-            else:
-                save_path = os.path.join(output_directory, f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
+        subject = cdet_evaluate_function.main(subject, verbose=False, precision=crossvalidation_params['Precision'], model=cdet_model)
+
+        if intermediate:
+            os.makedirs(os.path.join(output_directory, 'cdet_predictions'), exist_ok=True)
+            save_path = os.path.join(output_directory, 'cdet_predictions', f"predicted_cdet_microbleednet_{subject['basename']}.nii.gz")
+            newhdr = image_header.copy()
+            newaff = image_affine.copy()
+            newobj = nib.nifti1.Nifti1Image(subject['cdet_inference'], affine=newaff, header=newhdr)
+            nib.save(newobj, save_path)
+
+        subject = cdisc_evaluate_function.main(subject, verbose=verbose, precision=crossvalidation_params['Precision'], model=cdisc_student_model)
+
+        if intermediate:
+            os.makedirs(os.path.join(output_directory, 'cdisc_predictions'), exist_ok=True)
+            save_path = os.path.join(output_directory, 'cdisc_predictions', f"predicted_cdisc_microbleednet_{subject['basename']}.nii.gz")
             newhdr = image_header.copy()
             newaff = image_affine.copy()
-            newobj = nib.nifti1.Nifti1Image(subject['final_inference'], affine=newaff, header=newhdr)
+            newobj = nib.nifti1.Nifti1Image(subject['cdisc_inference'], affine=newaff, header=newhdr)
             nib.save(newobj, save_path)
 
+        brain_mask = (image > 0).astype(int)
+        subject['final_inference'] = data_preparation.shape_based_filtering(subject['cdisc_inference'], brain_mask)
+
+        if intermediate:
+            os.makedirs(os.path.join(output_directory, 'final_predictions'), exist_ok=True)
+            save_path = os.path.join(output_directory, 'final_predictions', f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
+        else:
+            save_path = os.path.join(output_directory, f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
+        newhdr = image_header.copy()
+        newaff = image_affine.copy()
+        newobj = nib.nifti1.Nifti1Image(subject['final_inference'], affine=newaff, header=newhdr)
+        nib.save(newobj, save_path)
+
+    if verbose:
+        print(f'Fold {fold + 1}: complete!')
+
+
+def main(subjects, crossvalidation_params, model_directory=None, perform_augmentation=True, intermediate=False, save_checkpoint=False, save_weights=True, save_case='best', verbose=True, checkpoint_directory=None, output_directory=None):
+    """
+    The main function for leave-one-out validation of Truenet
+    :param sub_name_dicts: list of dictionaries containing subject filepaths
+    :param cv_params: dictionary of LOO paramaters
+    :param model_dir: str, filepath for leading the teacher model
+    :param aug: bool, whether to do data augmentation
+    :param intermediate: bool, whether to save intermediate results
+    :param save_cp: bool, whether to save checkpoint
+    :param save_wei: bool, whether to save weights alone or the full model
+    :param save_case: str, condition for saving the CP
+    :param verbose: bool, display debug messages
+    :param dir_cp: str, filepath for saving the model
+    :param output_dir: str, filepath for saving the output predictions
+    """
+
+    assert len(subjects) >= 5, "Number of distinct subjects for Leave-one-out validation cannot be less than 5"
+
+    folds = crossvalidation_params['fold']  # scalar [1, N]
+    res_fold = crossvalidation_params['res_fold'] - 1 # scalar [1, N]
+    parallel_folds = crossvalidation_params['Parallel_folds']  # scalar [1, N]
+
+    if verbose:
+        print(f'Found {len(subjects)} subjects')
+
+    # The CDet patches do not depend on the fold, they are extracted once per subject and each fold selects its subjects
+    cdet_patches_store = data_preparation.split_into_nonoverlapping_patches_per_subject(subjects, patch_size=48)
+    if verbose:
+        print(f"Extracted {len(cdet_patches_store['positive'])} positive and {len(cdet_patches_store['negative'])} negative CDet patches")
+
+    fold_args = (subjects, cdet_patches_store, crossvalidation_params, model_directory, perform_augmentation, intermediate, save_checkpoint, save_weights, save_case, verbose, checkpoint_directory, output_directory)
+
+    if parallel_folds == 1:
+        for fold in tqdm(range(res_fold, folds), leave=False, disable=True):
+            run_fold(fold, *fold_args)
+
+    else:
+        # Each fold process gets an equal share of the CPU threads. The processes are spawned (not forked), so that CUDA
+        # and the DataLoader workers can be used inside the folds.
+        num_threads = max(1, (os.cpu_count() or 1) // parallel_folds)
         if verbose:
-            print(f'Fold {fold + 1}: complete!')
+            print(f'Running {parallel_folds} folds in parallel with {num_threads} threads each')
+
+        with ProcessPoolExecutor(max_workers=parallel_folds, mp_context=multiprocessing.get_context('spawn')) as executor:
+            fold_futures = [executor.submit(run_fold, fold, *fold_args, num_threads=num_threads) for fold in range(res_fold, folds)]
+            for fold_future in fold_futures:
+                # Raises the error of a failed fold
+                fold_future.result()
 
     if verbose:
         print('Cross-validation done!')
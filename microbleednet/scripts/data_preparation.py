@@ -196,6 +196,10 @@ def preprocess_subject(subject):
 
 def load_subject(subject):
 
+    # Volumes already loaded and cropped by the evaluation pipeline
+    if 'cached_data' in subject:
+        return subject['cached_data']
+
     # Load image
     image_path = subject['input_path']
     image = nib.load(image_path).get_fdata()
@@ -371,6 +375,47 @@ def split_into_nonoverlapping_patches_classwise(subjects, patch_size=48):
 
     return positive_patches_store, negative_patches_store
 
+def split_into_nonoverlapping_patches_per_subject(subjects, patch_size=48):
+    """
+    Extracts the positive and negative non-overlapping patches of every subject once, tagged with the index of their
+    subject, so that the patches of any subset of the subjects (e.g. a cross-validation fold) can be selected without
+    reloading the subjects
+    :param subjects: list of dictionaries containing subject filepaths
+    :param patch_size: int
+    :return: dictionary of positive and negative patches, and their subject indices (positive_subject_ids, negative_subject_ids)
+    """
+
+    patches_store = {'positive': [], 'negative': [], 'positive_subject_ids': [], 'negative_subject_ids': []}
+
+    for subject_id, subject in enumerate(subjects):
+
+        positive_patches_store, negative_patches_store = split_into_nonoverlapping_patches_classwise([subject], patch_size)
+
+        patches_store['positive'].extend(positive_patches_store)
+        patches_store['negative'].extend(negative_patches_store)
+        patches_store['positive_subject_ids'].extend([subject_id] * len(positive_patches_store))
+        patches_store['negative_subject_ids'].extend([subject_id] * len(negative_patches_store))
+
+    patches_store['positive_subject_ids'] = np.array(patches_store['positive_subject_ids'], dtype=int)
+    patches_store['negative_subject_ids'] = np.array(patches_store['negative_subject_ids'], dtype=int)
+
+    return patches_store
+
+def select_subject_patches(patches_store, subject_ids):
+    """
+    :param patches_store: dictionary returned by split_into_nonoverlapping_patches_per_subject
+    :param subject_ids: list of subject indices
+    :return: tuple of the positive and negative patches of the subjects
+    """
+
+    positive_indices = np.flatnonzero(np.isin(patches_store['positive_subject_ids'], subject_ids))
+    negative_indices = np.flatnonzero(np.isin(patches_store['negative_subject_ids'], subject_ids))
+
+    positive_patches_store = [patches_store['positive'][idx] for idx in positive_indices]
+    negative_patches_store = [patches_store['negative'][idx] for idx in negative_indices]
+
+    return positive_patches_store, negative_patches_store
+
 def put_patches_into_volume(patches, volume_template, patch_size):
 
     volume = np.zeros_like(volume_template)
@@ -406,6 +451,75 @@ def put_patches_into_volume(patches, volume_template, patch_size):
     
     return volume
 
+def put_feature_patches_into_volume(feature_patches, volume_shape, patch_size, scale=4):
+
+    # Feature patches are downsampled by scale with respect to the image patches
+    n_channels = feature_patches.shape[1]
+    feature_patch_size = patch_size // scale
+    feature_volume_shape = [int(np.ceil(dim / scale)) for dim in volume_shape]
+
+    feature_volume = np.zeros([n_channels] + feature_volume_shape, dtype=feature_patches.dtype)
+
+    num_patches_x = np.ceil(volume_shape[0] / patch_size).astype(int)
+    num_patches_y = np.ceil(volume_shape[1] / patch_size).astype(int)
+    num_patches_z = np.ceil(volume_shape[2] / patch_size).astype(int)
+
+    patch_idx = 0
+    for z in range(num_patches_z):
+        for y in range(num_patches_y):
+            for x in tqdm(range(num_patches_x), leave=False, desc='replacing_feature_patches', disable=True):
+
+                patch_x_start = x * patch_size
+                if x == num_patches_x - 1:
+                    patch_x_start = max(0, volume_shape[0] - patch_size)
+
+                patch_y_start = y * patch_size
+                if y == num_patches_y - 1:
+                    patch_y_start = max(0, volume_shape[1] - patch_size)
+
+                patch_z_start = z * patch_size
+                if z == num_patches_z - 1:
+                    patch_z_start = max(0, volume_shape[2] - patch_size)
+
+                feature_x_start = patch_x_start // scale
+                feature_y_start = patch_y_start // scale
+                feature_z_start = patch_z_start // scale
+                feature_x_end = min(feature_x_start + feature_patch_size, feature_volume_shape[0])
+                feature_y_end = min(feature_y_start + feature_patch_size, feature_volume_shape[1])
+                feature_z_end = min(feature_z_start + feature_patch_size, feature_volume_shape[2])
+
+                feature_volume[:, feature_x_start:feature_x_end, feature_y_start:feature_y_end, feature_z_start:feature_z_end] = feature_patches[patch_idx, :, :(feature_x_end-feature_x_start), :(feature_y_end-feature_y_start), :(feature_z_end-feature_z_start)]
+
+                patch_idx += 1
+
+    return feature_volume
+
+def get_feature_patches_centered_on_cmb(feature_volume, gt, patch_size=24, scale=4):
+
+    # Same candidates and patch placement as get_patches_centered_on_cmb, on the downsampled feature maps
+    labelled_gt = label(gt)
+    dist_properties = regionprops(labelled_gt)
+    n_patches = len(dist_properties)
+
+    n_channels = feature_volume.shape[0]
+    feature_patch_size = patch_size // scale
+    feature_patches = np.zeros([n_patches, n_channels, feature_patch_size, feature_patch_size, feature_patch_size], dtype=feature_volume.dtype)
+
+    for patch_idx in tqdm(range(n_patches), leave=False, desc='get_feature_patches_centered_on_cmb', disable=True):
+
+        centroid = dist_properties[patch_idx].centroid
+        sx = max(0, int(np.round(centroid[0])) - patch_size // 2) // scale
+        sy = max(0, int(np.round(centroid[1])) - patch_size // 2) // scale
+        sz = max(0, int(np.round(centroid[2])) - patch_size // 2) // scale
+        ex = min(feature_volume.shape[1], sx + feature_patch_size)
+        ey = min(feature_volume.shape[2], sy + feature_patch_size)
+        ez = min(feature_volume.shape[3], sz + feature_patch_size)
+
+        feature_patch = feature_volume[:, sx:ex, sy:ey, sz:ez]
+        feature_patches[patch_idx, :, :feature_patch.shape[1], :feature_patch.shape[2], :feature_patch.shape[3]] = feature_patch
+
+    return feature_patches
+
 def get_patches_centered_on_cmb(image, gt, frst=None, patch_size=24):
     
     # label is called gt here because of the conflict with the function 'label'
@@ -457,7 +571,11 @@ def split_into_patches_centered_on_cmb_classwise(subjects, patch_size=24):
 
         image_header = nib.load(subject['input_path']).header
         image, label, frst, _ = load_subject(subject)
-        cdet_prediction = subject['cdet_inference']
+        if 'cdet_candidates' in subject:
+            # Compact candidate maps of cdet_evaluate_function.get_cdet_candidates
+            cdet_prediction = unpack_candidate_map(subject['cdet_candidates'])
+        else:
+            cdet_prediction = subject['cdet_inference']
 
         # Here, if it is true positive, the detected cmb is labelled as 2, else it is labelled as 1
         label = np.minimum((label * 2) + cdet_prediction, 2)
@@ -480,6 +598,37 @@ def split_into_patches_centered_on_cmb_classwise(subjects, patch_size=24):
     
     return tp_patches_store, fp_patches_store
 
+def pack_candidate_map(candidate_map):
+    """
+    Stores a binary CDet candidate map compactly, as the flat indices of its candidate voxels, or as packed bits when
+    more than 1/32 of the voxels are candidates
+    :param candidate_map: ndarray, CDet inference volume
+    :return: dictionary with the shape of the volume and the indices (or bits) of the non-zero voxels
+    """
+
+    candidate_mask = (candidate_map > 0).ravel()
+
+    if 32 * candidate_mask.sum() > candidate_mask.size:
+        return {'shape': np.array(candidate_map.shape), 'bits': np.packbits(candidate_mask)}
+
+    return {'shape': np.array(candidate_map.shape), 'indices': np.flatnonzero(candidate_mask).astype(np.int32)}
+
+def unpack_candidate_map(candidates):
+    """
+    :param candidates: dictionary returned by pack_candidate_map
+    :return: ndarray, binary CDet inference volume
+    """
+
+    n_voxels = int(np.prod(candidates['shape']))
+
+    if 'bits' in candidates:
+        candidate_map = np.unpackbits(candidates['bits'], count=n_voxels).astype(int)
+    else:
+        candidate_map = np.zeros(n_voxels, dtype=int)
+        candidate_map[candidates['indices']] = 1
+
+    return candidate_map.reshape(tuple(candidates['shape']))
+
 def filter_predictions_from_volume(prediction_volume, component_labels):
 
     labelled_prediction_volume = label(prediction_volume)
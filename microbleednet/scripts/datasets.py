@@ -3,12 +3,8 @@ from __future__ import division
 from __future__ import print_function
 
 import torch
-import random
 import numpy as np
-from scipy.ndimage import filters
-from torch.utils.data import Dataset
-
-from microbleednet.scripts import data_preparation
+from torch.utils.data import Dataset, Sampler
 
 #####################################
 # Truenet dataset utility functions #
@@ -17,91 +13,111 @@ from microbleednet.scripts import data_preparation
 #####################################
 
 
-class CDiscPatchDataset(Dataset):
-
-    def __init__(self, minority_class, majority_class, ratio, perform_augmentations=False):
-        self.minority_class = minority_class
-        self.majority_class = majority_class
+class BalancedPatchSampler(Sampler):
+    """
+    Samples balanced groups of patch indices for CDetPatchDataset and CDiscPatchDataset: (minority, majority) for 1:1,
+    (majority, minority, minority) for 2:1 and single patches for random. Each class is drawn from concatenated random
+    permutations, so every patch of a class is used before any of them is drawn again. The groups are computed in the main
+    process, so the datasets are not modified by the DataLoader workers, and they only depend on the seed and the epoch.
+    In a distributed training, every process computes the same groups and keeps every num_replicas-th group, padded so
+    that all the processes run the same number of batches.
+    :param dataset: CDetPatchDataset or CDiscPatchDataset
+    :param seed: int
+    :param num_replicas: int, number of processes of the distributed training
+    :param rank: int, rank of the process
+    """
 
-        self.minority_class_copy = list(minority_class)
-        self.majority_class_copy = list(majority_class)
+    def __init__(self, dataset, seed=0, num_replicas=1, rank=0):
+        self.ratio = dataset.ratio
+        self.n_minority = len(dataset.minority_class)
+        self.n_majority = len(dataset.majority_class)
+        self.num_samples = len(dataset)
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
 
-        self.ratio = ratio
-        self.perform_augmentations = perform_augmentations
+        if self.ratio in ['1:1', '2:1'] and (self.n_minority == 0 or self.n_majority == 0):
+            raise ValueError(f'Balanced {self.ratio} sampling needs patches of both classes, found {self.n_minority} and {self.n_majority} patches.')
 
-        if self.ratio == 'random':
-            self.full_set = self.minority_class + self.majority_class
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
-    def reset_samples(self):
-        if len(self.majority_class) < 2:
-            self.majority_class = list(self.majority_class_copy)
-        if len(self.minority_class) < 2:
-            self.minority_class = list(self.minority_class_copy)
-    
-    def process(self, data):
+    def draw(self, class_id, n_patches, n_draws, offset):
+        # Draws of the current epoch from an endless stream of seeded permutations of the class, so that over the epochs
+        # every patch of the class is drawn once before any of them is drawn again
+        start = self.epoch * n_draws
+        first_permutation = start // n_patches
+        last_permutation = (start + n_draws - 1) // n_patches
 
-        x = data['data_patch']
-        y = data['patch_label']
+        permutations = np.concatenate([np.random.default_rng([self.seed, class_id, idx]).permutation(n_patches) for idx in range(first_permutation, last_permutation + 1)])
+        start = start - first_permutation * n_patches
 
-        x = np.expand_dims(x, 0)
-        y = np.expand_dims(y, 0)
+        return permutations[start:start + n_draws] + offset
 
-        if self.perform_augmentations:
-            x, _= data_preparation.augment_data(x, np.zeros_like(x), n_augmentations=4)
-            y = np.stack([y] * 5, axis=0)
-            y = y[:, 0]
+    def __iter__(self):
 
-        return x, y
+        # The minority class patches come first in the dataset
+        if self.ratio == '1:1':
+            minority_indices = self.draw(0, self.n_minority, self.num_samples, 0)
+            majority_indices = self.draw(1, self.n_majority, self.num_samples, self.n_minority)
+            groups = np.stack([minority_indices, majority_indices], axis=1)
 
-    def sample(self, index):
+        elif self.ratio == '2:1':
+            majority_indices = self.draw(1, self.n_majority, self.num_samples, self.n_minority)
+            minority_indices = self.draw(0, self.n_minority, 2 * self.num_samples, 0)
+            groups = np.concatenate([majority_indices[:, None], minority_indices.reshape(-1, 2)], axis=1)
 
-        if self.ratio == '1:1':
-            x1 = self.minority_class[index]
+        elif self.ratio == 'random':
+            groups = np.random.default_rng([self.seed, 2, self.epoch]).permutation(self.num_samples)[:, None]
 
-            if len(self.majority_class) < 1:
-                self.reset_samples()
+        if self.num_replicas > 1:
+            groups = np.resize(groups, (len(self) * self.num_replicas, groups.shape[1]))[self.rank::self.num_replicas]
 
-            # Take majority_class samples without replacement
-            index = random.randint(0, len(self.majority_class) - 1)
-            x2 = self.majority_class[index]
-            self.majority_class.pop(index)
+        return iter([tuple(group) for group in groups.tolist()])
 
-            samples = [x1, x2]
-        
-        elif self.ratio == '2:1':
+    def __len__(self):
+        return -(-self.num_samples // self.num_replicas)
 
-            if len(self.majority_class) < 1:
-                self.reset_samples()
 
-            index = random.randint(0, len(self.majority_class) - 1)
-            x1 = self.majority_class[index]
-            self.majority_class.pop(index)
+class CDiscPatchDataset(Dataset):
+    """
+    Candidate patches of both classes, indexed by the groups of indices of BalancedPatchSampler. The patches of the
+    datasets created with perform_augmentations=True are augmented on the collated batch (augmentations.augment_batch).
+    """
 
-            if len(self.minority_class) < 2:
-                self.reset_samples()
+    def __init__(self, minority_class, majority_class, ratio, perform_augmentations=False):
+        self.minority_class = list(minority_class)
+        self.majority_class = list(majority_class)
+        self.patches = self.minority_class + self.majority_class
 
-            # Take minority_class samples without replacement
-            index = random.randint(0, len(self.minority_class) - 1)
-            x2 = self.minority_class[index]
-            self.minority_class.pop(index)
+        self.ratio = ratio
+        self.perform_augmentations = perform_augmentations
+    
+    def process(self, data):
 
-            index = random.randint(0, len(self.minority_class) - 1)
-            x3 = self.minority_class[index]
-            self.minority_class.pop(index)
+        x = data['data_patch']
+        y = data['patch_label']
 
-            samples = [x1, x2, x3]
+        x = np.expand_dims(x, 0)
+        y = np.expand_dims(y, 0)
 
-        elif self.ratio == 'random':
-            x = self.full_set[index]
-            samples = [x]
+        if 'teacher_scores' in data:
+            # Patch variants (and teacher scores) precomputed by cdisc_train_function.cache_teacher_scores
+            x = data['data_patch_variants']
+            if 'frozen_features' in data:
+                # Outputs of the frozen layers of the fine-tuned model, see cdisc_train_function.cache_frozen_features
+                x = data['frozen_features']
+            y = np.repeat(y, len(x), axis=0)
+            return x, y, data['teacher_scores']
 
-        return samples
+        return x, y, None
 
-    def __getitem__(self, index):
+    def __getitem__(self, indices):
 
-        samples = self.sample(index)
+        samples = [self.patches[index] for index in indices]
 
-        x_store, y_store = zip(*[self.process(sample) for sample in samples])
+        x_store, y_store, teacher_scores_store = zip(*[self.process(sample) for sample in samples])
 
         x = np.concatenate(x_store, axis=0)
         y = np.concatenate(y_store, axis=0)
@@ -114,6 +130,9 @@ class CDiscPatchDataset(Dataset):
             'label': y,
         }
 
+        if all([teacher_scores is not None for teacher_scores in teacher_scores_store]):
+            data_dict['teacher_scores'] = torch.from_numpy(np.concatenate(teacher_scores_store, axis=0))
+
         return data_dict
 
     def __len__(self):
@@ -122,27 +141,23 @@ class CDiscPatchDataset(Dataset):
         elif self.ratio == '2:1':
             return len(self.minority_class)
         elif self.ratio == 'random':
-            return len(self.full_set)
+            return len(self.patches)
         
 
 class CDetPatchDataset(Dataset):
+    """
+    Patches of both classes, indexed by the groups of indices of BalancedPatchSampler. The patches of the
+    datasets created with perform_augmentations=True are augmented on the collated batch (augmentations.augment_batch).
+    """
 
     def __init__(self, minority_class, majority_class, ratio, perform_augmentations=False):
 
-        self.minority_class = minority_class
-        self.majority_class = majority_class
-
-        self.minority_class_copy = list(minority_class)
-        self.majority_class_copy = list(majority_class)
+        self.minority_class = list(minority_class)
+        self.majority_class = list(majority_class)
+        self.patches = self.minority_class + self.majority_class
 
         self.ratio = ratio
         self.perform_augmentations = perform_augmentations
-
-    def reset_samples(self):
-        if len(self.majority_class) < 2:
-            self.majority_class = list(self.majority_class_copy)
-        if len(self.minority_class) < 2:
-            self.minority_class = list(self.minority_class_copy)
     
     def process(self, data):
 
@@ -154,55 +169,15 @@ class CDetPatchDataset(Dataset):
         y = np.expand_dims(y, 0)
         pixel_weights = np.expand_dims(pixel_weights, 0)
 
-        if self.perform_augmentations:
-            x, y = data_preparation.augment_data(x, y, n_augmentations=4)
-            pixel_weights = filters.gaussian_filter(y, 1.2) * 10
-        
-        y = np.stack((1 - y, y), axis=1)
+        # Class indices instead of one-hot float labels
+        y = y.astype(np.uint8)
         pixel_weights = np.expand_dims(pixel_weights, 1)
 
         return x, y, pixel_weights
-    
-    def sample(self, index):
 
-        if self.ratio == '1:1':
-            x1 = self.minority_class[index]
-
-            # Take majority_class samples without replacement
-            index = random.randint(0, len(self.majority_class) - 1)
-            x2 = self.majority_class[index]
-            self.majority_class.pop(index)
-
-            samples = [x1, x2]
-        
-        elif self.ratio == '2:1':
-
-            if len(self.majority_class) < 1:
-                self.reset_samples()
-
-            index = random.randint(0, len(self.majority_class) - 1)
-            x1 = self.majority_class[index]
-            self.majority_class.pop(index)
-
-            if len(self.minority_class) < 2:
-                self.reset_samples()
-
-            # Take minority_class samples without replacement
-            index = random.randint(0, len(self.minority_class) - 1)
-            x2 = self.minority_class[index]
-            self.minority_class.pop(index)
-
-            index = random.randint(0, len(self.minority_class) - 1)
-            x3 = self.minority_class[index]
-            self.minority_class.pop(index)
-
-            samples = [x1, x2, x3]
-
-        return samples
-
-    def __getitem__(self, index):
+    def __getitem__(self, indices):
 
-        samples = self.sample(index)
+        samples = [self.patches[index] for index in indices]
 
         x_store, y_store, pixel_weights_store = zip(*[self.process(sample) for sample in samples])
 
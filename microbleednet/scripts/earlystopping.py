@@ -6,12 +6,14 @@ import os
 import torch
 import numpy as np
 
+from microbleednet.scripts import utils
+
 class EarlyStoppingModelCheckpointing:
     """
     Early stopping stops the training if the validation loss doesn't improve after a given patience
     """
 
-    def __init__(self, model_name, patience=5, verbose=False):
+    def __init__(self, model_name, patience=5, verbose=False, checkpoint_writer=None):
         
         self.counter = 0
         self.best_score = None
@@ -20,6 +22,8 @@ class EarlyStoppingModelCheckpointing:
         self.model_name = model_name
         self.patience = patience
         self.best_validation_loss = np.inf
+        # Background writer of the checkpoints, if None the checkpoints are saved with torch.save
+        self.checkpoint_writer = checkpoint_writer
 
     def __call__(self, validation_loss, validation_dice, best_validation_dice, model, epoch, optimizer, scheduler, loss, training_params, weights=True, checkpoint=True, save_condition='best', model_path=None):
         
@@ -46,15 +50,19 @@ class EarlyStoppingModelCheckpointing:
 
     def save_checkpoint(self, validation_loss, validation_dice, best_validation_dice, model, epoch, optimizer, scheduler, loss, training_params, weights, checkpoint, save_condition, model_path):
 
+        # In a distributed training, the models are identical in all the processes and only the main process saves them
+        if checkpoint and not utils.is_main_process():
+            return
+
         if checkpoint:
 
             if weights == True:
                 if save_condition == 'best' and validation_dice > best_validation_dice:
-                    torch.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights_bestdice.pth'))
+                    self.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights_bestdice.pth'))
                 elif save_condition == 'everyN' and (epoch % training_params['EveryN']) == 0:
-                    torch.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights_epoch_{epoch}.pth'))
+                    self.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights_epoch_{epoch}.pth'))
                 elif save_condition == 'last':
-                    torch.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights.pth'))
+                    self.save(model.state_dict(), os.path.join(model_path, f'microbleednet_{self.model_name}_model_weights.pth'))
 
                 if self.verbose:
                     print('Saving model (only weights).')
@@ -67,15 +75,19 @@ class EarlyStoppingModelCheckpointing:
                         'scheduler_stat_dict': scheduler.state_dict(),
                         'loss': loss
                     }
+
+                # Lets the loaders rebuild CDet models trained with a non-default width or depth
+                if hasattr(model, 'architecture'):
+                    save_dict['architecture'] = model.architecture
                 
                 if save_condition == 'best' and validation_dice > best_validation_dice:
-                    torch.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_bestdice.pth'))
+                    self.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_bestdice.pth'))
                 
                 elif save_condition == 'everyN' and (epoch % training_params['EveryN']) == 0:
-                    torch.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_epoch_{epoch}.pth'))
+                    self.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_epoch_{epoch}.pth'))
 
                 elif save_condition == 'last':
-                    torch.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_beforeES.pth'))
+                    self.save(save_dict, os.path.join(model_path, f'microbleednet_{self.model_name}_model_beforeES.pth'))
 
                 if self.verbose:
                     print('Saving model (full environment).')
@@ -83,6 +95,12 @@ class EarlyStoppingModelCheckpointing:
         elif self.verbose:
             print('Exiting without saving the model.')
 
+    def save(self, checkpoint, path):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(checkpoint, path)
+        else:
+            torch.save(checkpoint, path)
+
 
 class EarlyStoppingModelCheckpointing2models:
     """
@@ -6,13 +6,16 @@ import os
 import torch
 import numpy as np
 from tqdm import tqdm
+import queue
+import threading
 import nibabel as nib
+import multiprocessing as mp
 
 from microbleednet.scripts import utils
 from microbleednet.scripts import cdet_evaluate_function
 from microbleednet.scripts import cdisc_evaluate_function
+from microbleednet.scripts import cdisc_shared_evaluate_function
 
-import microbleednet.scripts.model_architectures as models
 import microbleednet.scripts.data_preparation as data_preparation
 
 ####################################
@@ -21,6 +24,206 @@ import microbleednet.scripts.data_preparation as data_preparation
 # 09-01-2023                       #
 ####################################
 
+def load_subject_for_evaluation(subject):
+    """
+    Loads and crops the subject volumes, along with the NIfTI information needed to save the predictions
+
+    :param subject: dictionary containing subject filepaths
+    :return: dictionary containing the cropped volumes, crop coordinates and the original header, affine and shape
+    """
+
+    nifti_image = nib.load(subject['input_path'])
+    image, label, frst, crop_coords = data_preparation.load_subject(subject)
+
+    loaded_data = {
+        'image': image,
+        'label': label,
+        'frst': frst,
+        'crop_coords': crop_coords,
+        'header': nifti_image.header.copy(),
+        'affine': nifti_image.affine.copy(),
+        'shape': nifti_image.shape,
+    }
+
+    return loaded_data
+
+def write_volume(data, save_path, volume_shape, crop_coords, affine, header):
+    """
+    Places the cropped data back into the original volume shape and saves it as a NIfTI image
+
+    :param data: ndarray, cropped volume
+    :param save_path: str, output filepath
+    :param volume_shape: tuple, shape of the original image
+    :param crop_coords: crop coordinates returned by data_preparation.load_subject
+    :param affine: ndarray, affine of the original image
+    :param header: NIfTI header of the original image
+    """
+
+    image_to_save = data_preparation.replace_into_volume_shape(volume_shape, data, crop_coords)
+    newobj = nib.nifti1.Nifti1Image(image_to_save, affine=affine.copy(), header=header.copy())
+    nib.save(newobj, save_path)
+
+def save_volume(data, save_path, loaded_data, write_queue=None):
+    """
+    Saves the volume directly, or hands it over to the writer thread if a write queue is given
+    """
+
+    if write_queue is not None:
+        write_queue.put((data, save_path, loaded_data['shape'], loaded_data['crop_coords'], loaded_data['affine'], loaded_data['header']))
+    else:
+        write_volume(data, save_path, loaded_data['shape'], loaded_data['crop_coords'], loaded_data['affine'], loaded_data['header'])
+
+def evaluate_subject(subject, cdet_model, cdisc_student_model, evaluation_parameters, intermediate=False, output_directory=None, verbose=False, loaded_data=None, write_queue=None):
+    """
+    Runs the CDet -> CDisc -> shape based filtering pipeline on a single subject and saves the predictions
+
+    :param subject: dictionary containing subject filepaths
+    :param cdet_model: loaded CDet model
+    :param cdisc_student_model: loaded CDisc student model (or shared-encoder CDisc head if evaluation_parameters['Cdisc_model'] is shared)
+    :param evaluation_parameters: dictionary of evaluation parameters
+    :param intermediate: bool, whether to save intermediate results
+    :param output_directory: str, filepath for saving the output predictions
+    :param verbose: bool, display debug messages
+    :param loaded_data: dictionary returned by load_subject_for_evaluation, if None the subject is loaded here
+    :param write_queue: queue.Queue of the writer thread, if None the predictions are saved here
+    :return: str, basename of the evaluated subject
+    """
+
+    model_name = evaluation_parameters['Modelname']
+    model_variant = evaluation_parameters['Model_variant']
+    precision = evaluation_parameters['Precision']
+    shared_encoder = evaluation_parameters['Cdisc_model'] == 'shared'
+
+    if loaded_data is None:
+        loaded_data = load_subject_for_evaluation(subject)
+
+    image = loaded_data['image']
+
+    # The CDet and CDisc evaluation functions reuse the volumes instead of loading the subject again
+    subject = dict(subject)
+    subject['cached_data'] = (loaded_data['image'], loaded_data['label'], loaded_data['frst'], loaded_data['crop_coords'])
+
+    if intermediate:
+        os.makedirs(os.path.join(output_directory, 'input_images'), exist_ok=True)
+        save_path = os.path.join(output_directory, 'input_images', f"input_microbleednet_{subject['basename']}.nii.gz")
+        save_volume(image, save_path, loaded_data, write_queue)
+
+    subject = cdet_evaluate_function.main(subject, verbose=False, model_name=model_name, model_variant=model_variant, precision=precision, model=cdet_model, return_features=shared_encoder)
+
+    if intermediate:
+        os.makedirs(os.path.join(output_directory, 'cdet_predictions'), exist_ok=True)
+        save_path = os.path.join(output_directory, 'cdet_predictions', f"predicted_cdet_microbleednet_{subject['basename']}.nii.gz")
+        save_volume(subject['cdet_inference'], save_path, loaded_data, write_queue)
+
+    if shared_encoder:
+        # Classifies the candidates from the CDet encoder features, without a second encoder pass
+        subject = cdisc_shared_evaluate_function.main(subject, verbose=verbose, model_name=model_name, precision=precision, model=cdisc_student_model)
+    else:
+        subject = cdisc_evaluate_function.main(subject, verbose=verbose, model_name=model_name, model_variant=model_variant, precision=precision, model=cdisc_student_model)
+
+    if intermediate:
+        os.makedirs(os.path.join(output_directory, 'cdisc_predictions'), exist_ok=True)
+        save_path = os.path.join(output_directory, 'cdisc_predictions', f"predicted_cdisc_microbleednet_{subject['basename']}.nii.gz")
+        save_volume(subject['cdisc_inference'], save_path, loaded_data, write_queue)
+
+    brain_mask = (image > 0).astype(int)
+    subject['final_inference'] = data_preparation.shape_based_filtering(subject['cdisc_inference'], brain_mask)
+
+    if intermediate:
+        os.makedirs(os.path.join(output_directory, 'final_predictions'), exist_ok=True)
+        save_path = os.path.join(output_directory, 'final_predictions', f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
+    else:
+        save_path = os.path.join(output_directory, f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
+
+    save_volume(subject['final_inference'], save_path, loaded_data, write_queue)
+
+    return subject['basename']
+
+def _load_subjects(subjects, load_queue):
+    # Loader thread: prefetches the upcoming subjects, the bounded queue limits how many are held in memory
+    for subject in subjects:
+        try:
+            loaded_data = load_subject_for_evaluation(subject)
+        except Exception as error:
+            load_queue.put((subject, error))
+            return
+        load_queue.put((subject, loaded_data))
+    load_queue.put(None)
+
+def _write_volumes(write_queue, write_errors):
+    # Writer thread: compresses and saves the predictions while the next subject is evaluated
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        try:
+            write_volume(*item)
+        except Exception as error:
+            write_errors.append(error)
+
+def evaluate_subjects_pipelined(subjects, cdet_model, cdisc_student_model, evaluation_parameters, intermediate=False, output_directory=None, verbose=False, prefetch=2):
+    """
+    Evaluates the subjects with a loader thread, inference in the calling thread and a writer thread,
+    so that loading and saving the volumes overlaps with the model computation
+
+    :param subjects: list of dictionaries containing subject filepaths
+    :param cdet_model: loaded CDet model
+    :param cdisc_student_model: loaded CDisc student model
+    :param evaluation_parameters: dictionary of evaluation parameters
+    :param intermediate: bool, whether to save intermediate results
+    :param output_directory: str, filepath for saving the output predictions
+    :param verbose: bool, display debug messages
+    :param prefetch: int, maximum number of loaded subjects waiting to be evaluated
+    """
+
+    load_queue = queue.Queue(maxsize=prefetch)
+    write_queue = queue.Queue(maxsize=4 * prefetch)
+    write_errors = []
+
+    loader = threading.Thread(target=_load_subjects, args=(subjects, load_queue), daemon=True)
+    writer = threading.Thread(target=_write_volumes, args=(write_queue, write_errors), daemon=True)
+    loader.start()
+    writer.start()
+
+    try:
+        with tqdm(total=len(subjects), leave=False, desc='evaluating_subjects', disable=True) as pbar:
+            while True:
+                item = load_queue.get()
+                if item is None:
+                    break
+
+                subject, loaded_data = item
+                if isinstance(loaded_data, Exception):
+                    raise loaded_data
+
+                evaluate_subject(subject, cdet_model, cdisc_student_model, evaluation_parameters, intermediate, output_directory, verbose, loaded_data=loaded_data, write_queue=write_queue)
+                pbar.update(1)
+    finally:
+        # Let the writer finish saving the queued predictions
+        write_queue.put(None)
+        writer.join()
+
+    if len(write_errors) > 0:
+        raise write_errors[0]
+
+
+# Models and arguments shared by the evaluation worker processes, set before forking the workers
+_worker_state = {}
+
+def _initialise_worker(threads_per_job):
+    torch.set_num_threads(threads_per_job)
+
+def _evaluate_subject_in_worker(subject):
+    return evaluate_subject(subject, _worker_state['cdet_model'], _worker_state['cdisc_student_model'], _worker_state['evaluation_parameters'],
+                            _worker_state['intermediate'], _worker_state['output_directory'], _worker_state['verbose'])
+
+def get_subject_size(subject):
+    """
+    :param subject: dictionary containing subject filepaths
+    :return: int, number of voxels in the input image (read from the header only)
+    """
+    return int(np.prod(nib.load(subject['input_path']).shape))
+
 def main(subjects, evaluation_parameters, intermediate=False, model_directory=None, load_case='last', output_directory=None, verbose=False):
     """
     The main function for testing Truenet
@@ -38,97 +241,79 @@ def main(subjects, evaluation_parameters, intermediate=False, model_directory=No
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    cdet_model = models.CDetNet(n_channels=2, n_classes=2, init_channels=64)
-    cdisc_student_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64)
-
-    # cdet_model = nn.DataParallel(cdet_model)
-    # cdisc_student_model = nn.DataParallel(cdisc_student_model)
-
-    cdet_model.to(device=device)
-    cdisc_student_model.to(device=device)
-
     model_name = evaluation_parameters['Modelname']
-        
-    # Load candidate discriminator student model
-    try:
-        student_model_path = os.path.join(model_directory, f'{model_name}_cdisc_student_model.pth')
-        cdisc_student_model = utils.load_model(student_model_path, cdisc_student_model)
-    except:
-        try:
-            student_model_path = os.path.join(model_directory, f'{model_name}_cdisc_student_model_weights.pth')
-            cdisc_student_model = utils.load_model(student_model_path, cdisc_student_model, mode='weights')
-        except ImportError:
-            raise ImportError(f'In directory, {model_directory}, {model_name}_cdisc_student_model.pth or {model_name}_cdisc_student_model_weights.pth does not appear to be a valid model file.')
+    model_variant = evaluation_parameters['Model_variant']
+    jobs = evaluation_parameters['Jobs']
+    threads_per_job = evaluation_parameters['Threads_per_job']
+
+    if model_variant == 'int8':
+        # Quantized models only run on the CPU
+        device = torch.device('cpu')
+
+    if jobs > 1 and device.type == 'cuda':
+        # Forked workers cannot share a CUDA context, the GPU already parallelises within a subject
+        if verbose:
+            print('Parallel evaluation is only supported on the CPU, evaluating subjects sequentially on the GPU')
+        jobs = 1
+
+    if threads_per_job is None:
+        threads_per_job = max(1, (os.cpu_count() or 1) // jobs)
+
+    # Load both models once, they are shared by all subjects (and by all the workers)
+    cdet_model = cdet_evaluate_function.load_cdet_model(model_directory, model_name, model_variant, device)
+    if evaluation_parameters['Cdisc_model'] == 'shared':
+        if cdet_model.init_channels != 64 or cdet_model.depth != 2:
+            raise ValueError(f'The shared-encoder CDisc model requires a CDet model with init_channels=64 and depth=2, got {cdet_model.architecture}')
+        cdisc_student_model = cdisc_shared_evaluate_function.load_cdisc_shared_head(model_directory, model_name, device)
+    else:
+        cdisc_student_model = cdisc_evaluate_function.load_cdisc_student_model(model_directory, model_name, model_variant, device)
+
+    cdet_model.eval()
+    cdisc_student_model.eval()
+
+    # Only the models run on fixed-shape patches are compiled, the shared-encoder head sees variable numbers of candidates
+    # (and calls the CDet encoder and decoder directly, so the compiled forward pass is not used in that case)
+    if evaluation_parameters['Compile']:
+        cdet_model = utils.compile_model(cdet_model)
+        if evaluation_parameters['Cdisc_model'] == 'student':
+            cdisc_student_model = utils.compile_model(cdisc_student_model)
 
     if verbose:
-        # print('Loaded CDisc weights')
         print(f'Found {len(subjects)} subjects')
-        
-    for subject in tqdm(subjects, leave=False, desc='evaluating_subjects', disable=True):
-
-        image_header = nib.load(subject['input_path']).header
-        image_affine = nib.load(subject['input_path']).affine
-        raw_image_shape = nib.load(subject['input_path']).get_fdata().shape
-        image, label, frst, crop_coords = data_preparation.load_subject(subject)
-
-        if intermediate:
-            os.makedirs(os.path.join(output_directory, 'input_images'), exist_ok=True)
-            save_path = os.path.join(output_directory, 'input_images', f"input_microbleednet_{subject['basename']}.nii.gz")
-            newhdr = image_header.copy()
-            newaff = image_affine.copy()
-            image_to_save = data_preparation.replace_into_volume_shape(raw_image_shape, image, crop_coords)
-            newobj = nib.nifti1.Nifti1Image(image_to_save, affine=newaff, header=newhdr)
-            nib.save(newobj, save_path)
-
-        subject = cdet_evaluate_function.main(subject, verbose=False, model_directory=model_directory, model_name=model_name)
-
-        if intermediate:
-            os.makedirs(os.path.join(output_directory, 'cdet_predictions'), exist_ok=True)
-            save_path = os.path.join(output_directory, 'cdet_predictions', f"predicted_cdet_microbleednet_{subject['basename']}.nii.gz")
-            newhdr = image_header.copy()
-            newaff = image_affine.copy()
-            image_to_save = data_preparation.replace_into_volume_shape(raw_image_shape, subject['cdet_inference'], crop_coords)
-            newobj = nib.nifti1.Nifti1Image(image_to_save, affine=newaff, header=newhdr)
-            nib.save(newobj, save_path)
-
-        subject = cdisc_evaluate_function.main(subject, verbose=verbose, model_directory=model_directory, model_name=model_name)
-
-        if intermediate:
-            os.makedirs(os.path.join(output_directory, 'cdisc_predictions'), exist_ok=True)
-            save_path = os.path.join(output_directory, 'cdisc_predictions', f"predicted_cdisc_microbleednet_{subject['basename']}.nii.gz")
-            newhdr = image_header.copy()
-            newaff = image_affine.copy()
-            image_to_save = data_preparation.replace_into_volume_shape(raw_image_shape, subject['cdisc_inference'], crop_coords)
-            newobj = nib.nifti1.Nifti1Image(image_to_save, affine=newaff, header=newhdr)
-            nib.save(newobj, save_path)
-
-        brain_mask = (image > 0).astype(int)
-        subject['final_inference'] = data_preparation.shape_based_filtering(subject['cdisc_inference'], brain_mask)
-
-        if intermediate:
-            os.makedirs(os.path.join(output_directory, 'final_predictions'), exist_ok=True)
-            save_path = os.path.join(output_directory, 'final_predictions', f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
-        else:
-            save_path = os.path.join(output_directory, f"predicted_final_microbleednet_{subject['basename']}.nii.gz")
-
-        newhdr = image_header.copy()
-        newaff = image_affine.copy()
-        image_to_save = data_preparation.replace_into_volume_shape(raw_image_shape, subject['final_inference'], crop_coords)
-        newobj = nib.nifti1.Nifti1Image(image_to_save, affine=newaff, header=newhdr)
-        nib.save(newobj, save_path)
-
-    if verbose:
-        print('Testing complete for all subjects!', flush=True)
-
-
-
-
 
+    if jobs == 1:
+        if evaluation_parameters['Threads_per_job'] is not None:
+            torch.set_num_threads(threads_per_job)
 
+        evaluate_subjects_pipelined(subjects, cdet_model, cdisc_student_model, evaluation_parameters, intermediate, output_directory, verbose)
 
+    else:
+        if verbose:
+            print(f'Evaluating with {jobs} jobs, {threads_per_job} threads per job')
 
+        # Larger subjects first, so that the longest subjects do not end up running alone at the end
+        subjects = sorted(subjects, key=get_subject_size, reverse=True)
 
+        # The weights are moved to shared memory and read by all the workers without being copied
+        cdet_model.share_memory()
+        cdisc_student_model.share_memory()
 
+        _worker_state.update({
+            'cdet_model': cdet_model,
+            'cdisc_student_model': cdisc_student_model,
+            'evaluation_parameters': evaluation_parameters,
+            'intermediate': intermediate,
+            'output_directory': output_directory,
+            'verbose': verbose,
+        })
 
+        context = mp.get_context('fork')
+        with context.Pool(processes=min(jobs, len(subjects)), initializer=_initialise_worker, initargs=(threads_per_job,)) as pool:
+            for basename in tqdm(pool.imap_unordered(_evaluate_subject_in_worker, subjects, chunksize=1), total=len(subjects), leave=False, desc='evaluating_subjects', disable=True):
+                if verbose:
+                    print(f'Evaluated {basename}')
 
+        _worker_state.clear()
 
+    if verbose:
+        print('Testing complete for all subjects!', flush=True)
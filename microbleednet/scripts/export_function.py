@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from microbleednet.scripts import model_registry
+
+
+class ChannelsLastWrapper(nn.Module):
+    """
+    Converts the input to channels_last_3d before calling the wrapped model, so that the
+    exported graph can be fed with the default (contiguous) patches built in the evaluate path.
+    """
+
+    def __init__(self, model):
+        super(ChannelsLastWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last_3d)
+        return self.model(x)
+
+
+def fold_batchnorm(module):
+    """
+    Folds every Conv3d -> BatchNorm3d pair found in the nn.Sequential blocks of the model
+    (DoubleConv, SingleConv) into a single Conv3d. The model must be in eval mode.
+    :param module: nn.Module
+    :return: module with the BatchNorm layers folded into the preceding convolutions
+    """
+
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            layers = list(child)
+            folded_layers = []
+
+            idx = 0
+            while idx < len(layers):
+                if isinstance(layers[idx], nn.Conv3d) and idx + 1 < len(layers) and isinstance(layers[idx + 1], nn.BatchNorm3d):
+                    folded_layers.append(fuse_conv_bn_eval(layers[idx], layers[idx + 1]))
+                    idx += 2
+                else:
+                    folded_layers.append(fold_batchnorm(layers[idx]))
+                    idx += 1
+
+            setattr(module, name, nn.Sequential(*folded_layers))
+        else:
+            fold_batchnorm(child)
+
+    return module
+
+
+def export_model(model, example_input, tolerance=1e-3, verbose=False):
+    """
+    Folds BatchNorm, converts to channels_last_3d and freezes the model into a TorchScript graph
+    :param model: eager model with loaded weights
+    :param example_input: torch.tensor used for tracing and for the equivalence check
+    :param tolerance: float, maximum absolute difference allowed between eager and exported outputs
+    :param verbose: bool, display debug messages
+    :return: frozen torch.jit.ScriptModule
+    """
+
+    model.eval()
+
+    with torch.no_grad():
+        eager_output = model(example_input)
+
+        folded_model = fold_batchnorm(model)
+        folded_model = folded_model.to(memory_format=torch.channels_last_3d)
+        wrapped_model = ChannelsLastWrapper(folded_model).eval()
+
+        traced_model = torch.jit.trace(wrapped_model, example_input)
+        frozen_model = torch.jit.freeze(traced_model)
+
+        exported_output = frozen_model(example_input)
+
+    max_difference = (eager_output - exported_output).abs().max().item()
+    if verbose:
+        print(f'Maximum absolute difference between eager and exported outputs: {max_difference:.2e}')
+
+    if max_difference > tolerance:
+        raise ValueError(f'Exported model is not numerically equivalent to the eager model (max difference {max_difference:.2e} > {tolerance:.2e})')
+
+    return frozen_model
+
+
+def main(model_directory, model_name, output_directory, verbose=False):
+    """
+    The main function for exporting the CDet and CDisc student models for deployment
+    :param model_directory: str, directory containing the trained models
+    :param model_name: str, basename of the trained models
+    :param output_directory: str, directory for saving the exported models
+    :param verbose: bool, display debug messages
+    """
+
+    device = torch.device('cpu')
+
+    cdet_model = model_registry.load_model(model_directory, model_name, 'cdet')
+    cdisc_student_model = model_registry.load_model(model_directory, model_name, 'cdisc_student')
+
+    cdet_model.to(device=device)
+    cdisc_student_model.to(device=device)
+
+    # Patch sizes used by cdet_evaluate_function and cdisc_evaluate_function
+    cdet_input = torch.rand(1, 2, 48, 48, 48, device=device)
+    cdisc_input = torch.rand(1, 2, 24, 24, 24, device=device)
+
+    if verbose:
+        print('Exporting CDet model')
+    exported_cdet_model = export_model(cdet_model, cdet_input, verbose=verbose)
+    torch.jit.save(exported_cdet_model, os.path.join(output_directory, f'{model_name}_cdet_model_scripted.pt'))
+
+    if verbose:
+        print('Exporting CDisc student model')
+    exported_cdisc_student_model = export_model(cdisc_student_model, cdisc_input, verbose=verbose)
+    torch.jit.save(exported_cdisc_student_model, os.path.join(output_directory, f'{model_name}_cdisc_student_model_scripted.pt'))
+
+    if verbose:
+        print('Export complete!')
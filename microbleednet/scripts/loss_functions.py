@@ -70,37 +70,39 @@ class CrossEntropyLoss(nn.Module):
 
 class CombinedLoss(nn.Module):
     """
-    A combination of dice and cross entropy loss
+    A combination of dice and cross entropy loss, computed on the device of the input from integer class labels
     """
 
     def __init__(self):
         super().__init__()
-        self.dice_loss = DiceLoss()
-        self.cross_entropy_loss = CrossEntropyLoss()
 
     def forward(self, input, target, weight=None):
         """
         Forward pass
-        :param input: torch.tensor (NxCxHxW)
-        :param target: torch.tensor (NxHxW)
-        :param weight: torch.tensor (NxHxW), optional
+        :param input: torch.tensor (NxCxHxWxD or NxC)
+        :param target: torch.tensor of class indices (NxHxWxD or N), one-hot targets (NxCxHxWxD or NxC) are converted
+        :param weight: torch.tensor (NxHxWxD), optional
         :return: scalar
         """
-        
-        probabilities_vector = F.softmax(input, dim=1)
-        # mask_vector = (probabilities_vector > 0.5).double()
 
-        dice_loss = self.dice_loss(probabilities_vector[:, 1], target[:, 1])
-        ce_loss = self.cross_entropy_loss(input, target)
+        if target.dim() == input.dim():
+            target = target.argmax(dim=1)
+        target = target.long()
 
-        if weight is not None:
-            ce_loss = ce_loss * weight.view(-1).cuda()
+        # Both terms come from the log-probabilities, no one-hot target or per-voxel loss map is built
+        log_probabilities = F.log_softmax(input, dim=1)
+        ce_loss = F.nll_loss(log_probabilities, target)
 
-        dice_loss = dice_loss.mean()
-        ce_loss = ce_loss.mean()
+        foreground_probabilities = log_probabilities[:, 1].exp()
+        foreground_target = (target == 1)
+        intersection = foreground_probabilities[foreground_target].sum()
+        dice_loss = 1 - (2.0 * intersection + 1.0) / (foreground_probabilities.sum() + foreground_target.sum() + 1.0)
+
+        if weight is not None:
+            # The voxel-averaged cross entropy is scaled by the mean weight, as with the previous nn.CrossEntropyLoss(reduction='mean')
+            ce_loss = ce_loss * weight.to(device=ce_loss.device, dtype=ce_loss.dtype).mean()
 
         return dice_loss + ce_loss
-        # return ce_loss
 
 
 class DistillationLoss(nn.Module):
@@ -133,4 +135,32 @@ class DistillationLoss(nn.Module):
         return (kl_divergence_loss * alpha + ce_loss * (1.0 - alpha))
 
 
+class SegmentationDistillationLoss(nn.Module):
+    """
+    A combination of voxel-wise knowledge distillation and the dice + cross entropy segmentation loss
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.combined_loss = CombinedLoss()
+
+    def forward(self, input, teacher_scores, target, temperature, alpha, weight=None):
+        """
+        Forward pass
+        :param input: torch.tensor (NxCxHxWxD)
+        :param teacher_scores: torch.tensor (NxCxHxWxD)
+        :param target: torch.tensor of class indices (NxHxWxD)
+        :param temperature: scalar
+        :param alpha: scalar
+        :param weight: torch.tensor (NxHxWxD), optional
+        :return: scalar
+        """
+
+        p = F.log_softmax(input / temperature, dim=1)
+        q = F.log_softmax(teacher_scores / temperature, dim=1)
+
+        # KL divergence summed over the classes and averaged over the voxels
+        kl_divergence_loss = F.kl_div(p, q, log_target=True, reduction='none').sum(dim=1).mean() * (temperature ** 2)
+        segmentation_loss = self.combined_loss(input, target, weight=weight)
 
+        return (kl_divergence_loss * alpha + segmentation_loss * (1.0 - alpha))
@@ -17,32 +17,48 @@ class CDetNet(nn.Module):
     """
     Microbleednet Candidate Detection Model definition
     """
-    def __init__(self, n_channels, n_classes, init_channels, bilinear=False):
+    def __init__(self, n_channels, n_classes, init_channels, bilinear=False, depth=2, mid_channels=None):
         super(CDetNet, self).__init__()
         self.n_channels = n_channels
         self.init_channels = init_channels
         self.n_classes = n_classes
         self.n_layers = 3
         self.bilinear = bilinear
+        self.depth = depth
+        # Number of channels between the two convolutions of each (pruned) block, e.g. {'down2': 96}
+        self.mid_channels = mid_channels
+        mid_channels = mid_channels or {}
 
         self.inpconv = model_layers.OutConv(n_channels, 3, name="inpconv_")
-        self.convfirst = model_layers.DoubleConv(3, init_channels, 3, 1, name="convfirst_")
-        self.down1 = model_layers.Down(init_channels, init_channels*2, 3, 1, name="down1_")
-        self.down2 = model_layers.Down(init_channels*2, init_channels*4, 3, 1, name="down2_")
-        self.up2 = model_layers.Up(init_channels*4, init_channels*2, 3, name="up2_", bilinear=bilinear)
-        self.up1 = model_layers.Up(init_channels*2, init_channels, 3, name="up1_", bilinear=bilinear)
+        self.convfirst = model_layers.DoubleConv(3, init_channels, 3, 1, mid_channels=mid_channels.get('convfirst'), name="convfirst_")
+        # The layers are named down1..downN and upN..up1, so that the default depth keeps the original state_dict keys
+        for level in range(1, depth + 1):
+            setattr(self, f'down{level}', model_layers.Down(init_channels * 2 ** (level - 1), init_channels * 2 ** level, 3, 1, mid_channels=mid_channels.get(f'down{level}'), name=f"down{level}_"))
+        for level in range(depth, 0, -1):
+            setattr(self, f'up{level}', model_layers.Up(init_channels * 2 ** level, init_channels * 2 ** (level - 1), 3, name=f"up{level}_", bilinear=bilinear, mid_channels=mid_channels.get(f'up{level}')))
         self.outconv = model_layers.OutConv(init_channels, n_classes, name="outconv_")
 
-    def forward(self, x):
+    @property
+    def architecture(self):
+        return {'init_channels': self.init_channels, 'depth': self.depth, 'mid_channels': self.mid_channels}
+
+    def encode(self, x):
         xi = self.inpconv(x)
-        x1 = self.convfirst(xi)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x = self.up2(x3, x2)
-        x = self.up1(x, x1)
+        features = [self.convfirst(xi)]
+        for level in range(1, self.depth + 1):
+            features.append(getattr(self, f'down{level}')(features[-1]))
+        return features
+
+    def decode(self, features):
+        x = features[-1]
+        for level in range(self.depth, 0, -1):
+            x = getattr(self, f'up{level}')(x, features[level - 1])
         logits = self.outconv(x)
         return logits
 
+    def forward(self, x):
+        return self.decode(self.encode(x))
+
 
 class CDiscNet(nn.Module):
     """
@@ -64,6 +80,14 @@ class CDiscNet(nn.Module):
         self.up1 = model_layers.Up(init_channels * 2, init_channels, 3, bilinear=bilinear, name="up1_")
         self.outconv = model_layers.OutConv(init_channels, n_classes, name="outconv_")
 
+    def encode(self, x):
+        # Encoder only forward pass, the distillation only uses the bottleneck features (up2, up1 and outconv are skipped)
+        xi = self.inpconv(x)
+        x1 = self.convfirst(xi)
+        x2 = self.down1(x1)
+        x3 = self.down2(x2)
+        return x3
+
     def forward(self, x):
         xi = self.inpconv(x)
         x1 = self.convfirst(xi)
@@ -162,22 +186,25 @@ class CDiscClass48(nn.Module):
 
 
 class CDiscStudentNet(nn.Module):
-    def __init__(self, n_channels, n_classes, init_channels, bilinear=False):
+    def __init__(self, n_channels, n_classes, init_channels, bilinear=False, mid_channels=None):
         super(CDiscStudentNet, self).__init__()
         self.n_channels = n_channels
         self.init_channels = init_channels
         self.n_classes = n_classes
         self.n_layers = 3
         self.bilinear = bilinear
+        # Number of channels between the two convolutions of each (pruned) block, e.g. {'classdown1': 64}
+        self.mid_channels = mid_channels
+        mid_channels = mid_channels or {}
 
         self.inpconv = model_layers.OutConv(n_channels, 3, name="inpconv_")
-        self.convfirst = model_layers.DoubleConv(3, init_channels, 3, 1, name="convfirst_")
-        self.down1 = model_layers.Down(init_channels, init_channels * 2, 3, 1, name="down1_")
-        self.down2 = model_layers.Down(init_channels * 2, init_channels * 4, 3, 1, name="down2_")
+        self.convfirst = model_layers.DoubleConv(3, init_channels, 3, 1, mid_channels=mid_channels.get('convfirst'), name="convfirst_")
+        self.down1 = model_layers.Down(init_channels, init_channels * 2, 3, 1, mid_channels=mid_channels.get('down1'), name="down1_")
+        self.down2 = model_layers.Down(init_channels * 2, init_channels * 4, 3, 1, mid_channels=mid_channels.get('down2'), name="down2_")
 
         self.classconvfirst = model_layers.SingleConv(init_channels * 4, init_channels * 2, 1, name="clconvfirst_")
-        self.classdown1 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, name="down1_")
-        self.classdown2 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, name="down2_")
+        self.classdown1 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, mid_channels=mid_channels.get('classdown1'), name="down1_")
+        self.classdown2 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, mid_channels=mid_channels.get('classdown2'), name="down2_")
         # self.down3 = Down(init_channels, init_channels//2, 1)
         self.fc1 = nn.Linear(512 * 2, 128)
         self.fc2 = nn.Linear(128, 32)
@@ -191,10 +218,101 @@ class CDiscStudentNet(nn.Module):
         xi = self.classconvfirst(x3)
         x1 = self.classdown1(xi)
         x1 = self.classdown2(x1)
-        x1 = x1.view(-1, 512 * 2)
+        x1 = x1.reshape(-1, 512 * 2)
         x1 = self.fc1(x1)
         x1 = self.fc2(x1)
         x1 = self.fc3(x1)
         # x1 = torch.sigmoid(x1)
         return x1
 
+    # The layers in the order of the forward pass, the fine-tuned layers are counted from the end
+    layer_order = ['inpconv', 'convfirst', 'down1', 'down2', 'classconvfirst', 'classdown1', 'classdown2', 'fc1', 'fc2', 'fc3']
+
+    def forward_layers(self, x, first=0, last=None):
+        # Runs the layers layer_order[first:last] only, forward(x) == forward_layers(forward_layers(x, 0, n), n)
+        for name in self.layer_order[first:last]:
+            if name == 'fc1':
+                x = x.reshape(-1, 512 * 2)
+            x = getattr(self, name)(x)
+        return x
+
+    @property
+    def architecture(self):
+        return {'init_channels': self.init_channels, 'mid_channels': self.mid_channels}
+
+
+class CDiscSharedHead(nn.Module):
+    """
+    Microbleednet Candidate Discrimination head on the CDet encoder features.
+    Takes the (init_channels * 4) x 6 x 6 x 6 region of the CDet down2 feature maps covering a 24 x 24 x 24 candidate patch.
+    """
+    def __init__(self, n_classes, init_channels):
+        super(CDiscSharedHead, self).__init__()
+        self.init_channels = init_channels
+        self.n_classes = n_classes
+
+        self.classconvfirst = model_layers.SingleConv(init_channels * 4, init_channels * 2, 1, name="clconvfirst_")
+        self.classdown1 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, name="down1_")
+        self.classdown2 = model_layers.Down(init_channels * 2, init_channels * 2, 3, 3, name="down2_")
+        self.fc1 = nn.Linear(512 * 2, 128)
+        self.fc2 = nn.Linear(128, 32)
+        self.fc3 = nn.Linear(32, n_classes)
+
+    def forward(self, x):
+        xi = self.classconvfirst(x)
+        x1 = self.classdown1(xi)
+        x1 = self.classdown2(x1)
+        x1 = x1.reshape(-1, 512 * 2)
+        x1 = self.fc1(x1)
+        x1 = self.fc2(x1)
+        x1 = self.fc3(x1)
+        return x1
+
+
+class CDiscSharedNet(nn.Module):
+    """
+    Frozen CDet encoder followed by the shared candidate discrimination head, used to train the head on 24 x 24 x 24 patches.
+    Only the head is trained and saved, the encoder weights come from the CDet checkpoint.
+    """
+    def __init__(self, cdet_model, n_classes, init_channels):
+        super(CDiscSharedNet, self).__init__()
+        # The head is built for the down2 features of the default CDet architecture
+        if cdet_model.init_channels != init_channels or cdet_model.depth != 2:
+            raise ValueError(f'The shared candidate discrimination head requires a CDet model with init_channels={init_channels} and depth=2, got {cdet_model.architecture}')
+
+        self.encoder = cdet_model
+        self.head = CDiscSharedHead(n_classes, init_channels)
+
+        for param in self.encoder.parameters():
+            param.requires_grad = False
+
+    def train(self, mode=True):
+        super(CDiscSharedNet, self).train(mode)
+        # The BatchNorm statistics of the CDet encoder must stay the same as in detection
+        self.encoder.eval()
+        return self
+
+    def state_dict(self, *args, **kwargs):
+        return self.head.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, state_dict, strict=True):
+        return self.head.load_state_dict(state_dict, strict)
+
+    def forward(self, x):
+        features = self.encoder.encode(x)
+        return self.head(features[2])
+
+
+class FrozenPrefixNet(nn.Module):
+    """
+    Trainable layers of a fine-tuned model (CDiscStudentNet), run on the stored outputs of its frozen leading layers
+    (see cdisc_train_function.cache_frozen_features) instead of on the patches.
+    Only the training passes go through it, the whole model is still the one validated and saved.
+    """
+    def __init__(self, model, n_frozen_layers):
+        super(FrozenPrefixNet, self).__init__()
+        self.model = model
+        self.n_frozen_layers = n_frozen_layers
+
+    def forward(self, x):
+        return self.model.forward_layers(x, first=self.n_frozen_layers)
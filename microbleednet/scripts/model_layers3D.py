@@ -9,6 +9,32 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def run_checkpointed(module, function, *inputs):
+    """
+    Runs function(*inputs) without keeping its intermediate activations for the backward pass, they are recomputed
+    during the backward pass instead (activation checkpointing). The BatchNorm running statistics of the module are
+    only updated by the forward pass, and restored after the recomputation.
+    """
+    recomputing = [False]
+
+    def run(*inputs):
+        if not recomputing[0]:
+            recomputing[0] = True
+            return function(*inputs)
+
+        # The recomputation can be stopped early (once the saved activations are recomputed), hence the finally
+        buffers = [buffer.clone() for buffer in module.buffers()]
+        try:
+            return function(*inputs)
+        finally:
+            with torch.no_grad():
+                for buffer, saved_buffer in zip(module.buffers(), buffers):
+                    buffer.copy_(saved_buffer)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
 
 
 class SingleConv(nn.Module):
@@ -45,40 +71,55 @@ class DoubleConv(nn.Module):
             nn.BatchNorm3d(out_channels),
             nn.ReLU(inplace=True)
         )
+        # Activation checkpointing in training (see run_checkpointed)
+        self.checkpointing = False
 
     def forward(self, x):
+        if self.checkpointing and torch.is_grad_enabled():
+            return run_checkpointed(self, self.double_conv, x)
         return self.double_conv(x)
 
 
 class Down(nn.Module):
     """Downscaling with maxpool then double conv"""
 
-    def __init__(self, in_channels, out_channels, kernel_size1, kernel_size2, name=None):
+    def __init__(self, in_channels, out_channels, kernel_size1, kernel_size2, mid_channels=None, name=None):
         super().__init__()
         self.maxpool_conv = nn.Sequential(
             nn.MaxPool3d(2),
-            DoubleConv(in_channels, out_channels, kernel_size1, kernel_size2)
+            DoubleConv(in_channels, out_channels, kernel_size1, kernel_size2, mid_channels=mid_channels)
         )
+        # Activation checkpointing in training (see run_checkpointed)
+        self.checkpointing = False
 
     def forward(self, x):
+        if self.checkpointing and torch.is_grad_enabled():
+            return run_checkpointed(self, self.maxpool_conv, x)
         return self.maxpool_conv(x)
 
 
 class Up(nn.Module):
     """Upscaling then double conv"""
 
-    def __init__(self, in_channels, out_channels, kernel_size, bilinear=True, name=None):
+    def __init__(self, in_channels, out_channels, kernel_size, bilinear=True, mid_channels=None, name=None):
         super().__init__()
 
         # if bilinear, use the normal convolutions to reduce the number of channels
         if bilinear:
             self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-            self.conv = DoubleConv(in_channels, out_channels, 3, 1, mid_channels=in_channels // 2)
+            self.conv = DoubleConv(in_channels, out_channels, 3, 1, mid_channels=mid_channels or in_channels // 2)
         else:
             self.up = nn.ConvTranspose3d(in_channels, in_channels // 2, kernel_size=kernel_size, stride=2)
-            self.conv = DoubleConv(in_channels, out_channels, 3, 1)
+            self.conv = DoubleConv(in_channels, out_channels, 3, 1, mid_channels=mid_channels)
+        # Activation checkpointing in training (see run_checkpointed)
+        self.checkpointing = False
 
     def forward(self, x1, x2):
+        if self.checkpointing and torch.is_grad_enabled():
+            return run_checkpointed(self, self.upsample_conv, x1, x2)
+        return self.upsample_conv(x1, x2)
+
+    def upsample_conv(self, x1, x2):
         # print(x1.size())
         x1 = self.up(x1)
         # input is CHW
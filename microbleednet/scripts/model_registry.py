@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from microbleednet.scripts import utils
+from microbleednet.scripts import model_architectures as models
+
+
+def build_cdet_model(architecture):
+    return models.CDetNet(n_channels=2, n_classes=2, init_channels=architecture['init_channels'], depth=architecture['depth'], mid_channels=architecture.get('mid_channels'))
+
+def build_cdisc_student_model(architecture):
+    return models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=architecture['init_channels'], mid_channels=architecture.get('mid_channels'))
+
+# Model key: file stem (after the model name), function inferring the architecture from a state_dict (None for the
+# fixed architectures) and function building the model
+MODEL_SPECS = {
+    'cdet': ('cdet_model', utils.get_cdet_architecture, build_cdet_model),
+    'cdisc_student': ('cdisc_student_model', utils.get_cdisc_student_architecture, build_cdisc_student_model),
+    'cdisc_teacher': ('cdisc_teacher_model', None, lambda architecture: models.CDiscNet(n_channels=2, n_classes=2, init_channels=64)),
+    'cdisc_teacher_classification_head': ('cdisc_teacher_classification_head', None, lambda architecture: models.CDiscClass24(n_channels=2, n_classes=2, init_channels=256)),
+    'cdisc_shared': ('cdisc_shared_model', None, lambda architecture: models.CDiscSharedHead(n_classes=2, init_channels=64)),
+}
+
+# Checkpoint formats, in order of preference: file suffix (after the file stem) and loading mode
+CHECKPOINT_FORMATS = [
+    ('.safetensors', 'safetensors'),
+    ('.pth', 'full_model'),
+    ('_weights.pth', 'weights'),
+]
+
+# Registry of the resolved checkpoints: (model directory, model name, model key): entry dictionary
+_registry = {}
+
+
+def resolve_model(model_directory, model_name, model_key):
+    """
+    Resolves a model to a single checkpoint file, without loading it
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param model_key: str, cdet, cdisc_student, cdisc_teacher, cdisc_teacher_classification_head or cdisc_shared
+    :return: dictionary with the path and format of the checkpoint, and the architecture once the checkpoint has been loaded
+    """
+
+    if model_key not in MODEL_SPECS:
+        raise ValueError(f'Unknown model {model_key}, options: {", ".join(MODEL_SPECS.keys())}')
+
+    registry_key = (os.path.abspath(model_directory), model_name, model_key)
+    if registry_key in _registry and os.path.isfile(_registry[registry_key]['path']):
+        return _registry[registry_key]
+
+    file_stem, _, _ = MODEL_SPECS[model_key]
+    for suffix, checkpoint_format in CHECKPOINT_FORMATS:
+        checkpoint_path = os.path.join(model_directory, f'{model_name}_{file_stem}{suffix}')
+        if os.path.isfile(checkpoint_path):
+            _registry[registry_key] = {'path': checkpoint_path, 'format': checkpoint_format, 'architecture': None}
+            return _registry[registry_key]
+
+    filenames = ' or '.join([f'{model_name}_{file_stem}{suffix}' for suffix, _ in CHECKPOINT_FORMATS])
+    raise ValueError(f'In directory, {model_directory}, {filenames} does not appear to be a valid model file.')
+
+def load_model(model_directory, model_name, model_key, device=None):
+    """
+    Builds a model with the architecture of its checkpoint and loads its weights. The checkpoint is memory-mapped and
+    loaded with weights_only=True (see utils.load_checkpoint_with_architecture), and cached for the lifetime of the process.
+    Safetensors checkpoints can store the architecture as a JSON string under the 'architecture' metadata key.
+    :param model_directory: str, directory containing the model
+    :param model_name: str, basename of the model
+    :param model_key: str, cdet, cdisc_student, cdisc_teacher, cdisc_teacher_classification_head or cdisc_shared
+    :param device: cpu() or cuda(), if None the model is left on the CPU
+    :return: model
+    """
+
+    entry = resolve_model(model_directory, model_name, model_key)
+    _, get_architecture, build_model = MODEL_SPECS[model_key]
+
+    state_dict, architecture = utils.load_checkpoint_with_architecture(entry['path'], entry['format'])
+
+    if architecture is None and get_architecture is not None:
+        architecture = get_architecture(state_dict)
+    entry['architecture'] = architecture
+
+    model = build_model(architecture)
+    model.load_state_dict(state_dict)
+
+    if device is not None:
+        model = model.to(device)
+
+    return model
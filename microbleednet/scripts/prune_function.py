@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import torch
+import torch.nn as nn
+from collections import OrderedDict
+
+from microbleednet.scripts import utils
+from microbleednet.scripts import model_registry
+from microbleednet.scripts import cdet_finetune_function
+from microbleednet.scripts import cdisc_finetune_function
+from microbleednet.scripts import model_architectures as models
+
+
+def get_flops(model, example_input):
+    """
+    Counts the multiply-accumulate operations of the convolutions and fully connected layers for one forward pass
+    :param model: eager model
+    :param example_input: torch.tensor, input of the forward pass
+    :return: int, number of multiply-accumulate operations
+    """
+
+    flops = []
+
+    def count_flops(module, inputs, output):
+        if isinstance(module, nn.Conv3d):
+            flops.append(output.numel() * module.weight[0].numel())
+        elif isinstance(module, nn.ConvTranspose3d):
+            flops.append(inputs[0].numel() * module.weight[0].numel())
+        elif isinstance(module, nn.Linear):
+            flops.append(output.numel() * module.in_features)
+
+    hooks = [module.register_forward_hook(count_flops) for module in model.modules() if isinstance(module, (nn.Conv3d, nn.ConvTranspose3d, nn.Linear))]
+
+    model.eval()
+    with torch.no_grad():
+        model(example_input)
+
+    for hook in hooks:
+        hook.remove()
+
+    return sum(flops)
+
+
+def measure_latency(model, example_input, repeats=5):
+    """
+    Average time of a forward pass of the model
+    :param model: eager model
+    :param example_input: torch.tensor, input of the forward pass
+    :param repeats: int, number of timed forward passes
+    :return: float, seconds per forward pass
+    """
+
+    model.eval()
+    with torch.no_grad():
+        # Warm-up pass, not timed
+        model(example_input)
+
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            model(example_input)
+
+    return (time.perf_counter() - start_time) / repeats
+
+
+def prune_state_dict(state_dict, keep_ratio):
+    """
+    Removes the least important channels between the two convolutions of every DoubleConv block. The importance of a
+    channel is the magnitude of its BatchNorm scale (gamma). The input and output channels of the blocks are unchanged,
+    so that the skip connections and the fully connected layers keep their shapes.
+    :param state_dict: state_dict of the trained model
+    :param keep_ratio: float (0, 1], proportion of the channels kept in each block
+    :return: tuple of pruned state_dict and dictionary of block name: number of channels kept
+    """
+
+    pruned_state_dict = OrderedDict(state_dict)
+    mid_channels = {}
+
+    for key in state_dict:
+        if not key.endswith('double_conv.1.weight'):
+            continue
+
+        prefix = key[:-len('1.weight')]
+        importance = state_dict[key].abs()
+
+        n_kept_channels = max(1, int(round(keep_ratio * len(importance))))
+        kept_channels = torch.sort(torch.argsort(importance, descending=True)[:n_kept_channels]).values
+
+        # First convolution and its BatchNorm lose output channels, the second convolution loses the matching input channels
+        for name in ['0.weight', '0.bias', '1.weight', '1.bias', '1.running_mean', '1.running_var']:
+            pruned_state_dict[prefix + name] = state_dict[prefix + name][kept_channels].clone()
+        pruned_state_dict[prefix + '3.weight'] = state_dict[prefix + '3.weight'][:, kept_channels].clone()
+
+        mid_channels[key.split('.')[0]] = n_kept_channels
+
+    return pruned_state_dict, mid_channels
+
+
+def prune_model(model, keep_ratio):
+    """
+    Builds the pruned version of a CDet or CDisc student model
+    :param model: CDetNet or CDiscStudentNet with loaded weights
+    :param keep_ratio: float (0, 1], proportion of the channels kept in each block
+    :return: pruned model
+    """
+
+    pruned_state_dict, mid_channels = prune_state_dict(model.state_dict(), keep_ratio)
+
+    if isinstance(model, models.CDetNet):
+        pruned_model = models.CDetNet(n_channels=2, n_classes=2, init_channels=model.init_channels, depth=model.depth, mid_channels=mid_channels)
+    else:
+        pruned_model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=model.init_channels, mid_channels=mid_channels)
+
+    pruned_model.load_state_dict(pruned_state_dict)
+
+    return pruned_model
+
+
+def save_pruned_model(model, output_directory, model_key):
+    """
+    Saves the weights of the pruned model, and a full checkpoint with its architecture
+    :param model: pruned model
+    :param output_directory: str, directory for saving the pruned model
+    :param model_key: str, cdet or cdisc_student
+    """
+
+    torch.save(model.state_dict(), os.path.join(output_directory, f'microbleednet_{model_key}_model_weights.pth'))
+    torch.save({'model_state_dict': model.state_dict(), 'architecture': model.architecture}, os.path.join(output_directory, f'microbleednet_{model_key}_model.pth'))
+
+
+def main(subjects, model_directory, model_name, output_directory, keep_ratio=0.5, finetune_params=None, verbose=False):
+    """
+    The main function for channel pruning of the CDet and CDisc student models, followed by a short fine-tuning
+    :param subjects: list of dictionaries containing the fine-tuning subject filepaths
+    :param model_directory: str, directory containing the trained models (and the CDisc teacher models)
+    :param model_name: str, basename of the trained models
+    :param output_directory: str, directory for saving the pruned models (basename microbleednet)
+    :param keep_ratio: float (0, 1], proportion of the channels kept in each block
+    :param finetune_params: dictionary of fine-tuning parameters, if None the pruned models are not fine-tuned
+    :param verbose: bool, display debug messages
+    """
+
+    device = torch.device('cpu')
+
+    cdet_model = model_registry.load_model(model_directory, model_name, 'cdet')
+    cdisc_student_model = model_registry.load_model(model_directory, model_name, 'cdisc_student')
+
+    cdet_model.to(device=device)
+    cdisc_student_model.to(device=device)
+
+    # Patch sizes used by cdet_evaluate_function and cdisc_evaluate_function
+    example_inputs = {
+        'cdet': torch.rand(1, 2, 48, 48, 48, device=device),
+        'cdisc_student': torch.rand(1, 2, 24, 24, 24, device=device),
+    }
+
+    for model_key, model in [('cdet', cdet_model), ('cdisc_student', cdisc_student_model)]:
+
+        if verbose:
+            print(f'Pruning {model_key} model')
+
+        pruned_model = prune_model(model, keep_ratio)
+        save_pruned_model(pruned_model, output_directory, model_key)
+
+        flops = get_flops(model, example_inputs[model_key])
+        pruned_flops = get_flops(pruned_model, example_inputs[model_key])
+        latency = measure_latency(model, example_inputs[model_key])
+        pruned_latency = measure_latency(pruned_model, example_inputs[model_key])
+
+        print(f'{model_key}: {sum([p.numel() for p in model.parameters()]) / 1e6:.2f} M -> {sum([p.numel() for p in pruned_model.parameters()]) / 1e6:.2f} M parameters, '
+              f'{flops / 1e9:.2f} -> {pruned_flops / 1e9:.2f} GMACs per patch ({100 * (1 - pruned_flops / flops):.1f}% fewer), '
+              f'{latency * 1e3:.1f} -> {pruned_latency * 1e3:.1f} ms per patch on the CPU')
+
+    if finetune_params is None:
+        if verbose:
+            print('Pruning complete! The pruned models have not been fine-tuned.')
+        return
+
+    # Pruned models are fine-tuned in place, on all layers, and then saved again with their architecture
+    finetune_params = dict(finetune_params, Modelname='microbleednet')
+
+    if verbose:
+        print('Fine-tuning the pruned CDet model')
+    cdet_finetune_function.main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='last', verbose=verbose, model_directory=output_directory, checkpoint_directory=output_directory)
+    cdet_model = utils.load_cdet_model(os.path.join(output_directory, 'microbleednet_cdet_model_weights.pth'), mode='weights')
+    save_pruned_model(cdet_model, output_directory, 'cdet')
+
+    if verbose:
+        print('Fine-tuning the pruned CDisc student model')
+    cdisc_finetune_function.main(subjects, finetune_params, perform_augmentation=True, save_checkpoint=True, save_weights=True, save_case='last', verbose=verbose, model_directory=output_directory, checkpoint_directory=output_directory, teacher_directory=model_directory)
+    cdisc_student_model = utils.load_cdisc_student_model(os.path.join(output_directory, 'microbleednet_cdisc_student_model_weights.pth'), mode='weights')
+    save_pruned_model(cdisc_student_model, output_directory, 'cdisc_student')
+
+    if verbose:
+        print('Pruning and fine-tuning complete!')
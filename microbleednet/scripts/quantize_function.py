@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import copy
+import torch
+import numpy as np
+import torch.nn as nn
+from tqdm import tqdm
+from torch.ao.quantization import QConfig, QConfigMapping, get_default_qconfig, default_dynamic_qconfig, default_weight_observer
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from microbleednet.scripts import model_registry
+from microbleednet.scripts import compare_function
+from microbleednet.scripts import data_preparation
+from microbleednet.scripts import cdet_evaluate_function
+
+
+def get_calibration_patches(subjects, model_directory, model_name, max_patches=256, verbose=False):
+    """
+    Extracts the CDet (48x48x48) and CDisc (24x24x24) patches used to calibrate the static quantization
+    :param subjects: list of dictionaries containing subject filepaths
+    :param model_directory: str, directory containing the float models
+    :param model_name: str, basename of the float models
+    :param max_patches: int, maximum number of patches per model
+    :param verbose: bool, display debug messages
+    :return: tuple of ndarrays containing the CDet and CDisc calibration patches
+    """
+
+    cdet_patches_store = []
+    cdisc_patches_store = []
+
+    for subject in tqdm(subjects, leave=False, desc='get_calibration_patches', disable=True):
+
+        image, label, frst, _ = data_preparation.load_subject(subject)
+        brain_mask = (image > 0).astype(int)
+
+        data_patches, _, _, _, _ = data_preparation.get_nonoverlapping_patches(image, label, brain_mask, frst, 48)
+        data_patches[data_patches < 0] = 0
+        cdet_patches_store.append(data_patches)
+
+        # CDisc sees patches centred on the candidates of the float CDet model
+        subject = cdet_evaluate_function.main(dict(subject), verbose=False, model_directory=model_directory, model_name=model_name)
+        data_patches, _ = data_preparation.get_patches_centered_on_cmb(image, subject['cdet_inference'], frst, 24)
+        data_patches[data_patches < 0] = 0
+        cdisc_patches_store.append(data_patches)
+
+        if sum([len(patches) for patches in cdet_patches_store]) >= max_patches and sum([len(patches) for patches in cdisc_patches_store]) >= max_patches:
+            break
+
+    cdet_patches = np.concatenate(cdet_patches_store, axis=0)[:max_patches]
+    cdisc_patches = np.concatenate(cdisc_patches_store, axis=0)[:max_patches]
+
+    if verbose:
+        print(f'Num CDet calibration patches: {len(cdet_patches)}, Num CDisc calibration patches: {len(cdisc_patches)}')
+
+    return cdet_patches, cdisc_patches
+
+
+def quantize_model(model, calibration_patches, qconfig_mapping, batch_size=8):
+    """
+    Post-training quantization of the model, calibrated on the given patches
+    :param model: eager float model with loaded weights
+    :param calibration_patches: ndarray, N x C x H x W x D calibration patches
+    :param qconfig_mapping: QConfigMapping, static and/or dynamic quantization configuration
+    :param batch_size: int
+    :return: frozen torch.jit.ScriptModule of the quantized model
+    """
+
+    model = copy.deepcopy(model).eval()
+    example_input = torch.from_numpy(calibration_patches[:1]).float()
+
+    prepared_model = prepare_fx(model, qconfig_mapping, (example_input,))
+
+    with torch.no_grad():
+        for idx in range(0, len(calibration_patches), batch_size):
+            prepared_model(torch.from_numpy(calibration_patches[idx:idx + batch_size]).float())
+
+    quantized_model = convert_fx(prepared_model)
+
+    with torch.no_grad():
+        traced_model = torch.jit.trace(quantized_model, example_input)
+        frozen_model = torch.jit.freeze(traced_model)
+
+    return frozen_model
+
+
+def main(subjects, model_directory, model_name, output_directory, max_patches=256, verbose=False):
+    """
+    The main function for int8 quantization of the CDet and CDisc student models for CPU inference
+    :param subjects: list of dictionaries containing the calibration subject filepaths
+    :param model_directory: str, directory containing the float models
+    :param model_name: str, basename of the float models
+    :param output_directory: str, directory for saving the quantized models
+    :param max_patches: int, maximum number of calibration patches per model
+    :param verbose: bool, display debug messages
+    """
+
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+    cdet_model = model_registry.load_model(model_directory, model_name, 'cdet')
+    cdisc_student_model = model_registry.load_model(model_directory, model_name, 'cdisc_student')
+
+    cdet_model.to(device='cpu')
+    cdisc_student_model.to(device='cpu')
+
+    if verbose:
+        print(f'Found {len(subjects)} calibration subjects')
+
+    cdet_patches, cdisc_patches = get_calibration_patches(subjects, model_directory, model_name, max_patches=max_patches, verbose=verbose)
+
+    if len(cdisc_patches) == 0:
+        raise ValueError('The float CDet model did not detect any candidates in the calibration subjects, cannot calibrate the CDisc student model.')
+
+    static_qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    # Per channel weight observers are not supported for the ConvTranspose3d upsampling layers
+    transpose_qconfig = QConfig(activation=static_qconfig.activation, weight=default_weight_observer)
+
+    # Static quantization of the Conv3d stacks
+    if verbose:
+        print('Quantizing CDet model')
+    cdet_qconfig_mapping = QConfigMapping().set_global(static_qconfig).set_object_type(nn.ConvTranspose3d, transpose_qconfig)
+    quantized_cdet_model = quantize_model(cdet_model, cdet_patches, cdet_qconfig_mapping)
+    torch.jit.save(quantized_cdet_model, os.path.join(output_directory, f'{model_name}_cdet_model_int8.pt'))
+
+    # Static quantization of the Conv3d stacks and dynamic quantization of fc1..fc3
+    if verbose:
+        print('Quantizing CDisc student model')
+    cdisc_qconfig_mapping = QConfigMapping().set_global(static_qconfig).set_object_type(nn.Linear, default_dynamic_qconfig)
+    quantized_cdisc_student_model = quantize_model(cdisc_student_model, cdisc_patches, cdisc_qconfig_mapping)
+    torch.jit.save(quantized_cdisc_student_model, os.path.join(output_directory, f'{model_name}_cdisc_student_model_int8.pt'))
+
+    if verbose:
+        print('Quantization complete! Comparing with the float models.')
+
+    compare_function.main(subjects, model_directory, model_name, reference_variant='eager', test_variant='int8', test_model_directory=output_directory, verbose=verbose)
@@ -3,10 +3,20 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import re
+import json
+import time
+import hashlib
 import torch
 import random
+import contextlib
 import numpy as np
+import torch.distributed as dist
 from collections import OrderedDict
+from torch.utils.data import DataLoader
+
+from microbleednet.scripts import model_layers3D as model_layers
+from microbleednet.scripts import model_architectures as models
 
 ###########################################
 # Microbleednet general utility functions #
@@ -70,18 +80,20 @@ def split_subjects(subjects, train_proportion):
 
     return train_subjects, validation_subjects, validation_indices
 
-def freeze_layers_for_finetuning(model, layers_to_finetune, verbose=False):
+def freeze_layers_for_finetuning(model, layers_to_finetune, verbose=False, model_layer_names=None):
     """
     Unfreezing specific layers of the model for fine-tuning
     :param model: model
     :param layer_to_ft: list of ints, layers to fine-tune starting from the decoder end.
     :param verbose: bool, display debug messages
+    :param model_layer_names: list of layer names starting from the output end (default = CDet layers)
     :return: model after unfreezing only the required layers
     """
 
-    model_layer_names = ['outconv', 'up1', 'up2', 'up3', 'down3', 'down2', 'down1', 'convfirst']
+    if model_layer_names is None:
+        model_layer_names = ['outconv', 'up1', 'up2', 'up3', 'down3', 'down2', 'down1', 'convfirst']
 
-    model_layers_to_finetune = [model_layer_names[layer_idx - 1] for layer_idx in layers_to_finetune]
+    model_layers_to_finetune = [model_layer_names[layer_idx - 1] for layer_idx in layers_to_finetune if layer_idx <= len(model_layer_names)]
 
     for name, child in model.named_children():
         if name in model_layers_to_finetune:
@@ -97,14 +109,473 @@ def freeze_layers_for_finetuning(model, layers_to_finetune, verbose=False):
 
     return model
 
-def load_model(checkpoint_path, model, mode='weights'):
+def get_n_frozen_leading_layers(model):
+    """
+    Counts the leading layers of the model whose parameters are all frozen (see freeze_layers_for_finetuning)
+    :param model: model with a layer_order attribute, the names of its layers in the order of the forward pass
+    :return: int, number of frozen layers before the first trainable one
+    """
 
-    if mode == 'weights':
-        axial_state_dict = torch.load(checkpoint_path)
-    else:
-        checkpoint = torch.load(checkpoint_path)
-        axial_state_dict = checkpoint['model_state_dict']
+    n_frozen_layers = 0
+    for name in model.layer_order:
+        if any([param.requires_grad for param in getattr(model, name).parameters()]):
+            break
+        n_frozen_layers += 1
 
+    return n_frozen_layers
+
+def load_model(checkpoint_path, model, mode='weights'):
+
+    axial_state_dict, _ = load_checkpoint_with_architecture(checkpoint_path, mode)
     model.load_state_dict(axial_state_dict)
     
     return model
+
+def get_mid_channels(state_dict):
+    """
+    Finds the blocks whose DoubleConv has fewer channels between its two convolutions than at its output (pruned blocks)
+    :param state_dict: model state_dict
+    :return: dictionary of block name: number of channels, None if no block is pruned
+    """
+
+    mid_channels = {}
+    for key, value in state_dict.items():
+        if key.endswith('double_conv.0.weight'):
+            out_channels = state_dict[key.replace('double_conv.0.weight', 'double_conv.3.weight')].shape[0]
+            if value.shape[0] != out_channels:
+                mid_channels[key.split('.')[0]] = value.shape[0]
+
+    return mid_channels or None
+
+def get_cdet_architecture(state_dict):
+    """
+    Infers the CDet width, depth and pruned blocks from the shapes in a state_dict (weights-only checkpoints do not store them)
+    :param state_dict: CDet state_dict
+    :return: dictionary with init_channels, depth and mid_channels
+    """
+
+    init_channels = state_dict['convfirst.double_conv.3.weight'].shape[0]
+    depth = len([key for key in state_dict if re.fullmatch(r'down\d+\.maxpool_conv\.1\.double_conv\.0\.weight', key)])
+
+    return {'init_channels': init_channels, 'depth': depth, 'mid_channels': get_mid_channels(state_dict)}
+
+def get_cdisc_student_architecture(state_dict):
+    """
+    Infers the CDisc student width and pruned blocks from the shapes in a state_dict
+    :param state_dict: CDisc student state_dict
+    :return: dictionary with init_channels and mid_channels
+    """
+
+    init_channels = state_dict['convfirst.double_conv.3.weight'].shape[0]
+
+    return {'init_channels': init_channels, 'mid_channels': get_mid_channels(state_dict)}
+
+# Per process cache of the loaded checkpoints, keyed on the path, mode and modification time of the file
+_checkpoint_cache = {}
+
+def load_checkpoint_with_architecture(checkpoint_path, mode='weights'):
+    """
+    Loads the state_dict of a checkpoint, and the architecture stored with it (full model and safetensors checkpoints only).
+    The .pth checkpoints are memory-mapped and unpickled with weights_only=True, so that only tensors and plain
+    containers are read. Loaded checkpoints are cached for the lifetime of the process.
+    :param checkpoint_path: str, path to the checkpoint
+    :param mode: str, weights, full_model or safetensors
+    :return: tuple of state_dict and architecture dictionary (None if not stored)
+    """
+
+    file_stat = os.stat(checkpoint_path)
+    cache_key = (os.path.abspath(checkpoint_path), mode, file_stat.st_mtime_ns, file_stat.st_size)
+    if cache_key in _checkpoint_cache:
+        return _checkpoint_cache[cache_key]
+
+    if mode == 'safetensors':
+        try:
+            from safetensors import safe_open
+        except ImportError:
+            raise ImportError('Loading .safetensors checkpoints requires the safetensors package, please install it with pip install safetensors')
+
+        state_dict = OrderedDict()
+        with safe_open(checkpoint_path, framework='pt', device='cpu') as file:
+            for key in file.keys():
+                state_dict[key] = file.get_tensor(key)
+            metadata = file.metadata() or {}
+        architecture = json.loads(metadata['architecture']) if 'architecture' in metadata else None
+
+    else:
+        try:
+            checkpoint = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # Checkpoints written with the legacy (non zip) serialisation cannot be memory-mapped
+            checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+
+        if mode == 'weights':
+            state_dict, architecture = checkpoint, None
+        else:
+            state_dict, architecture = checkpoint['model_state_dict'], checkpoint.get('architecture')
+
+    # Entries of an earlier version of the same file are dropped, their memory-mapped pages may no longer be valid
+    for key in [key for key in _checkpoint_cache if key[:2] == cache_key[:2]]:
+        del _checkpoint_cache[key]
+    _checkpoint_cache[cache_key] = (state_dict, architecture)
+
+    return state_dict, architecture
+
+def load_cdet_model(checkpoint_path, mode='weights'):
+    """
+    Builds a CDet model with the architecture of the checkpoint and loads its weights
+    :param checkpoint_path: str, path to the checkpoint
+    :param mode: str, weights or full_model
+    :return: CDetNet
+    """
+
+    state_dict, architecture = load_checkpoint_with_architecture(checkpoint_path, mode)
+    if architecture is None:
+        architecture = get_cdet_architecture(state_dict)
+
+    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=architecture['init_channels'], depth=architecture['depth'], mid_channels=architecture.get('mid_channels'))
+    model.load_state_dict(state_dict)
+
+    return model
+
+def load_cdisc_student_model(checkpoint_path, mode='weights'):
+    """
+    Builds a CDisc student model with the architecture of the checkpoint and loads its weights
+    :param checkpoint_path: str, path to the checkpoint
+    :param mode: str, weights or full_model
+    :return: CDiscStudentNet
+    """
+
+    state_dict, architecture = load_checkpoint_with_architecture(checkpoint_path, mode)
+    if architecture is None:
+        architecture = get_cdisc_student_architecture(state_dict)
+
+    model = models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=architecture['init_channels'], mid_channels=architecture.get('mid_channels'))
+    model.load_state_dict(state_dict)
+
+    return model
+
+def load_exported_model(model_path, device):
+    """
+    Loads a frozen TorchScript model written by export_function or quantize_function
+    :param model_path: str, path to the exported model
+    :param device: cpu() or cuda()
+    :return: torch.jit.ScriptModule
+    """
+
+    if not os.path.isfile(model_path):
+        raise ValueError(f'{model_path} does not appear to be a valid exported model file. Please run microbleednet export or microbleednet quantize first.')
+
+    model = torch.jit.load(model_path, map_location=device)
+    model.eval()
+
+    return model
+
+def get_autocast_context(device, precision='float32'):
+    """
+    Returns the autocast context used for the forward passes
+    :param device: cpu() or cuda()
+    :param precision: str, float32, bfloat16 or float16
+    :return: context manager
+    """
+
+    if precision == 'float32':
+        return contextlib.nullcontext()
+
+    if precision == 'float16' and device.type != 'cuda':
+        raise ValueError('float16 autocast is only supported on the GPU, please use bfloat16 on the CPU')
+
+    dtype = torch.bfloat16 if precision == 'bfloat16' else torch.float16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+def get_grad_scaler(device, precision='float32'):
+    """
+    Returns the gradient scaler used for the backward passes
+    :param device: cpu() or cuda()
+    :param precision: str, float32, bfloat16 or float16
+    :return: torch.amp.GradScaler, disabled unless training in float16
+    """
+
+    # bfloat16 has the same exponent range as float32, so only float16 gradients need scaling
+    return torch.amp.GradScaler(device.type, enabled=(precision == 'float16'))
+
+def get_accumulation_step(batch_index, n_batches, batch_factor):
+    """
+    Gradient accumulation over groups of batch_factor consecutive batches of an epoch. The last group of the epoch can
+    be smaller, so that the optimiser always steps before the validation, the scheduler and the early stopping.
+    :param batch_index: int, index of the batch in the epoch
+    :param n_batches: int, number of batches in the epoch
+    :param batch_factor: int, number of batches accumulated for each optimiser step
+    :return: tuple of the number of batches in the group of the batch (to average the loss) and bool, step the optimiser after the batch
+    """
+
+    group_start = (batch_index // batch_factor) * batch_factor
+    group_size = min(batch_factor, n_batches - group_start)
+
+    return group_size, batch_index + 1 == group_start + group_size
+
+def create_data_loader(dataset, batch_size, sampler, training_params, device):
+    """
+    Creates the DataLoader of the training or validation patches, with the worker options of the training parameters.
+    The loaders are created once per training, so that persistent workers are reused by every epoch.
+    :param dataset: CDetPatchDataset or CDiscPatchDataset
+    :param batch_size: int
+    :param sampler: datasets.BalancedPatchSampler
+    :param training_params: dictionary of training parameters (Num_workers, Pin_memory, Persistent_workers, Prefetch_factor)
+    :param device: cpu() or cuda(), the batches are only pinned for copies to the GPU
+    :return: DataLoader
+    """
+
+    num_workers = training_params['Num_workers']
+    loader_options = {}
+    if num_workers > 0:
+        # Only valid with worker processes
+        loader_options['persistent_workers'] = training_params['Persistent_workers']
+        loader_options['prefetch_factor'] = training_params['Prefetch_factor']
+
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=(training_params['Pin_memory'] and device.type == 'cuda'), **loader_options)
+
+def cache_batches(data_loader, device):
+    """
+    Collates the batches of a data loader once, for the validation patches that are drawn in the same way at every
+    validation. The batches are kept in pinned memory when training on the GPU, so that they are copied asynchronously.
+    :param data_loader: DataLoader with a deterministic sampler
+    :param device: cpu() or cuda()
+    :return: list of batches (dictionaries of tensors)
+    """
+
+    batches = []
+    for batch in data_loader:
+        if device.type == 'cuda':
+            batch = {key: value.pin_memory() for key, value in batch.items()}
+        batches.append(batch)
+
+    return batches
+
+class EpochTimer:
+    """
+    Accumulates the time spent in the phases of a training epoch (waiting for the data loader, forward and backward
+    passes, optimiser steps, validation, checkpointing). On the GPU, the device is synchronised at the start and end of
+    each phase, so that the asynchronous kernels are counted in the phase that launched them.
+    """
+
+    # Phases timed by the training functions, reported (as 0 s) even when they do not occur in an epoch
+    phases = ['train', 'data_wait', 'preprocessing', 'forward', 'backward', 'optimizer', 'validation', 'checkpoint']
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict((phase, 0.0) for phase in self.phases)
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize()
+            self.times[phase] = self.times.get(phase, 0.0) + time.perf_counter() - start_time
+
+    def iterate(self, iterable, phase='data_wait'):
+        """
+        Iterates over a data loader, counting the time blocked waiting for each batch
+        :param iterable: DataLoader
+        :param phase: str
+        """
+
+        iterator = iter(iterable)
+        while True:
+            with self.time(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self, n_samples):
+        """
+        :param n_samples: int, number of patches trained on in the epoch (by all the processes)
+        :return: dictionary of the training throughput (samples_per_second) and the time of each phase in seconds (<phase>_time)
+        """
+
+        summary = OrderedDict()
+        summary['samples_per_second'] = n_samples / self.times['train'] if self.times['train'] > 0 else 0.0
+        for phase, phase_time in self.times.items():
+            summary[f'{phase}_time'] = phase_time
+
+        return summary
+
+def hash_files(paths):
+    """
+    :param paths: list of str, file paths
+    :return: str, SHA-256 hex digest of the contents of the files
+    """
+
+    file_hash = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def hash_state_dict(model):
+    """
+    :param model: model (or compiled model)
+    :return: str, SHA-256 hex digest of the names, shapes and values of the parameters and buffers of the model
+    """
+
+    state_dict_hash = hashlib.sha256()
+    for key, value in sorted(model.state_dict().items()):
+        value = value.detach().cpu().contiguous()
+        state_dict_hash.update(f'{key}:{value.dtype}:{tuple(value.shape)}'.encode())
+        state_dict_hash.update(value.view(-1).view(torch.uint8).numpy().tobytes() if value.numel() > 0 else b'')
+
+    return state_dict_hash.hexdigest()
+
+def print_epoch_timings(timings, verbose=False):
+    """
+    :param timings: dictionary returned by EpochTimer.summary
+    :param verbose: bool, display the timings
+    """
+
+    if verbose:
+        phase_times = ', '.join([f'{key[:-len("_time")]} {value:.2f} s' for key, value in timings.items() if key.endswith('_time')])
+        print(f'Training throughput: {timings["samples_per_second"]:.1f} patches/s ({phase_times})')
+
+def append_json_line(path, record):
+    """
+    Appends a record to a JSON lines file
+    :param path: str
+    :param record: dictionary of JSON serialisable values
+    """
+
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+def setup_distributed(seed=0):
+    """
+    Joins the process group of a multi-process training launched with torchrun (which sets RANK, WORLD_SIZE,
+    LOCAL_RANK, MASTER_ADDR and MASTER_PORT). NCCL is used when GPUs exist, and gloo between CPU processes otherwise.
+    The random generators are seeded identically in every process, so that the training/validation splits match.
+    :param seed: int
+    """
+
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        raise ValueError('Multi-process training must be launched with torchrun, e.g. torchrun --nproc_per_node=4 $(which microbleednet) train ... -mgpu True')
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        dist.init_process_group('nccl')
+    else:
+        dist.init_process_group('gloo')
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_sum(values, device):
+    """
+    Sums values over the processes of a distributed training
+    :param values: list of floats or ints
+    :param device: cpu() or cuda(), device of the process (NCCL only reduces GPU tensors)
+    :return: list of sums, with the types of the values (unchanged if the training is not distributed)
+    """
+
+    if not is_distributed():
+        return values
+
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+
+    return [type(value)(total) for value, total in zip(values, tensor.tolist())]
+
+def wrap_distributed_model(model, device):
+    """
+    Wraps the model being trained in DistributedDataParallel, so that its gradients are averaged over the processes
+    :param model: model
+    :param device: cpu() or cuda()
+    :return: tuple of the model used for the training passes and contextmanager function skipping the gradient
+    synchronisation (for the accumulated batches that are not followed by an optimiser step)
+    """
+
+    if not is_distributed():
+        return model, contextlib.nullcontext
+
+    device_ids = [torch.cuda.current_device()] if device.type == 'cuda' else None
+    distributed_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+    return distributed_model, distributed_model.no_sync
+
+def set_activation_checkpointing(model, enabled=True):
+    """
+    Enables activation checkpointing on the outermost DoubleConv, Down and Up blocks of the model: the activations inside
+    the blocks are recomputed in the backward pass instead of being kept in memory, so that larger patches and batches
+    can be trained in the same memory, at the cost of a second forward pass through the blocks. The state_dict is unchanged.
+    :param model: model
+    :param enabled: bool
+    :return: model
+    """
+
+    nested_blocks = set()
+    for module in model.modules():
+        if isinstance(module, (model_layers.DoubleConv, model_layers.Down, model_layers.Up)):
+            # Blocks inside a checkpointed block are recomputed with it
+            module.checkpointing = enabled and module not in nested_blocks
+            if module.checkpointing:
+                nested_blocks.update(module.modules())
+
+    return model
+
+def compile_model(model, cache_directory=None):
+    """
+    Compiles the forward pass of the model in place with torch.compile (inductor backend). The state_dict keys and the
+    model attributes are unchanged, so checkpoints can be saved and loaded as usual.
+    :param model: eager model
+    :param cache_directory: str, directory of the inductor compile cache, reused across runs (default = ~/.cache/microbleednet/inductor)
+    :return: model
+    """
+
+    if cache_directory is None:
+        cache_directory = os.path.join(os.path.expanduser('~'), '.cache', 'microbleednet', 'inductor')
+
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_directory)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+    # The patch shapes are fixed (48 x 48 x 48 CDet, 24 x 24 x 24 CDisc), so the graphs are specialised on them. Only the
+    # batch dimension is marked dynamic, so that the smaller last training and validation batches reuse the same graph
+    # instead of being recompiled. Dynamo still specialises a batch of one patch (e.g. the CDisc evaluation patches).
+    compiled_forward = torch.compile(model.forward, backend='inductor', dynamic=False)
+
+    def forward(x, *args, **kwargs):
+        torch._dynamo.maybe_mark_dynamic(x, 0)
+        return compiled_forward(x, *args, **kwargs)
+
+    # Set on the instance, so that both model(x) and the model.forward(x) calls of the training loops are compiled
+    model.forward = forward
+
+    return model
@@ -0,0 +1,55 @@
+import torch
+
+from microbleednet.scripts import augmentations
+
+
+def make_batch(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    label = (torch.rand(2, 1, 12, 10, 6, generator=generator) > 0.7).float()
+    # The FRST channel is the label volume and the image channel a scaled copy of it (noise is only added to the image)
+    data = torch.cat([0.8 * label, label], dim=1)
+    # Voxel labels and stored pixel weights, as in cdet_train_function.train
+    labels = torch.cat([label, 2 * label], dim=1)
+    return data, labels
+
+
+def test_translate_batch_shifts_each_volume_with_zero_fill():
+    volumes = torch.rand(2, 1, 12, 10, 6)
+    translated_volumes = augmentations.translate_batch(volumes, torch.tensor([2, 0]), torch.tensor([-3, 1]))
+
+    assert torch.equal(translated_volumes[0, :, 2:, :-3], volumes[0, :, :-2, 3:])
+    assert torch.all(translated_volumes[0, :, :2] == 0) and torch.all(translated_volumes[0, :, :, -3:] == 0)
+    assert torch.equal(translated_volumes[1, :, :, 1:], volumes[1, :, :, :-1])
+    assert torch.all(translated_volumes[1, :, :, :1] == 0)
+
+
+def test_image_labels_and_pixel_weights_move_together():
+    data, labels = make_batch()
+    augmented_data, augmented_labels = augmentations.augment_batch(data, labels, n_augmentations=8, generator=torch.Generator().manual_seed(0))
+
+    assert augmented_data.shape == (18, 2, 12, 10, 6)
+    assert augmented_labels.shape == (18, 2, 12, 10, 6)
+    assert torch.equal(augmented_data[:2], data) and torch.equal(augmented_labels[:2], labels)
+
+    augmented_label = augmented_labels[:, 0]
+    assert torch.equal(augmented_data[:, 1], augmented_label)
+    assert torch.equal(augmented_labels[:, 1], 2 * augmented_label)
+
+    # The image channel matches the label geometry up to the noise (standard deviation 0.1), a misaligned copy would
+    # differ by 0.8 on a large part of the voxels
+    image_errors = (augmented_data[:, 0] - 0.8 * augmented_label).abs().flatten(1).mean(dim=1)
+    assert torch.all(image_errors < 0.1)
+
+    # Some copies are flipped or translated, so the test compares moved volumes
+    assert not torch.equal(augmented_label[2:], labels[:, 0].repeat(8, 1, 1, 1))
+
+
+def test_same_generator_seed_gives_same_augmentations():
+    data, labels = make_batch()
+
+    first = augmentations.augment_batch(data, labels, generator=torch.Generator().manual_seed(3))
+    second = augmentations.augment_batch(data, labels, generator=torch.Generator().manual_seed(3))
+    other = augmentations.augment_batch(data, labels, generator=torch.Generator().manual_seed(4))
+
+    assert torch.equal(first[0], second[0]) and torch.equal(first[1], second[1])
+    assert not torch.equal(first[0], other[0])
@@ -0,0 +1,76 @@
+import os
+import time
+import threading
+
+import pytest
+import torch
+
+from microbleednet.scripts import checkpoint_writer
+
+
+def test_pending_writes_to_the_same_path_are_coalesced(tmp_path):
+    writer = checkpoint_writer.AsyncCheckpointWriter()
+    written = []
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_write(checkpoint, file):
+        started.set()
+        release.wait()
+        torch.save(checkpoint, file)
+
+    def recording_write(checkpoint, file):
+        written.append(checkpoint['epoch'])
+        torch.save(checkpoint, file)
+
+    # The writer thread is kept busy, so that the next writes are still pending when they are submitted
+    writer.submit(str(tmp_path / 'first.pth'), blocking_write, {'epoch': 0})
+    started.wait()
+    for epoch in range(1, 4):
+        writer.submit(str(tmp_path / 'model.pth'), recording_write, {'epoch': epoch})
+    release.set()
+    writer.close()
+
+    assert written == [3]
+    assert torch.load(tmp_path / 'model.pth')['epoch'] == 3
+
+
+def test_checkpoint_is_written_to_a_temporary_file_then_renamed(tmp_path):
+    writer = checkpoint_writer.AsyncCheckpointWriter()
+    path = tmp_path / 'model.pth'
+    writer.save({'weight': torch.ones(3)}, str(path))
+    writer.flush()
+
+    files_while_writing = []
+
+    def interrupted_write(checkpoint, file):
+        files_while_writing.extend(sorted(os.listdir(tmp_path)))
+        file.write(b'truncated')
+        raise OSError('disk full')
+
+    writer.submit(str(path), interrupted_write, None)
+    with pytest.raises(OSError):
+        writer.flush()
+
+    # The new checkpoint was written next to the previous one, which is left intact by the failed write
+    assert files_while_writing == ['model.pth', 'model.pth.tmp']
+    assert torch.equal(torch.load(path)['weight'], torch.ones(3))
+    writer.close()
+
+
+def test_write_error_is_raised_by_the_next_call(tmp_path):
+    writer = checkpoint_writer.AsyncCheckpointWriter()
+
+    def failing_write(checkpoint, file):
+        raise RuntimeError('write failed')
+
+    writer.submit(str(tmp_path / 'model.pth'), failing_write, None)
+    while writer.error is None:
+        time.sleep(0.01)
+
+    with pytest.raises(RuntimeError, match='write failed'):
+        writer.save({'epoch': 1}, str(tmp_path / 'model.pth'))
+
+    # The error is only raised once, the writer keeps writing the next checkpoints
+    writer.save({'epoch': 2}, str(tmp_path / 'model.pth'))
+    writer.close()
+    assert torch.load(tmp_path / 'model.pth')['epoch'] == 2
@@ -0,0 +1,48 @@
+import numpy as np
+
+from microbleednet.scripts import utils
+from microbleednet.scripts import data_preparation
+from microbleednet.scripts import cdet_evaluate_function
+from microbleednet.scripts import model_architectures as models
+
+
+def round_trip(candidate_map):
+    return data_preparation.unpack_candidate_map(data_preparation.pack_candidate_map(candidate_map))
+
+
+def test_empty_candidate_map_round_trip():
+    candidate_map = np.zeros((20, 18, 7), dtype=int)
+
+    assert 'indices' in data_preparation.pack_candidate_map(candidate_map)
+    assert np.array_equal(round_trip(candidate_map), candidate_map)
+
+
+def test_sparse_candidate_map_round_trip():
+    candidate_map = (np.random.default_rng(0).random((20, 18, 7)) > 0.99).astype(int)
+
+    assert 'indices' in data_preparation.pack_candidate_map(candidate_map)
+    assert np.array_equal(round_trip(candidate_map), candidate_map)
+
+
+def test_dense_candidate_map_round_trip():
+    # The number of voxels is not a multiple of 8, so the last packed byte is partly padding
+    candidate_map = (np.random.default_rng(0).random((20, 18, 7)) > 0.5).astype(int)
+
+    assert 'bits' in data_preparation.pack_candidate_map(candidate_map)
+    assert np.array_equal(round_trip(candidate_map), candidate_map)
+
+
+def test_changed_model_changes_candidates_cache_path(tmp_path):
+    input_path = tmp_path / 'subject_preproc.nii.gz'
+    frst_path = tmp_path / 'subject_frst.nii.gz'
+    input_path.write_bytes(b'input')
+    frst_path.write_bytes(b'frst')
+    subject = {'input_path': str(input_path), 'frst_path': str(frst_path)}
+
+    model = models.CDetNet(n_channels=2, n_classes=2, init_channels=4)
+    cache_path = cdet_evaluate_function.get_cdet_candidates_cache_path(subject, utils.hash_state_dict(model), 'float32', str(tmp_path))
+    assert cache_path == cdet_evaluate_function.get_cdet_candidates_cache_path(subject, utils.hash_state_dict(model), 'float32', str(tmp_path))
+
+    model.outconv.conv.bias.data[0] += 1
+    changed_cache_path = cdet_evaluate_function.get_cdet_candidates_cache_path(subject, utils.hash_state_dict(model), 'float32', str(tmp_path))
+    assert changed_cache_path != cache_path
@@ -0,0 +1,69 @@
+from microbleednet.scripts import datasets
+
+
+def make_dataset(n_minority, n_majority, ratio):
+    # The sampler only uses the class sizes and the ratio of the dataset
+    return datasets.CDiscPatchDataset([{}] * n_minority, [{}] * n_majority, ratio=ratio)
+
+
+def sample(dataset, epoch, seed=0, num_replicas=1, rank=0):
+    sampler = datasets.BalancedPatchSampler(dataset, seed=seed, num_replicas=num_replicas, rank=rank)
+    sampler.set_epoch(epoch)
+    return list(sampler)
+
+
+def test_same_seed_and_epoch_give_same_indices():
+    dataset = make_dataset(10, 30, '1:1')
+
+    assert sample(dataset, epoch=3) == sample(dataset, epoch=3)
+    assert sample(dataset, epoch=3, seed=1) != sample(dataset, epoch=3, seed=0)
+
+
+def test_epochs_draw_consecutive_windows_of_each_class():
+    dataset = make_dataset(10, 30, '1:1')
+
+    first_epoch = sample(dataset, epoch=0)
+    second_epoch = sample(dataset, epoch=1)
+    assert first_epoch != second_epoch
+
+    # Each epoch draws len(dataset) = 10 majority patches, so every majority patch is drawn once over three epochs
+    majority_indices = [group[1] for epoch in range(3) for group in sample(dataset, epoch)]
+    assert sorted(majority_indices) == list(range(10, 40))
+
+
+def test_one_to_one_proportion():
+    dataset = make_dataset(10, 30, '1:1')
+    groups = sample(dataset, epoch=0)
+
+    assert len(groups) == len(dataset)
+    for minority_index, majority_index in groups:
+        assert 0 <= minority_index < 10
+        assert 10 <= majority_index < 40
+
+
+def test_two_to_one_proportion():
+    dataset = make_dataset(10, 30, '2:1')
+    groups = sample(dataset, epoch=0)
+
+    assert len(groups) == len(dataset)
+    for majority_index, *minority_indices in groups:
+        assert 10 <= majority_index < 40
+        assert len(minority_indices) == 2
+        assert all([0 <= minority_index < 10 for minority_index in minority_indices])
+
+
+def test_replicas_get_disjoint_equal_length_shards():
+    dataset = make_dataset(11, 30, '1:1')
+    num_replicas = 4
+
+    shards = [sample(dataset, epoch=2, num_replicas=num_replicas, rank=rank) for rank in range(num_replicas)]
+
+    assert len(set([len(shard) for shard in shards])) == 1
+    assert len(shards[0]) == -(-len(dataset) // num_replicas)
+
+    # Interleaving the shards gives back the groups of a single process, each drawn by one replica only, padded with
+    # the first groups so that every replica runs the same number of batches
+    all_groups = sample(dataset, epoch=2)
+    interleaved_groups = [shard[idx] for idx in range(len(shards[0])) for shard in shards]
+    assert interleaved_groups[:len(all_groups)] == all_groups
+    assert interleaved_groups[len(all_groups):] == all_groups[:len(interleaved_groups) - len(all_groups)]
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from microbleednet.scripts import model_registry
+from microbleednet.scripts import prune_function
+from microbleednet.scripts import model_architectures as models
+
+
+@pytest.mark.parametrize('model_key, model, input_shape, output_shape', [
+    ('cdet', models.CDetNet(n_channels=2, n_classes=2, init_channels=8), (2, 2, 48, 48, 48), (2, 2, 48, 48, 48)),
+    ('cdisc_student', models.CDiscStudentNet(n_channels=2, n_classes=2, init_channels=64), (2, 2, 24, 24, 24), (2, 2)),
+])
+def test_pruned_model_reloads_through_the_registry(tmp_path, model_key, model, input_shape, output_shape):
+    pruned_model = prune_function.prune_model(model, keep_ratio=0.5)
+    prune_function.save_pruned_model(pruned_model, str(tmp_path), model_key)
+
+    # Every DoubleConv block keeps half of the channels between its two convolutions
+    state_dict = model.state_dict()
+    _, mid_channels = prune_function.prune_state_dict(state_dict, keep_ratio=0.5)
+    for key in [key for key in state_dict if key.endswith('double_conv.1.weight')]:
+        assert mid_channels[key.split('.')[0]] == state_dict[key].numel() // 2
+
+    reloaded_model = model_registry.load_model(str(tmp_path), 'microbleednet', model_key)
+    assert reloaded_model.architecture == pruned_model.architecture
+    assert sum([p.numel() for p in reloaded_model.parameters()]) < sum([p.numel() for p in model.parameters()])
+
+    x = torch.rand(*input_shape)
+    pruned_model.eval()
+    reloaded_model.eval()
+    with torch.no_grad():
+        output = reloaded_model(x)
+        assert output.shape == output_shape
+        assert torch.allclose(output, pruned_model(x))